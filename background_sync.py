@@ -1,18 +1,19 @@
 import time
-import schedule
 from pymongo.mongo_client import MongoClient
-from datetime import datetime
+from datetime import datetime, timezone
 import traceback
 import logging
 import requests
-from google.oauth2.credentials import Credentials
 import google.oauth2.credentials
 import google_auth_oauthlib.flow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import os
 from dotenv import load_dotenv
-from util import get_ics_events, sync_with_tasklist, decrypt_token
+from util import fetch_ics_events, feed_after_sync, sync_counts, sync_with_tasklist, upcoming_deadlines, decrypt_many, ensure_fresh_token, access_token_fields, SyncTrace, set_google_rate_limiter
+from sync_store import iter_sync_users, iter_due_users, SyncLedger, SharedRateLimiter, GOOGLE_API_CALLS_PER_MINUTE
+from sync_pipeline import SyncPipeline
+import metrics
 
 load_dotenv()
 
@@ -39,6 +40,13 @@ logger = logging.getLogger("background_sync")
 # Full MongoDB connection string from the environment.
 MONGO_URI = app_config['MONGO_URI']
 
+# How often the scheduler looks for users whose next_sync_at has passed.
+SYNC_POLL_SECONDS = int(os.getenv("SYNC_POLL_SECONDS", 60))
+# Users synced per pass before the schedule is read again.
+SYNC_DUE_BATCH = 200
+# Users synced to Google concurrently.
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", 8))
+
 
 
 def connect_to_mongodb():
@@ -58,74 +66,139 @@ def connect_to_mongodb():
         return None
 
 
-def refresh_user_tokens(user_auth):
-    """Refresh the access token using the refresh token"""
-    try:
-        # Build the credentials object
-        creds = Credentials(
-            token=None,  # We don't have a valid token
-            refresh_token=decrypt_token(user_auth.get('refresh_token')),
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id= app_config['OAUTH_CLIENT_ID'],
-            client_secret= app_config['OAUTH_CLIENT_SECRET'],
-            scopes=["https://www.googleapis.com/auth/tasks"]
-        )
-        
-        # Request a new token
-        creds.refresh(Request())
-        
-        # Return the refreshed credentials
-        return {
-            "access_token": creds.token,
-            "refresh_token": creds.refresh_token,
-            "client_id": user_auth.get('client_id'),
-            "client_secret": user_auth.get('client_secret'),
-        }
-    except Exception as e:
-        logger.error(f"Error refreshing tokens: {str(e)}")
+def refresh_user_tokens(user_auth, refresh_token, access_token=None):
+    """
+    The user's OAuth token from their (decrypted) refresh and saved access
+    tokens. The access token is reused unless it is about to expire, else
+    refreshed (see util.ensure_fresh_token). None if the refresh failed.
+    """
+    oauth_token = {
+        "access_token": access_token,
+        "expires_at": user_auth.get('access_token_expires_at'),
+        "refresh_token": refresh_token,
+        "client_id": user_auth.get('client_id') or app_config['OAUTH_CLIENT_ID'],
+        "client_secret": user_auth.get('client_secret') or app_config['OAUTH_CLIENT_SECRET'],
+    }
+    if not ensure_fresh_token(oauth_token):
         return None
+    return oauth_token
+
 
+def sync_task_for_user(user_auth, user_link, trace=None, prefetched=None):
+    """
+    Sync tasks for a specific user, recording stage timings in trace (a
+    util.SyncTrace) if given, from their prefetched feed (see
+    sync_pipeline) if given.
 
-def sync_task_for_user(user_auth, user_link):
-    """Sync tasks for a specific user"""
+    Returns a dict with 'success', plus 'ics_feed' (the feed state to save,
+    see util.fetch_ics_events), 'counts' and 'tasks_state' from the Google
+    sync, the feed's upcoming 'deadlines', 'not_modified' when the feed was
+    unchanged and the sync was skipped, and 'error' (a short error class) on
+    failure.
+    """
+    trace = trace if trace is not None else SyncTrace()
     try:
         # Get user information
         email = user_auth.get('email')
-        ics_url = decrypt_token(user_link.get('ics_url'))
+        with trace.stage('decrypt'):
+            ics_url, refresh_token, access_token = decrypt_many(
+                [user_link.get('ics_url'), user_auth.get('refresh_token'), user_auth.get('access_token')]
+            )
 
         if not ics_url:
             logger.warning(f"No ICS URL found for user {email}")
-            return False
+            return {"success": False, "error": "NoIcsUrl"}
 
         # Don't log the URL itself — it embeds a bearer token.
         logger.info(f"Starting sync for user {email}")
-        
+
+        # Get calendar events, unless the feed is unchanged since the last
+        # clean sync (304, or same content fingerprint). Fetching first means
+        # an unchanged feed costs neither a token refresh nor any Google call.
+        events, feed = fetch_ics_events(ics_url, user_link.get('ics_feed'), trace, prefetched)
+        if events is None:
+            logger.info(f"Feed unchanged for {email}; skipping sync")
+            return {"success": True, "not_modified": True, "ics_feed": feed}
+        if not events:
+            logger.warning(f"No events found in calendar for user {email}")
+            return {"success": False, "error": "NoEvents"}
+
         # Refresh the user's tokens
-        oauth_token = refresh_user_tokens(user_auth)
+        with trace.stage('token_refresh'):
+            oauth_token = refresh_user_tokens(user_auth, refresh_token, access_token)
         if not oauth_token:
             logger.error(f"Failed to refresh tokens for user {email}")
-            return False
-            
-        # Get calendar events
-        events = get_ics_events(ics_url)
-        if not events:
-            logger.warning(f"No events found in calendar for user {email}")
-            return False
+            return {"success": False, "error": "TokenRefreshFailed"}
             
         # Sync with Google Tasks - don't include past events
-        result = sync_with_tasklist(oauth_token, events, include_past_events=False)
+        result = sync_with_tasklist(
+            oauth_token, events, include_past_events=False,
+            state=user_auth.get('tasks_state'), trace=trace,
+        )
+        # Save the access token if it was refreshed, before or during the
+        # sync, for the next syncs to reuse.
+        token_fields = access_token_fields(oauth_token) if oauth_token['access_token'] != access_token else None
         
         if result.get('success'):
             logger.info(f"Sync successful for {email}. Added {result.get('task_count')} tasks.")
-            return True
+            return {
+                "success": True,
+                "counts": sync_counts(result),
+                "ics_feed": feed_after_sync(feed, result),
+                "tasks_state": result.get('tasks_state'),
+                "deadlines": upcoming_deadlines(events),
+                "token_fields": token_fields,
+            }
         else:
             logger.error(f"Sync failed for {email}: {result.get('error')}")
-            return False
+            return {"success": False, "error": result.get('error_class', 'SyncFailed'), "token_fields": token_fields}
             
     except Exception as e:
         logger.error(f"Error during sync for user: {str(e)}")
         logger.error(traceback.format_exc())
-        return False
+        return {"success": False, "error": type(e).__name__}
+
+
+def timed_sync_task_for_user(user_auth, user_link, prefetched=None):
+    """
+    sync_task_for_user, also returning how long it took in seconds and its
+    SyncTrace (profiled if the user is listed in SYNC_PROFILE_USERS).
+    """
+    trace = SyncTrace(user_auth.get('email'))
+    started = time.monotonic()
+    with trace.profiling():
+        result = sync_task_for_user(user_auth, user_link, trace, prefetched)
+    return result, time.monotonic() - started, trace
+
+
+def sync_users(users, ledger, pipeline):
+    """
+    Syncs (user_auth, user_link) pairs through the pipeline, recording each
+    outcome (and next sync time). Returns (processed, succeeded).
+    """
+    processed = 0
+    sync_count = 0
+    for user_auth, user_link, (result, duration, trace) in pipeline.run(users):
+        processed += 1
+        ledger.record(user_link, result, duration, trace, user_auth=user_auth)
+        if result.get('success'):
+            sync_count += 1
+    return processed, sync_count
+
+
+def sync_due_users(db, ledger, pipeline):
+    """
+    Syncs up to SYNC_DUE_BATCH users whose next_sync_at has passed, most
+    overdue first, downloading all their feeds up front. Returns how many
+    users were processed.
+    """
+    due = iter_due_users(db, datetime.now(timezone.utc), SYNC_DUE_BATCH)
+    processed, sync_count = sync_users(due, ledger, pipeline)
+    # The next pass reads the schedule these results set.
+    ledger.flush()
+    if processed:
+        logger.info(f"Synced {sync_count}/{processed} due users. Stages: {pipeline.summary()}")
+    return processed
 
 
 def sync_all_users():
@@ -136,60 +209,53 @@ def sync_all_users():
     if db is None:
         logger.error("Cannot connect to database. Aborting sync.")
         return
+    set_google_rate_limiter(SharedRateLimiter(db, "google_tasks", GOOGLE_API_CALLS_PER_MINUTE))
     
-    # Get all users with auth information and ics links
+    # Stream syncable users (auth joined to calendar link server-side)
     try:
-        users_auth = list(db.user_auth.find())
-        users_links = list(db.user_links.find())
-        
-        # Create a map of email to ics_url for quick lookup
-        links_map = {user['email']: user for user in users_links}
-        
-        logger.info(f"Found {len(users_auth)} users with auth data and {len(users_links)} with calendar links")
-        
-        sync_count = 0
-        for user_auth in users_auth:
-            email = user_auth.get('email')
-            user_link = links_map.get(email)
-            
-            if user_link:
-                success = sync_task_for_user(user_auth, user_link)
-                if success:
-                    sync_count += 1
-                    
-                    # Update last_sync timestamp in database
-                    db.user_auth.update_one(
-                        {"email": email},
-                        {"$set": {"last_sync": datetime.now()}}
-                    )
+        with SyncLedger(db, source="background_sync") as ledger, \
+                SyncPipeline(timed_sync_task_for_user, SYNC_WORKERS, SYNC_DUE_BATCH) as pipeline:
+            user_count, sync_count = sync_users(iter_sync_users(db), ledger, pipeline)
         
-        logger.info(f"Sync completed. Successfully synced {sync_count}/{len(users_auth)} users.")
+        logger.info(f"Sync completed. Successfully synced {sync_count}/{user_count} users.")
     
     except Exception as e:
         logger.error(f"Error during sync_all_users: {str(e)}")
         logger.error(traceback.format_exc())
+    finally:
+        metrics.export("background_sync")
 
 
 def run_scheduler():
-    """Run the scheduler that triggers sync every hour"""
-    # Schedule the sync to run every 24 hours
-    schedule.every(6).hours.do(sync_all_users)
-    
-    logger.info("Background sync scheduler started. Will sync every 24 hours.")
-    
-    # Run once immediately on startup
-    sync_all_users()
-    
-    # Keep running indefinitely
-    while True:
-        print("Check")
-        schedule.run_pending()
-        time.sleep(3600)  # Check every hour if there's a scheduled task to run
+    """
+    Syncs each user when their next_sync_at comes due (see
+    sync_store.next_sync_delay): hourly near deadlines, less often for idle
+    feeds. Users never synced before are due immediately.
+    """
+    db = connect_to_mongodb()
+    if db is None:
+        logger.error("Cannot connect to database. Aborting scheduler.")
+        return
+    set_google_rate_limiter(SharedRateLimiter(db, "google_tasks", GOOGLE_API_CALLS_PER_MINUTE))
+
+    logger.info(f"Background sync scheduler started. Checking for due users every {SYNC_POLL_SECONDS}s.")
+
+    with SyncLedger(db, source="background_sync") as ledger, \
+            SyncPipeline(timed_sync_task_for_user, SYNC_WORKERS, SYNC_DUE_BATCH) as pipeline:
+        while True:
+            processed = 0
+            try:
+                processed = sync_due_users(db, ledger, pipeline)
+            except Exception as e:
+                logger.error(f"Error during scheduled sync: {str(e)}")
+                logger.error(traceback.format_exc())
+            if processed:
+                metrics.export("background_sync")
+            # A full batch means more users are waiting; go straight on.
+            if processed < SYNC_DUE_BATCH:
+                time.sleep(SYNC_POLL_SECONDS)
 
 
 if __name__ == "__main__":
-    # Import the required Google auth modules here to avoid module not found errors
-    from google.auth.transport.requests import Request
-    
     logger.info("Starting background sync process")
     run_scheduler()
@@ -0,0 +1,513 @@
+"""
+Offline benchmarks for the ICS parse and Google Tasks sync hot paths in
+util.py. Feeds are generated in memory and the Tasks API is replaced by an
+in-process fake, so nothing touches the network.
+
+Usage:
+    python bench.py                                  # default sizes, JSON to stdout
+    python bench.py --events 100,2000 --repeat 3 --output bench.json
+    python bench.py --fill-cap                       # add a feed just under ICS_MAX_BYTES
+"""
+import gc
+import json
+import time
+import argparse
+import itertools
+import logging
+import platform
+import statistics
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import util
+
+DEFAULT_EVENT_COUNTS = (100, 1000, 5000)
+DEFAULT_REPEAT = 5
+DEFAULT_DESCRIPTION_LENGTH = 400
+# Every Nth event is an individually edited instance of a series.
+DEFAULT_RECURRENCE_EVERY = 10
+# Custom (non-Olson) zone some timed events are given in, defined by the
+# feed's own VTIMEZONE, as some institutions' feeds do.
+DEFAULT_TZID = "Canvas Campus Time"
+
+BENCH_FEED_URL = "https://canvas.invalid/feeds/calendars/user_bench.ics"
+
+
+# ---------------------------------------------------------------------------
+# Synthetic Canvas feed
+# ---------------------------------------------------------------------------
+
+def _ics_escape(text):
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+
+def _fold(line):
+    """Folds a content line at 75 octets, as RFC 5545 (and Canvas) does."""
+    raw = line.encode('utf-8')
+    if len(raw) <= 75:
+        return [raw]
+    out = [raw[:75]]
+    raw = raw[75:]
+    while raw:
+        out.append(b' ' + raw[:74])
+        raw = raw[74:]
+    return out
+
+
+def _vtimezone_lines(tzid):
+    return [
+        "BEGIN:VTIMEZONE",
+        f"TZID:{tzid}",
+        "BEGIN:STANDARD",
+        "DTSTART:19701101T020000",
+        "TZOFFSETFROM:-0400",
+        "TZOFFSETTO:-0500",
+        "TZNAME:CCST",
+        "END:STANDARD",
+        "BEGIN:DAYLIGHT",
+        "DTSTART:19700308T020000",
+        "TZOFFSETFROM:-0500",
+        "TZOFFSETTO:-0400",
+        "TZNAME:CCDT",
+        "END:DAYLIGHT",
+        "END:VTIMEZONE",
+    ]
+
+
+def _vevent_lines(i, description_length, recurrence_every, base, tzid=None):
+    course = f"CS {100 + i % 40}"
+    due = base + timedelta(days=i % 240 - 60, hours=i % 24)
+    description = (f"Assignment {i} for {course}, part {i % 5}; submit on Canvas. "
+                   * (description_length // 60 + 1))[:description_length]
+    lines = [
+        "BEGIN:VEVENT",
+        f"DTSTAMP:{base:%Y%m%dT%H%M%SZ}",
+        f"UID:event-assignment-{1800000 + i}",
+    ]
+    if i % 3 == 0:
+        # All-day assignment, the most common shape in Canvas feeds
+        lines += [f"DTSTART;VALUE=DATE:{due:%Y%m%d}", f"DTEND;VALUE=DATE:{due:%Y%m%d}"]
+    elif tzid and i % 3 == 1:
+        lines += [f"DTSTART;TZID={tzid}:{due:%Y%m%dT%H%M%S}", f"DTEND;TZID={tzid}:{due:%Y%m%dT%H%M%S}"]
+    else:
+        lines += [f"DTSTART:{due:%Y%m%dT%H%M%SZ}", f"DTEND:{due:%Y%m%dT%H%M%SZ}"]
+    if recurrence_every and i % recurrence_every == 0:
+        lines.append(f"RECURRENCE-ID:{due:%Y%m%dT%H%M%SZ}")
+    lines += [
+        "CLASS:PUBLIC",
+        f"DESCRIPTION:{_ics_escape(description)}",
+        "SEQUENCE:0",
+        f"SUMMARY:{_ics_escape(f'Assignment {i}, part {i % 5} [{course}]')}",
+        f"URL;VALUE=URI:https://canvas.invalid/courses/{i % 40}/assignments/{1800000 + i}",
+        f"X-ALT-DESC;FMTTYPE=text/html:<p>{_ics_escape(description)}</p>",
+        "END:VEVENT",
+    ]
+    return lines
+
+
+def make_ics(events, description_length=DEFAULT_DESCRIPTION_LENGTH,
+             recurrence_every=DEFAULT_RECURRENCE_EVERY, base=None, tzid=DEFAULT_TZID):
+    """
+    Builds a synthetic Canvas-style ICS feed.
+
+    Args:
+        events (int): Number of VEVENTs
+        description_length (int): Characters per description (also repeated
+            in X-ALT-DESC, as Canvas does)
+        recurrence_every (int): Every Nth event gets a RECURRENCE-ID; 0 for none
+        base (datetime): Due dates are spread from 60 days before this to 180
+            days after; defaults to now
+        tzid (str): A third of the events are in this zone, defined by a
+            VTIMEZONE in the feed; None keeps every event in UTC
+
+    Returns:
+        bytes: The feed, CRLF line endings and folded lines included
+    """
+    base = base or datetime.now(timezone.utc).replace(microsecond=0)
+    header = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//Instructure//Canvas//EN",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        "X-WR-CALNAME:Bench Student Calendar (Canvas)",
+    ]
+    out = []
+    if tzid:
+        header += _vtimezone_lines(tzid)
+    for line in header:
+        out += _fold(line)
+    for i in range(events):
+        for line in _vevent_lines(i, description_length, recurrence_every, base, tzid):
+            out += _fold(line)
+    out.append(b"END:VCALENDAR")
+    return b"\r\n".join(out) + b"\r\n"
+
+
+def events_for_size(target_bytes, description_length=DEFAULT_DESCRIPTION_LENGTH,
+                    recurrence_every=DEFAULT_RECURRENCE_EVERY):
+    """Largest event count whose generated feed stays under target_bytes."""
+    sample = 200
+    overhead = len(make_ics(0))
+    per_event = (len(make_ics(sample, description_length, recurrence_every)) - overhead) / sample
+    count = int((target_bytes - overhead) / per_event)
+    while count > 0 and len(make_ics(count, description_length, recurrence_every)) >= target_bytes:
+        count -= max(1, count // 200)
+    return count
+
+
+# ---------------------------------------------------------------------------
+# In-process stand-ins for the network
+# ---------------------------------------------------------------------------
+
+class _FeedResponse:
+    """Just enough of a requests.Response for fetch_ics_events."""
+
+    def __init__(self, content):
+        self.content = content
+        self.headers = {}
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class _FakeRequest:
+    def __init__(self, fn):
+        self._fn = fn
+
+    def execute(self, num_retries=0):
+        return self._fn()
+
+
+class _FakeBatch:
+    def __init__(self, service, callback):
+        self._service = service
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, request_id=None):
+        self._requests.append((request_id, request))
+
+    def execute(self):
+        self._service.calls['batch'] += 1
+        for request_id, request in self._requests:
+            self._callback(request_id, request.execute(), None)
+
+
+class FakeTasksService:
+    """
+    In-memory Google Tasks v1 service with the surface util.py uses:
+    tasklists list/insert, tasks list (paged, updatedMin, showDeleted)/get/
+    insert/patch, and batch requests. Field masks are accepted and ignored.
+    """
+
+    def __init__(self):
+        self.tasklists_store = {}
+        self.tasks_store = {}
+        self.calls = {'batch': 0, 'list': 0, 'get': 0, 'insert': 0, 'patch': 0}
+        # Tasks returned by tasks.list, across pages.
+        self.listed = 0
+        self._ids = itertools.count(1)
+
+    def _now(self):
+        return datetime.now(timezone.utc).isoformat()
+
+    def tasklists(self):
+        return _FakeTasklists(self)
+
+    def tasks(self):
+        return _FakeTasks(self)
+
+    def new_batch_http_request(self, callback):
+        return _FakeBatch(self, callback)
+
+
+class _FakeTasklists:
+    def __init__(self, service):
+        self.s = service
+
+    def list(self, **kwargs):
+        items = list(self.s.tasklists_store.values())
+        return _FakeRequest(lambda: {'items': items})
+
+    def insert(self, body, **kwargs):
+        def run():
+            tasklist = dict(body, id=f"list{next(self.s._ids)}")
+            self.s.tasklists_store[tasklist['id']] = tasklist
+            self.s.tasks_store[tasklist['id']] = {}
+            return tasklist
+        return _FakeRequest(run)
+
+
+class _FakeTasks:
+    def __init__(self, service):
+        self.s = service
+
+    def list(self, tasklist, pageToken=None, maxResults=100, updatedMin=None,
+             showDeleted=False, **kwargs):
+        def run():
+            self.s.calls['list'] += 1
+            items = [
+                t for t in self.s.tasks_store[tasklist].values()
+                if (showDeleted or not t.get('deleted'))
+                and (updatedMin is None or t['updated'] >= updatedMin)
+            ]
+            start = int(pageToken or 0)
+            page = {'items': items[start:start + maxResults]}
+            self.s.listed += len(page['items'])
+            if start + maxResults < len(items):
+                page['nextPageToken'] = str(start + maxResults)
+            return page
+        return _FakeRequest(run)
+
+    def get(self, tasklist, task, **kwargs):
+        def run():
+            self.s.calls['get'] += 1
+            return dict(self.s.tasks_store[tasklist][task])
+        return _FakeRequest(run)
+
+    def insert(self, tasklist, body, **kwargs):
+        def run():
+            self.s.calls['insert'] += 1
+            task = dict(body, id=f"task{next(self.s._ids)}", updated=self.s._now())
+            self.s.tasks_store[tasklist][task['id']] = task
+            return {'id': task['id']}
+        return _FakeRequest(run)
+
+    def patch(self, tasklist, task, body, **kwargs):
+        def run():
+            self.s.calls['patch'] += 1
+            stored = self.s.tasks_store[tasklist][task]
+            stored.update(body, updated=self.s._now())
+            return {'id': stored['id']}
+        return _FakeRequest(run)
+
+
+@contextmanager
+def _patched(obj, name, value):
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
+
+
+# ---------------------------------------------------------------------------
+# Timing
+# ---------------------------------------------------------------------------
+
+def _measure(fn, repeat, setup=None):
+    """
+    Runs fn repeat times (each after an untimed setup, whose result is passed
+    in) with the garbage collector paused, and returns the timings in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            fn(arg) if setup else fn()
+            timings.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return timings
+
+
+def _result(name, events, feed_bytes, timings, **extra):
+    median = statistics.median(timings)
+    return dict({
+        "name": name,
+        "events": events,
+        "bytes": feed_bytes,
+        "runs": len(timings),
+        "min_s": min(timings),
+        "median_s": median,
+        "mean_s": statistics.mean(timings),
+        "max_s": max(timings),
+        "per_event_us": median / events * 1e6 if events else None,
+    }, **extra)
+
+
+def check_parity(content):
+    """
+    Raises if the streaming parser and icalendar's whole-calendar parse
+    disagree on any event of content, so a benchmark never times a parser
+    that gets the feed wrong. The stream goes first: icalendar remembers
+    custom zones process-wide, and a whole-calendar parse would teach the
+    stream the feed's VTIMEZONEs.
+    """
+    chunks = [content[i:i + 8192] for i in range(0, len(content), 8192)]
+    streamed = list(util.iter_ics_events(chunks))
+    parsed = util._parse_ics(content)
+    if streamed != parsed:
+        mismatch = next((i for i, (a, b) in enumerate(zip(streamed, parsed)) if a != b), None)
+        raise RuntimeError(
+            f"Streaming parse differs from _parse_ics: {len(streamed)} vs {len(parsed)} events, "
+            f"first mismatch at {mismatch}"
+        )
+    return parsed
+
+
+def bench_parse(content, events, repeat):
+    """get_ics_events end to end, streaming and buffered, plus an unchanged refetch."""
+    results = []
+    open_feed = lambda url, validators=None: _FeedResponse(content)
+    with _patched(util, '_open_ics', open_feed):
+        for mode, stream in (("stream", True), ("buffered", False)):
+            with _patched(util, 'ICS_STREAM_PARSE', stream):
+                timings = _measure(lambda: util.get_ics_events(BENCH_FEED_URL), repeat)
+            results.append(_result(f"get_ics_events[{mode}]", events, len(content), timings))
+
+        _, feed = util.fetch_ics_events(BENCH_FEED_URL)
+        timings = _measure(lambda: util.fetch_ics_events(BENCH_FEED_URL, feed), repeat)
+        results.append(_result("fetch_ics_events[unchanged]", events, len(content), timings))
+    return results
+
+
+def bench_convert_validate(parsed, repeat):
+    """convert_to_rfc3339 and validate_task over every event, as the planner runs them."""
+    def run():
+        for event in parsed:
+            when = event['end'] or event['start']
+            task = {'title': event['summary'], 'notes': event['description'], 'status': 'needsAction'}
+            if when:
+                task['due'] = util.convert_to_rfc3339(when)
+            util.validate_task(task)
+    return [_result("convert_to_rfc3339+validate_task", len(parsed), None, _measure(run, repeat))]
+
+
+def _synced_service(parsed, age=timedelta(hours=1)):
+    """
+    A fake service whose dot_tasklist already holds a full sync of parsed,
+    and that sync's tasks_state, in the steady state of a user between
+    scheduled syncs: the tasks were written 2 * age ago and the saved
+    listing is from age ago (a later sync that changed nothing). With age
+    well past util.TASKS_STATE_CLOCK_SKEW, an incremental listing finds no
+    task changed since.
+    """
+    service = FakeTasksService()
+    with _patched(util, 'get_tasks_service', lambda token: (service, token)):
+        result = util.sync_with_tasklist({'token': 'bench'}, parsed)
+    for tasks in service.tasks_store.values():
+        for task in tasks.values():
+            task['updated'] = (datetime.fromisoformat(task['updated']) - 2 * age).isoformat()
+    state = dict(result['tasks_state'], listed_at=result['tasks_state']['listed_at'] - age)
+    return service, state
+
+
+def bench_sync(parsed, repeat):
+    """plan_sync alone, then sync_with_tasklist into an empty and an up-to-date list."""
+    results = []
+    listed = {}
+    token = {'token': 'bench'}
+    service, state = _synced_service(parsed)
+    existing = [util._task_entry(t) for t in service.tasks_store[state['tasklist_id']].values()]
+    today = datetime.now(timezone.utc).date()
+
+    timings = _measure(lambda: util.plan_sync(parsed, existing, today), repeat)
+    results.append(_result("plan_sync[up_to_date]", len(parsed), None, timings))
+    timings = _measure(lambda: util.plan_sync(parsed, [], today), repeat)
+    results.append(_result("plan_sync[empty]", len(parsed), None, timings))
+
+    def sync_into(arg):
+        service, state = arg
+        with _patched(util, 'get_tasks_service', lambda token: (service, token)):
+            util.sync_with_tasklist(token, parsed, state=state)
+
+    scenarios = (
+        ("initial", lambda: (FakeTasksService(), None)),
+        ("resync_full", lambda: (_synced_service(parsed)[0], None)),
+        ("resync_incremental", lambda: _synced_service(parsed)),
+    )
+    for name, make in scenarios:
+        services = []
+
+        def setup(make=make):
+            service, state = make()
+            service.calls = dict.fromkeys(service.calls, 0)
+            service.listed = 0
+            services.append(service)
+            return service, state
+
+        timings = _measure(sync_into, repeat, setup=setup)
+        results.append(_result(f"sync_with_tasklist[{name}]", len(parsed), None, timings,
+                               api_calls=services[-1].calls))
+        listed[name] = services[-1].listed
+
+    # An incremental resync that lists as many tasks as a full one isn't
+    # measuring incremental listing.
+    if parsed and listed["resync_incremental"] >= listed["resync_full"]:
+        raise RuntimeError(f"Incremental resync listed no fewer tasks than a full one: {listed}")
+    return results
+
+
+def run(event_counts, repeat, fill_cap=False, description_length=DEFAULT_DESCRIPTION_LENGTH,
+        recurrence_every=DEFAULT_RECURRENCE_EVERY):
+    """Runs every benchmark for each feed size and returns the JSON-ready report."""
+    feeds = [(n, make_ics(n, description_length, recurrence_every)) for n in event_counts]
+    if fill_cap:
+        n = events_for_size(util.ICS_MAX_BYTES, description_length, recurrence_every)
+        feeds.append((n, make_ics(n, description_length, recurrence_every)))
+
+    results = []
+    for events, content in feeds:
+        parsed = check_parity(content)
+        results += bench_parse(content, events, repeat)
+        results += bench_convert_validate(parsed, repeat)
+        results += bench_sync(parsed, repeat)
+
+    return {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "description_length": description_length,
+            "recurrence_every": recurrence_every,
+            "batch_size": util.BATCH_SIZE,
+            "ics_max_bytes": util.ICS_MAX_BYTES,
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ICS parse and sync hot paths offline.")
+    parser.add_argument("--events", default=",".join(map(str, DEFAULT_EVENT_COUNTS)),
+                        help="Comma-separated event counts to benchmark")
+    parser.add_argument("--fill-cap", action="store_true",
+                        help="Also benchmark a feed just under ICS_MAX_BYTES")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--description-length", type=int, default=DEFAULT_DESCRIPTION_LENGTH)
+    parser.add_argument("--recurrence-every", type=int, default=DEFAULT_RECURRENCE_EVERY)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    # util logs every task it touches; that would dominate the timings.
+    logging.disable(logging.CRITICAL)
+
+    report = run(
+        [int(n) for n in args.events.split(",") if n],
+        args.repeat,
+        fill_cap=args.fill_cap,
+        description_length=args.description_length,
+        recurrence_every=args.recurrence_every,
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+"""
+Local stand-in for the Google endpoints the batch sync talks to (Tasks v1 and
+the OAuth token endpoint), plus a Canvas-style ICS feed server, for load
+testing background_sync.py / one_time_sync.py without touching Google.
+
+Start the server:
+    python fake_google.py serve --port 8765 --latency-ms 80 --jitter-ms 40 \\
+        --error-rate-429 0.01 --user-quota-per-minute 500
+
+Point the sync at it (no code changes needed):
+    GOOGLE_TASKS_ROOT_URL=http://127.0.0.1:8765/
+    GOOGLE_TOKEN_URI=http://127.0.0.1:8765/token
+    ICS_TRUSTED_HOSTS=127.0.0.1
+
+Fill a scratch database with users whose feeds live on the fake server:
+    python fake_google.py seed --mongo-uri mongodb://localhost:27017 --db loadtest \\
+        --users 10000 --feed-base http://127.0.0.1:8765
+
+Counters (requests, statuses, injected errors, refreshes) are served as JSON
+at /_stats.
+"""
+import re
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import itertools
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import bench
+
+# Google rejects batches larger than this.
+MAX_BATCH_SIZE = 1000
+
+_TASKLISTS_RE = re.compile(r'^/tasks/v1/users/@me/lists(?:/(?P<tasklist>[^/]+))?$')
+_TASKS_RE = re.compile(r'^/tasks/v1/lists/(?P<tasklist>[^/]+)/tasks(?:/(?P<task>[^/]+))?$')
+
+
+def _rfc3339(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + f'{dt.microsecond // 1000:03d}Z'
+
+
+def _parse_rfc3339(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _error(code, reason, message, status):
+    return code, {"error": {
+        "code": code,
+        "message": message,
+        "errors": [{"message": message, "domain": "usageLimits" if code in (403, 429) else "global",
+                    "reason": reason}],
+        "status": status,
+    }}
+
+
+class FakeGoogle:
+    """
+    The state behind the server: issued access tokens, each user's tasklists
+    and tasks, per-minute quota windows and counters. Users are identified by
+    their refresh token. Every method is thread-safe.
+    """
+
+    def __init__(self, error_rate_429=0.0, error_rate_403=0.0, user_quota_per_minute=0,
+                 global_quota_per_minute=0, ics_events=200):
+        self.error_rate_429 = error_rate_429
+        self.error_rate_403 = error_rate_403
+        self.user_quota_per_minute = user_quota_per_minute
+        self.global_quota_per_minute = global_quota_per_minute
+        self.ics_events = ics_events
+
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._tokens = {}
+        self._users = {}
+        self._window = None
+        self._window_calls = {}
+        self._feeds = {}
+        self.stats = {"http_requests": 0, "api_calls": 0, "batches": 0, "token_refreshes": 0,
+                      "feeds_served": 0, "feeds_not_modified": 0, "statuses": {}, "methods": {}}
+
+    def count(self, key, sub=None):
+        with self._lock:
+            if sub is None:
+                self.stats[key] += 1
+            else:
+                self.stats[key][sub] = self.stats[key].get(sub, 0) + 1
+
+    # --- OAuth ---------------------------------------------------------
+
+    def refresh(self, form):
+        """POST /token with grant_type=refresh_token."""
+        refresh_token = (form.get('refresh_token') or [None])[0]
+        if (form.get('grant_type') or [None])[0] != 'refresh_token' or not refresh_token:
+            return 400, {"error": "invalid_grant", "error_description": "Bad Request"}
+        access_token = f"ya29.fake-{uuid.uuid4().hex}"
+        with self._lock:
+            self._tokens[access_token] = refresh_token
+            self._users.setdefault(refresh_token, {"tasklists": {}, "tasks": {}})
+            self.stats["token_refreshes"] += 1
+        return 200, {"access_token": access_token, "expires_in": 3599, "token_type": "Bearer",
+                     "scope": "https://www.googleapis.com/auth/tasks"}
+
+    # --- Tasks API -----------------------------------------------------
+
+    def _admit(self, user):
+        """Applies quotas and injected errors; returns an error response or None."""
+        minute = int(time.time() // 60)
+        with self._lock:
+            if self._window != minute:
+                self._window, self._window_calls = minute, {}
+            calls = self._window_calls
+            calls[None] = calls.get(None, 0) + 1
+            calls[user] = calls.get(user, 0) + 1
+            over_global = self.global_quota_per_minute and calls[None] > self.global_quota_per_minute
+            over_user = self.user_quota_per_minute and calls[user] > self.user_quota_per_minute
+        if over_global:
+            return _error(429, "rateLimitExceeded", "Quota exceeded for quota metric 'Queries'.",
+                          "RESOURCE_EXHAUSTED")
+        if over_user:
+            return _error(403, "userRateLimitExceeded", "User Rate Limit Exceeded", "PERMISSION_DENIED")
+        roll = random.random()
+        if roll < self.error_rate_429:
+            return _error(429, "rateLimitExceeded", "Rate Limit Exceeded", "RESOURCE_EXHAUSTED")
+        if roll < self.error_rate_429 + self.error_rate_403:
+            return _error(403, "rateLimitExceeded", "Rate Limit Exceeded", "PERMISSION_DENIED")
+        return None
+
+    def api(self, method, target, headers, body):
+        """Handles one Tasks API call (direct or from a batch); returns (status, json)."""
+        self.count("api_calls")
+        self.count("methods", method)
+        auth = headers.get('Authorization') or headers.get('authorization') or ''
+        with self._lock:
+            user = self._tokens.get(auth[len('Bearer '):]) if auth.startswith('Bearer ') else None
+        if user is None:
+            return _error(401, "authError", "Invalid Credentials", "UNAUTHENTICATED")
+        rejected = self._admit(user)
+        if rejected:
+            return rejected
+
+        parts = urlsplit(target)
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            return _error(400, "parseError", "Parse Error", "INVALID_ARGUMENT")
+
+        with self._lock:
+            data = self._users[user]
+            match = _TASKLISTS_RE.match(parts.path)
+            if match:
+                return self._tasklists(data, method, match['tasklist'], query, payload)
+            match = _TASKS_RE.match(parts.path)
+            if match:
+                return self._tasks(data, method, match['tasklist'], match['task'], query, payload)
+        return _error(404, "notFound", "Not Found", "NOT_FOUND")
+
+    def _new_id(self):
+        return hashlib.sha1(str(next(self._ids)).encode()).hexdigest()[:22]
+
+    def _page(self, items, query, default_max):
+        max_results = min(int(query.get('maxResults', default_max)), 100)
+        start = int(query.get('pageToken') or 0)
+        page = {"items": items[start:start + max_results]}
+        if start + max_results < len(items):
+            page["nextPageToken"] = str(start + max_results)
+        return page
+
+    def _tasklists(self, data, method, tasklist_id, query, payload):
+        now = _rfc3339(datetime.now(timezone.utc))
+        if tasklist_id is None and method == 'GET':
+            page = self._page(list(data["tasklists"].values()), query, 1000)
+            return 200, dict(page, kind="tasks#taskLists")
+        if tasklist_id is None and method == 'POST':
+            tasklist = {"kind": "tasks#taskList", "id": self._new_id(),
+                        "title": payload.get('title', ''), "updated": now}
+            data["tasklists"][tasklist["id"]] = tasklist
+            data["tasks"][tasklist["id"]] = {}
+            return 200, tasklist
+        if tasklist_id in data["tasklists"] and method == 'GET':
+            return 200, data["tasklists"][tasklist_id]
+        return _error(404, "notFound", "Not Found", "NOT_FOUND")
+
+    def _tasks(self, data, method, tasklist_id, task_id, query, payload):
+        tasks = data["tasks"].get(tasklist_id)
+        if tasks is None:
+            return _error(404, "notFound", "Task list not found.", "NOT_FOUND")
+        now = datetime.now(timezone.utc)
+
+        if task_id is None and method == 'GET':
+            show_deleted = query.get('showDeleted') == 'true'
+            show_completed = query.get('showCompleted', 'true') == 'true'
+            show_hidden = query.get('showHidden') == 'true'
+            updated_min = _parse_rfc3339(query['updatedMin']) if query.get('updatedMin') else None
+            items = [
+                t for t in tasks.values()
+                if (show_deleted or not t.get('deleted'))
+                and (show_completed or t.get('status') != 'completed')
+                and (show_hidden or not t.get('hidden'))
+                and (updated_min is None or _parse_rfc3339(t['updated']) >= updated_min)
+            ]
+            return 200, dict(self._page(items, query, 20), kind="tasks#tasks")
+
+        if task_id is None and method == 'POST':
+            task = self._apply({"kind": "tasks#task", "id": self._new_id(), "status": "needsAction"},
+                               payload, now)
+            tasks[task["id"]] = task
+            return 200, task
+
+        task = tasks.get(task_id)
+        if task is None or (task.get('deleted') and method != 'GET'):
+            return _error(404, "notFound", "Task not found.", "NOT_FOUND")
+        if method == 'GET':
+            return 200, task
+        if method in ('PATCH', 'PUT'):
+            return 200, self._apply(task, payload, now)
+        if method == 'DELETE':
+            task.update(deleted=True, updated=_rfc3339(now))
+            return 204, None
+        return _error(405, "methodNotAllowed", "Method Not Allowed", "INVALID_ARGUMENT")
+
+    @staticmethod
+    def _apply(task, payload, now):
+        for field in ('title', 'notes', 'status', 'due', 'completed', 'hidden'):
+            if field in payload:
+                task[field] = payload[field]
+        if task.get('due'):
+            # The API stores only the date part of due.
+            task['due'] = _parse_rfc3339(task['due']).strftime('%Y-%m-%dT00:00:00.000Z')
+        task['updated'] = _rfc3339(now)
+        task['etag'] = f'"{uuid.uuid4().hex}"'
+        return task
+
+    # --- ICS feeds -----------------------------------------------------
+
+    def feed(self, events):
+        """The (content, etag) of a generated feed, built once per size."""
+        with self._lock:
+            cached = self._feeds.get(events)
+        if cached is None:
+            content = bench.make_ics(events)
+            cached = (content, f'"{hashlib.sha256(content).hexdigest()[:32]}"')
+            with self._lock:
+                self._feeds[events] = cached
+        return cached
+
+
+class FakeGoogleHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeGoogle/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay(self):
+        latency = self.server.latency_ms + random.uniform(0, self.server.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def _send(self, status, body=b'', content_type='application/json; charset=UTF-8', headers=None):
+        self.server.google.count("statuses", str(status))
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if body:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_json(self, status, payload):
+        self._send(status, json.dumps(payload).encode() if payload is not None else b'')
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _dispatch(self):
+        google = self.server.google
+        google.count("http_requests")
+        body = self._body()
+        path = urlsplit(self.path).path
+        self._delay()
+
+        if path == '/token' and self.command == 'POST':
+            status, payload = google.refresh(parse_qs(body.decode()))
+            return self._send_json(status, payload)
+        if path == '/_stats':
+            with google._lock:
+                return self._send_json(200, json.loads(json.dumps(google.stats)))
+        if path.startswith('/feeds/') and self.command in ('GET', 'HEAD'):
+            return self._feed()
+        if path in ('/batch', '/batch/tasks/v1') and self.command == 'POST':
+            return self._batch(body)
+        if path.startswith('/tasks/v1/'):
+            status, payload = google.api(self.command, self.path, self.headers, body)
+            return self._send_json(status, payload)
+        self._send_json(*_error(404, "notFound", "Not Found", "NOT_FOUND"))
+
+    do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = do_HEAD = _dispatch
+
+    def _feed(self):
+        google = self.server.google
+        query = parse_qs(urlsplit(self.path).query)
+        events = int(query.get('events', [google.ics_events])[0])
+        content, etag = google.feed(events)
+        if self.headers.get('If-None-Match') == etag:
+            google.count("feeds_not_modified")
+            return self._send(304, headers={'ETag': etag})
+        google.count("feeds_served")
+        self._send(200, content, 'text/calendar; charset=utf-8', {'ETag': etag})
+
+    def _batch(self, body):
+        """Runs a multipart/mixed batch the way the Google batch endpoint does."""
+        google = self.server.google
+        google.count("batches")
+        message = BytesParser(policy=HTTP).parsebytes(
+            b'Content-Type: ' + self.headers.get('Content-Type', '').encode() + b'\r\n\r\n' + body
+        )
+        parts = list(message.iter_parts()) if message.is_multipart() else []
+        if not parts or len(parts) > MAX_BATCH_SIZE:
+            return self._send_json(*_error(400, "badRequest", "Invalid batch request", "INVALID_ARGUMENT"))
+
+        boundary = f"batch_{uuid.uuid4().hex}"
+        out = []
+        for part in parts:
+            raw = part.get_payload(decode=True) or part.get_payload().encode()
+            head, _, sub_body = raw.replace(b'\r\n', b'\n').partition(b'\n\n')
+            request_line, *header_lines = head.decode().split('\n')
+            method, target, _ = request_line.split(' ', 2)
+            sub_headers = dict(
+                line.split(':', 1) for line in header_lines if ':' in line
+            )
+            sub_headers = {k.strip(): v.strip() for k, v in sub_headers.items()}
+            status, payload = google.api(method, target, sub_headers, sub_body.strip())
+            google.count("statuses", str(status))
+            content_id = part.get('Content-ID', '')
+            out.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id[1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {status} {self.responses.get(status, ('',))[0]}\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(payload) if payload is not None else ''}\r\n"
+            )
+        out.append(f"--{boundary}--\r\n")
+        self._send(200, "".join(out).encode(), f"multipart/mixed; boundary={boundary}")
+
+
+def make_server(host='127.0.0.1', port=8765, latency_ms=0, jitter_ms=0, **options):
+    """Builds (but does not start) the fake server; options go to FakeGoogle."""
+    server = ThreadingHTTPServer((host, port), FakeGoogleHandler)
+    server.daemon_threads = True
+    server.google = FakeGoogle(**options)
+    server.latency_ms = latency_ms
+    server.jitter_ms = jitter_ms
+    return server
+
+
+def seed_users(db, users, feed_base, events=None):
+    """
+    Writes load-test users to user_auth / user_links: each gets a fake
+    refresh token and a feed on the fake server. Existing load-test users are
+    replaced; nothing else is touched.
+    """
+    from pymongo import UpdateOne
+    from util import encrypt_many
+
+    emails = [f"loadtest-{i}@example.invalid" for i in range(users)]
+    query = f"?events={events}" if events else ""
+    refresh_tokens = encrypt_many([f"fake-refresh-{i}" for i in range(users)])
+    ics_urls = encrypt_many([f"{feed_base.rstrip('/')}/feeds/user-{i}.ics{query}" for i in range(users)])
+    now = datetime.now()
+    for start in range(0, users, 1000):
+        chunk = range(start, min(start + 1000, users))
+        db.user_auth.bulk_write([UpdateOne(
+            {"email": emails[i]},
+            {"$set": {"email": emails[i], "refresh_token": refresh_tokens[i], "last_updated": now},
+             "$unset": {"tasks_state": "", "last_sync": ""}},
+            upsert=True,
+        ) for i in chunk], ordered=False)
+        db.user_links.bulk_write([UpdateOne(
+            {"email": emails[i]},
+            {"$set": {"email": emails[i], "ics_url": ics_urls[i], "updated_at": now},
+             "$unset": {"ics_feed": ""}},
+            upsert=True,
+        ) for i in chunk], ordered=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local fake of Google Tasks, OAuth and ICS feeds.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="Run the fake server")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--latency-ms", type=float, default=0, help="Added to every HTTP request")
+    serve.add_argument("--jitter-ms", type=float, default=0, help="Random extra latency, up to this")
+    serve.add_argument("--error-rate-429", type=float, default=0.0,
+                       help="Fraction of API calls failed with 429 rateLimitExceeded")
+    serve.add_argument("--error-rate-403", type=float, default=0.0,
+                       help="Fraction of API calls failed with 403 rateLimitExceeded")
+    serve.add_argument("--user-quota-per-minute", type=int, default=0,
+                       help="API calls per user per minute before 403 userRateLimitExceeded (0: off)")
+    serve.add_argument("--global-quota-per-minute", type=int, default=0,
+                       help="API calls per minute across users before 429 (0: off)")
+    serve.add_argument("--ics-events", type=int, default=200, help="Events per served feed")
+
+    seed = commands.add_parser("seed", help="Write load-test users to a scratch database")
+    seed.add_argument("--mongo-uri", required=True)
+    seed.add_argument("--db", required=True, help="Database name; never point this at production")
+    seed.add_argument("--users", type=int, default=1000)
+    seed.add_argument("--feed-base", default="http://127.0.0.1:8765")
+    seed.add_argument("--ics-events", type=int, help="Per-feed event count (default: the server's)")
+
+    args = parser.parse_args(argv)
+    if args.command == "seed":
+        from pymongo.mongo_client import MongoClient
+        seed_users(MongoClient(args.mongo_uri)[args.db], args.users, args.feed_base, args.ics_events)
+        print(f"Seeded {args.users} users into {args.db}")
+        return
+
+    server = make_server(
+        args.host, args.port, args.latency_ms, args.jitter_ms,
+        error_rate_429=args.error_rate_429,
+        error_rate_403=args.error_rate_403,
+        user_quota_per_minute=args.user_quota_per_minute,
+        global_quota_per_minute=args.global_quota_per_minute,
+        ics_events=args.ics_events,
+    )
+    print(f"Fake Google listening on http://{args.host}:{server.server_port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
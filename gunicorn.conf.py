@@ -0,0 +1,10 @@
+# Loaded automatically by gunicorn (see Procfile).
+import os
+
+
+def child_exit(server, worker):
+    # Drop an exited worker's live gauges from the multiprocess metrics
+    # directory (see metrics.py).
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
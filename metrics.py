@@ -0,0 +1,136 @@
+"""
+Prometheus metrics shared by the web app and the batch sync scripts.
+
+The web app serves them at /metrics, to requests bearing METRICS_TOKEN
+(without one set, not at all). Under gunicorn, set PROMETHEUS_MULTIPROC_DIR
+to an empty, writable directory so the samples of every worker are
+aggregated (gunicorn.conf.py cleans up after exited workers).
+sync_worker.py, which runs the web app's sync jobs, serves its own on a port
+of its own (serve()). The batch scripts call export() when a run ends, which
+pushes to PROMETHEUS_PUSHGATEWAY and/or writes METRICS_TEXTFILE (for
+node_exporter's textfile collector or a CI artifact).
+"""
+import os
+import logging
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, push_to_gateway, write_to_textfile, start_http_server,
+)
+from prometheus_client import multiprocess
+
+logger = logging.getLogger("metrics")
+
+_SECONDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+_BYTES = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)
+_EVENTS = (0, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+ICS_FETCH_SECONDS = Histogram(
+    "ctt_ics_fetch_seconds",
+    "Time spent on the network fetching an ICS feed (request plus body reads).",
+    ["outcome"], buckets=_SECONDS,
+)
+ICS_FETCH_BYTES = Histogram(
+    "ctt_ics_fetch_bytes", "Size of downloaded ICS feeds.", buckets=_BYTES,
+)
+ICS_PARSE_SECONDS = Histogram(
+    "ctt_ics_parse_seconds", "CPU time parsing an ICS feed into events.", buckets=_SECONDS,
+)
+ICS_EVENTS = Histogram(
+    "ctt_ics_events", "Events per parsed ICS feed.", buckets=_EVENTS,
+)
+GOOGLE_API_CALLS = Counter(
+    "ctt_google_api_calls_total",
+    "Google Tasks API calls by method and HTTP status; batched calls count individually.",
+    ["method", "status"],
+)
+GOOGLE_API_SECONDS = Histogram(
+    "ctt_google_api_call_seconds",
+    "Round-trip time of Google Tasks API HTTP requests ('batch' for a whole batch).",
+    ["method"], buckets=_SECONDS,
+)
+GOOGLE_BACKOFF_SECONDS = Counter(
+    "ctt_google_backoff_seconds_total", "Time slept backing off after Google rate-limit errors.",
+)
+GOOGLE_RATE_LIMIT_WAIT_SECONDS = Counter(
+    "ctt_google_rate_limit_wait_seconds_total",
+    "Time spent waiting on the shared Google call budget.",
+)
+TOKEN_REFRESHES = Counter(
+    "ctt_token_refreshes_total",
+    "OAuth access-token refreshes ('shared': reused another sync's concurrent refresh).", ["outcome"],
+)
+SYNC_USER_SECONDS = Histogram(
+    "ctt_sync_user_seconds", "Wall-clock time to sync one user.",
+    ["source", "status"], buckets=_SECONDS,
+)
+SYNC_JOB_WAIT_SECONDS = Histogram(
+    "ctt_sync_job_wait_seconds", "Time web sync jobs wait in the queue before a worker starts them.",
+    buckets=_SECONDS,
+)
+SYNC_STAGE_QUEUE_DEPTH = Gauge(
+    "ctt_sync_stage_queue_depth", "Users waiting for a bulk sync pipeline stage.",
+    ["stage"], multiprocess_mode="livesum",
+)
+SYNC_STAGE_WORKERS = Gauge(
+    "ctt_sync_stage_workers", "Workers of a bulk sync pipeline stage.",
+    ["stage"], multiprocess_mode="livesum",
+)
+SYNC_STAGE_BUSY_SECONDS = Counter(
+    "ctt_sync_stage_busy_seconds_total",
+    "Time a bulk sync pipeline stage's workers spent working; divide its rate by the workers for utilization.",
+    ["stage"],
+)
+
+
+def registry():
+    """The registry to collect from: every worker's samples in multiprocess mode."""
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        return REGISTRY
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected)
+    return collected
+
+
+def render():
+    """(body, content_type) for a /metrics response."""
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def serve(port, addr="0.0.0.0"):
+    """
+    Serves the metrics over HTTP from a background thread, for a long-running
+    process other than the web app. Failures are logged, not raised.
+    """
+    try:
+        start_http_server(port, addr=addr, registry=registry())
+    except OSError as e:
+        logger.error(f"Failed to serve metrics on {addr}:{port}: {e}")
+        return
+    logger.info(f"Serving metrics on {addr}:{port}")
+
+
+def export(job, instance=None):
+    """
+    Publishes the metrics of a finished batch run: pushed to the Pushgateway
+    under the given job name and/or written to METRICS_TEXTFILE. Does nothing
+    when neither is configured; failures are logged, not raised.
+
+    Shards of one run pass their shard as instance, so they are pushed under
+    separate groups and written to separate files (sync-metrics-2.prom).
+    """
+    pushgateway = os.getenv("PROMETHEUS_PUSHGATEWAY")
+    textfile = os.getenv("METRICS_TEXTFILE")
+    grouping_key = {"instance": instance} if instance else None
+    if textfile and instance:
+        root, ext = os.path.splitext(textfile)
+        textfile = f"{root}-{instance}{ext}"
+    if pushgateway:
+        try:
+            push_to_gateway(pushgateway, job=job, registry=registry(), grouping_key=grouping_key)
+        except Exception as e:
+            logger.error(f"Failed to push metrics to {pushgateway}: {e}")
+    if textfile:
+        try:
+            write_to_textfile(textfile, registry())
+        except Exception as e:
+            logger.error(f"Failed to write metrics to {textfile}: {e}")
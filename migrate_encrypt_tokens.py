@@ -1,6 +1,7 @@
 """
 One-time migration: encrypt existing plaintext secrets at rest:
   - user_auth.refresh_token  (Google OAuth refresh tokens)
+  - user_auth.access_token   (the latest short-lived Google access tokens)
   - user_links.ics_url       (Canvas feed URLs, which embed a bearer token)
 
 The app encrypts these on write (see util.encrypt_token), but rows written
@@ -20,51 +21,56 @@ Usage:
 """
 import os
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from util import encrypt_token, decrypt_token, _get_fernet
+from pymongo import MongoClient, UpdateOne
+from util import encrypt_many, decrypt_many, _get_fernet
 
 load_dotenv()
 
 MONGO_URI = os.getenv("MONGO_URI")
 MONGO_DB_NAME = os.getenv("MONGO_DB_NAME")
 
+# Rows are decrypted / encrypted / written back this many at a time.
+BATCH_SIZE = 500
 
-def _is_encrypted(value):
-    """True if value already decrypts under the current key (i.e. encrypted)."""
-    fernet = _get_fernet()
-    if fernet is None or value is None:
-        return False
-    try:
-        fernet.decrypt(value.encode())
-        return True
-    except Exception:
-        return False
 
+def _encrypt_batch(collection, docs, field, stats):
+    """Encrypt the plaintext values in one batch of docs and write them back."""
+    values = [doc.get(field) for doc in docs]
+    # A value is already encrypted iff it decrypts to something else under
+    # the current key; legacy plaintext passes through decrypt unchanged.
+    plain = [doc for doc, value, dec in zip(docs, values, decrypt_many(values)) if dec == value]
+    stats['already'] += len(docs) - len(plain)
 
-def _encrypt_field(collection, field):
-    """Encrypt a single string field across every doc in a collection."""
-    scanned = encrypted_now = already = skipped = 0
-    for doc in collection.find({field: {"$exists": True, "$ne": None}}):
-        scanned += 1
-        value = doc.get(field)
-
-        if _is_encrypted(value):
-            already += 1
-            continue
-
-        ciphertext = encrypt_token(value)
+    ciphertexts = encrypt_many([doc.get(field) for doc in plain])
+    ops = []
+    for doc, ciphertext, roundtrip in zip(plain, ciphertexts, decrypt_many(ciphertexts)):
         # Safety: never write a value we can't read back to the original.
-        if decrypt_token(ciphertext) != value:
+        if roundtrip != doc.get(field):
             print(f"  ! round-trip check failed for {doc.get('email')!r}; skipping")
-            skipped += 1
+            stats['skipped'] += 1
             continue
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {field: ciphertext}}))
+    if ops:
+        collection.bulk_write(ops, ordered=False)
+    stats['encrypted_now'] += len(ops)
+
 
-        collection.update_one({"_id": doc["_id"]}, {"$set": {field: ciphertext}})
-        encrypted_now += 1
+def _encrypt_field(collection, field):
+    """Encrypt a single string field across every doc in a collection."""
+    stats = {'scanned': 0, 'encrypted_now': 0, 'already': 0, 'skipped': 0}
+    batch = []
+    for doc in collection.find({field: {"$exists": True, "$ne": None}}, {field: 1, "email": 1}):
+        stats['scanned'] += 1
+        batch.append(doc)
+        if len(batch) >= BATCH_SIZE:
+            _encrypt_batch(collection, batch, field, stats)
+            batch = []
+    if batch:
+        _encrypt_batch(collection, batch, field, stats)
 
     print(
-        f"{collection.name}.{field}: scanned={scanned} encrypted_now={encrypted_now} "
-        f"already_encrypted={already} skipped={skipped}"
+        f"{collection.name}.{field}: scanned={stats['scanned']} encrypted_now={stats['encrypted_now']} "
+        f"already_encrypted={stats['already']} skipped={stats['skipped']}"
     )
 
 
@@ -81,6 +87,7 @@ def main():
     db = client[MONGO_DB_NAME]
 
     _encrypt_field(db.user_auth, "refresh_token")
+    _encrypt_field(db.user_auth, "access_token")
     _encrypt_field(db.user_links, "ics_url")
 
 
@@ -1,13 +1,15 @@
+import sys
 import time
+import argparse
 import logging
-from ratelimit import limits, sleep_and_retry
+import subprocess
 from pymongo.mongo_client import MongoClient
-from datetime import datetime
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
 import os
 from dotenv import load_dotenv
-from util import get_ics_events, sync_with_tasklist, decrypt_token
+from util import fetch_ics_events, feed_after_sync, sync_counts, sync_with_tasklist, upcoming_deadlines, decrypt_many, ensure_fresh_token, access_token_fields, TokenBucket, SyncTrace, set_google_rate_limiter
+from sync_store import iter_sync_users, SyncLedger, SyncLeases, SharedRateLimiter, GOOGLE_API_CALLS_PER_MINUTE
+from sync_pipeline import SyncPipeline
+import metrics
 
 # Silence all logging (including from util.py) for the one-time sync run.
 logging.disable(logging.CRITICAL)
@@ -22,14 +24,25 @@ app_config = {
     "FLASK_PORT": int(os.getenv("FLASK_PORT", 3000)),
     "MONGO_URI": os.getenv("MONGO_URI"),
     "MONGO_DB_NAME": os.getenv("MONGO_DB_NAME"),
+    # Number of users synced to Google concurrently.
+    "SYNC_WORKERS": int(os.getenv("SYNC_WORKERS", 8)),
+    # Set to split the run across shards: every process started with the
+    # same SYNC_RUN_ID leases users from one shared pool (see --processes).
+    "SYNC_RUN_ID": os.getenv("SYNC_RUN_ID"),
+    # This shard's label in leases and exported metrics.
+    "SYNC_SHARD": os.getenv("SYNC_SHARD"),
 }
 
 # Full MongoDB connection string from the environment (set in CI secrets).
 MONGO_URI = app_config['MONGO_URI']
 
-# Rate limiting constants
-GOOGLE_API_CALLS_PER_MINUTE = 300  # Google Tasks API quota
-ICS_FETCH_CALLS_PER_MINUTE = 30    # Be gentle with ICS endpoints
+# Rate limiting constants. These are global across all worker threads; Google
+# calls are paced per call by the shared limiter (GOOGLE_API_CALLS_PER_MINUTE).
+ICS_FETCH_CALLS_PER_MINUTE = int(os.getenv("ICS_FETCH_CALLS_PER_MINUTE", 600))    # Be gentle with ICS endpoints
+# Users whose feeds are downloaded together (see sync_pipeline).
+SYNC_PREFETCH_BATCH = int(os.getenv("SYNC_PREFETCH_BATCH", 200))
+
+ics_bucket = TokenBucket(ICS_FETCH_CALLS_PER_MINUTE)
 
 
 def connect_to_mongodb():
@@ -45,62 +58,95 @@ def connect_to_mongodb():
         return None
 
 
-@sleep_and_retry
-@limits(calls=GOOGLE_API_CALLS_PER_MINUTE, period=60)
-def refresh_user_tokens(user_auth):
-    """Refresh the access token using the refresh token"""
-    try:
-        # Build the credentials object
-        creds = Credentials(
-            token=None,  # We don't have a valid token
-            refresh_token=decrypt_token(user_auth.get('refresh_token')),
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=app_config['OAUTH_CLIENT_ID'],
-            client_secret=app_config['OAUTH_CLIENT_SECRET'],
-            scopes=["https://www.googleapis.com/auth/tasks"]
-        )
-        
-        # Request a new token
-        creds.refresh(Request())
-        
-        # Return the refreshed credentials
-        return {
-            "access_token": creds.token,
-            "refresh_token": creds.refresh_token,
-            "client_id": user_auth.get('client_id'),
-            "client_secret": user_auth.get('client_secret'),
-        }
-    except Exception:
+def refresh_user_tokens(user_auth, refresh_token, access_token=None):
+    """
+    The user's OAuth token from their (decrypted) refresh and saved access
+    tokens. The access token is reused unless it is about to expire, else
+    refreshed (see util.ensure_fresh_token). None if the refresh failed.
+    """
+    oauth_token = {
+        "access_token": access_token,
+        "expires_at": user_auth.get('access_token_expires_at'),
+        "refresh_token": refresh_token,
+        "client_id": user_auth.get('client_id') or app_config['OAUTH_CLIENT_ID'],
+        "client_secret": user_auth.get('client_secret') or app_config['OAUTH_CLIENT_SECRET'],
+    }
+    if not ensure_fresh_token(oauth_token):
         return None
-
-
-@sleep_and_retry
-@limits(calls=ICS_FETCH_CALLS_PER_MINUTE, period=60)
-def sync_task_for_user(user_auth, user_link):
-    """Sync tasks for a specific user"""
+    return oauth_token
+
+
+def sync_task_for_user(user_auth, user_link, trace=None, prefetched=None):
+    """
+    Sync tasks for a specific user, recording stage timings in trace (a
+    util.SyncTrace) if given, from their prefetched feed (see
+    sync_pipeline) if given. Returns a dict with 'success', plus the
+    'ics_feed' state to save (see util.fetch_ics_events), the Google sync
+    'counts' and 'tasks_state', the feed's upcoming 'deadlines', and 'error'
+    (a short error class) on failure.
+    """
+    trace = trace if trace is not None else SyncTrace()
     try:
-        ics_url = decrypt_token(user_link.get('ics_url'))
+        with trace.stage('decrypt'):
+            ics_url, refresh_token, access_token = decrypt_many(
+                [user_link.get('ics_url'), user_auth.get('refresh_token'), user_auth.get('access_token')]
+            )
 
         if not ics_url:
-            return False
+            return {"success": False, "error": "NoIcsUrl"}
+
+        # Get calendar events, unless the feed is unchanged since the last
+        # clean sync (304, or same content fingerprint). An unchanged feed
+        # skips the token refresh and every Google call.
+        if prefetched is None:
+            with trace.stage('throttle'):
+                ics_bucket.acquire()
+        events, feed = fetch_ics_events(ics_url, user_link.get('ics_feed'), trace, prefetched)
+        if events is None:
+            return {"success": True, "not_modified": True, "ics_feed": feed}
+        if not events:
+            return {"success": False, "error": "NoEvents"}
 
         # Refresh the user's tokens
-        oauth_token = refresh_user_tokens(user_auth)
+        with trace.stage('token_refresh'):
+            oauth_token = refresh_user_tokens(user_auth, refresh_token, access_token)
         if not oauth_token:
-            return False
-
-        # Get calendar events
-        events = get_ics_events(ics_url)
-        if not events:
-            return False
+            return {"success": False, "error": "TokenRefreshFailed"}
 
         # Sync with Google Tasks - don't include past events
-        result = sync_with_tasklist(oauth_token, events, include_past_events=False)
+        result = sync_with_tasklist(
+            oauth_token, events, include_past_events=False,
+            state=user_auth.get('tasks_state'), trace=trace,
+        )
+        # Save the access token if it was refreshed, before or during the
+        # sync, for the next syncs to reuse.
+        token_fields = access_token_fields(oauth_token) if oauth_token['access_token'] != access_token else None
 
-        return bool(result.get('success'))
+        if not result.get('success'):
+            return {"success": False, "error": result.get('error_class', 'SyncFailed'), "token_fields": token_fields}
+        return {
+            "success": True,
+            "counts": sync_counts(result),
+            "ics_feed": feed_after_sync(feed, result),
+            "tasks_state": result.get('tasks_state'),
+            "deadlines": upcoming_deadlines(events),
+            "token_fields": token_fields,
+        }
 
-    except Exception:
-        return False
+    except Exception as e:
+        return {"success": False, "error": type(e).__name__}
+
+
+def timed_sync_task_for_user(user_auth, user_link, prefetched=None):
+    """
+    sync_task_for_user, also returning how long it took in seconds and its
+    SyncTrace (profiled if the user is listed in SYNC_PROFILE_USERS).
+    """
+    trace = SyncTrace(user_auth.get('email'))
+    started = time.monotonic()
+    with trace.profiling():
+        result = sync_task_for_user(user_auth, user_link, trace, prefetched)
+    return result, time.monotonic() - started, trace
 
 
 def run_one_time_sync():
@@ -109,55 +155,95 @@ def run_one_time_sync():
     if db is None:
         print("Cannot connect to database. Aborting sync.")
         return
+    set_google_rate_limiter(SharedRateLimiter(db, "google_tasks", GOOGLE_API_CALLS_PER_MINUTE))
 
-    # Get all users with auth information and ics links
+    # Stream syncable users (auth joined to calendar link server-side), or
+    # lease them from the pool shared by the run's shards.
+    leases = None
     try:
-        users_auth = list(db.user_auth.find())
-        users_links = list(db.user_links.find())
-
-        # Create a map of email to ics_url for quick lookup
-        links_map = {user['email']: user for user in users_links}
-
-        total_users = len(users_auth)
-        if total_users == 0:
-            print("No users found to sync.")
-            return
-
-        print(f"Found {total_users} users to process")
+        workers = max(1, app_config['SYNC_WORKERS'])
+        fetch_batch = SYNC_PREFETCH_BATCH
+        if app_config['SYNC_RUN_ID']:
+            shard = app_config['SYNC_SHARD']
+            owner = f"shard-{shard}:{os.getpid()}" if shard else None
+            leases = SyncLeases(db, app_config['SYNC_RUN_ID'], owner=owner)
+            users = leases
+            # Pull one lease's worth at a time, so leases are claimed as the
+            # pipeline has room rather than a whole prefetch batch ahead.
+            fetch_batch = min(fetch_batch, leases.batch_size)
+            print(f"Syncing users with {workers} workers as {leases.owner} of run {leases.run_id}")
+        else:
+            users = iter_sync_users(db)
+            print(f"Syncing users with {workers} workers")
 
         sync_count = 0
         failed_count = 0
-
-        for index, user_auth in enumerate(users_auth, start=1):
-            print(f"Processing user {index}/{total_users}")
-            email = user_auth.get('email')
-            user_link = links_map.get(email)
-
-            if user_link:
-                success = sync_task_for_user(user_auth, user_link)
-                if success:
+        processed = 0
+        started = time.monotonic()
+
+        # Feeds are downloaded a batch at a time, parsed in other processes
+        # and synced by the workers; the stages' bounded queues keep users
+        # being pulled from the cursor only as fast as they are synced.
+        # Results are handled here on the main thread so the counters need
+        # no locking; the ledger batches the DB writes.
+        with SyncLedger(db, source="one_time_sync") as ledger, \
+                SyncPipeline(timed_sync_task_for_user, workers, fetch_batch, ics_bucket) as pipeline:
+            for user_auth, user_link, (result, duration, trace) in pipeline.run(users):
+                processed += 1
+                print(f"Processed user {processed}")
+                ledger.record(user_link, result, duration, trace, user_auth=user_auth)
+                if leases is not None:
+                    leases.finished(user_link)
+                if result.get('success'):
                     sync_count += 1
-
-                    # Update last_sync timestamp in database
-                    db.user_auth.update_one(
-                        {"email": email},
-                        {"$set": {"last_sync": datetime.now()}}
-                    )
                 else:
                     failed_count += 1
 
-                # Add a small delay between users to avoid overwhelming APIs
-                time.sleep(1)
-            else:
-                failed_count += 1
+        if processed == 0:
+            print("No users found to sync.")
+            return
 
+        elapsed = time.monotonic() - started
         print(f"Successfully synced: {sync_count} users")
         print(f"Failed to sync: {failed_count} users")
-        print(f"Total users processed: {total_users}")
+        print(f"Total users processed: {processed}")
+        print(f"Elapsed: {elapsed:.1f}s ({processed / elapsed if elapsed else 0:.2f} users/sec)")
+        print(f"Stages: {pipeline.summary()}")
+        if leases is not None:
+            print(f"Leases: {leases.claimed} claimed, {leases.taken_over} taken over from expired shards")
 
     except Exception:
         print("Error during one-time sync.")
+    finally:
+        if leases is not None:
+            leases.close()
+
+
+def run_local_shards(processes):
+    """
+    Runs the sync as several local processes sharing one SYNC_RUN_ID (a new
+    one unless set). Returns the worst exit code.
+    """
+    run_id = app_config['SYNC_RUN_ID'] or f"local-{int(time.time())}-{os.getpid()}"
+    print(f"Starting {processes} shards for run {run_id}")
+    children = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            env=dict(os.environ, SYNC_RUN_ID=run_id, SYNC_SHARD=str(shard)),
+        )
+        for shard in range(processes)
+    ]
+    return max(child.wait() for child in children)
 
 
 if __name__ == "__main__":
-    run_one_time_sync()
+    parser = argparse.ArgumentParser(description="Sync every user once.")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Split the run across this many local shard processes")
+    args = parser.parse_args()
+    if args.processes > 1:
+        sys.exit(run_local_shards(args.processes))
+    try:
+        run_one_time_sync()
+    finally:
+        metrics.export("one_time_sync", app_config['SYNC_SHARD'])
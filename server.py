@@ -1,9 +1,13 @@
-from flask import Flask, redirect, render_template, session, url_for, request, flash, g
+from flask import Flask, Response, abort, redirect, render_template, session, url_for, request, flash, g
 from authlib.integrations.flask_client import OAuth
 import json
 import logging
 import secrets
-from util import get_ics_events, sync_with_tasklist, encrypt_token, decrypt_token, revoke_google_token
+import time
+import metrics
+from util import get_ics_events, sync_with_tasklist, encrypt_token, decrypt_token, revoke_google_token, set_google_rate_limiter, access_token_fields
+from sync_store import SharedRateLimiter, GOOGLE_API_CALLS_PER_MINUTE, enqueue_sync_job, get_sync_job
+from sync_worker import start_job_threads
 from datetime import datetime
 import os
 from pymongo.mongo_client import MongoClient
@@ -30,6 +34,30 @@ app_config = {
     # username, and password out of source — they live only in the env.
     "MONGO_URI": os.getenv("MONGO_URI"),
     "MONGO_DB_NAME": os.getenv("MONGO_DB_NAME"),
+    # Bearer token required to read /metrics; unset, /metrics is not served.
+    "METRICS_TOKEN": os.getenv("METRICS_TOKEN"),
+    # Sync jobs run in background threads of each web process. Off by
+    # default: gunicorn would start them in every worker, and the Procfile
+    # already runs sync_worker.py for them.
+    "SYNC_JOB_THREADS": int(os.getenv("SYNC_WEB_JOB_THREADS", 0)),
+}
+
+# What the sync status page says while a job runs, by the last stage it
+# finished (see sync_worker.JOB_STAGES).
+SYNC_STAGE_MESSAGES = {
+    None: "Fetching your Canvas calendar...",
+    'fetch': "Reading your calendar events...",
+    'parse': "Checking your Google Tasks...",
+    'list': "Working out what changed...",
+    'diff': "Writing tasks to Google Tasks...",
+    'writes': "Finishing up...",
+}
+# What a failed job tells the user, by its error; anything else gets the
+# generic sync failure message.
+SYNC_JOB_ERRORS = {
+    'NoEvents': ('No events found in the provided Canvas ICS file', 'warning'),
+    'UnsafeURL': ('That calendar URL is not allowed. Please use the ICS link from Canvas.', 'error'),
+    'FetchFailed': ('Something went wrong while processing your calendar. Please try again later.', 'error'),
 }
 
 app = Flask(__name__)
@@ -65,6 +93,13 @@ else:
         # Set the database
         db = mongo_client[mongo_db_name]
 
+        # Web syncs draw on the same Google call budget as the batch syncs.
+        set_google_rate_limiter(SharedRateLimiter(db, "google_tasks", GOOGLE_API_CALLS_PER_MINUTE))
+
+        # Run queued /sync_calendar jobs in the background of this process.
+        if app_config['SYNC_JOB_THREADS'] > 0:
+            start_job_threads(db, app_config['SYNC_JOB_THREADS'])
+
         # Log database connection status
         if os.getenv("FLASK_ENV") == "development":
             db_list = mongo_client.list_database_names()
@@ -242,6 +277,9 @@ def auth():
             # Encrypt it at rest so a DB compromise doesn't expose usable creds.
             if token.get('refresh_token'):
                 update_data["refresh_token"] = encrypt_token(token.get('refresh_token'))
+            # The fresh access token (encrypted) spares the next sync a refresh.
+            if token.get('access_token'):
+                update_data.update(access_token_fields(token))
             
             # Store OAuth token information in the database
             db.user_auth.update_one(
@@ -292,6 +330,8 @@ def disconnect():
         try:
             db.user_auth.delete_one({"email": user_email})
             db.user_links.delete_one({"email": user_email})
+            db.sync_ledger.delete_many({"email": user_email})
+            db.sync_jobs.delete_many({"email": user_email})
         except Exception as e:
             logger.error(f"MongoDB error during disconnect: {e}")
             flash(GENERIC_DB_ERROR, 'error')
@@ -346,7 +386,47 @@ def sync_calendar():
     if not ics_url:
         flash('Please provide your Canvas ICS URL', 'error')
         return render_template('import_ics.html')
-        
+
+    user_email = session.get('user', {}).get('userinfo', {}).get('email')
+    if db is None or not user_email:
+        # No job queue without the database; sync within the request.
+        return _sync_calendar_now(ics_url)
+
+    try:
+        # Save or update the ICS URL in the database
+        encrypted_url = encrypt_token(ics_url)
+        db.user_links.update_one(
+            {"email": user_email},
+            {"$set": {
+                "email": user_email,
+                # Encrypt at rest — the feed URL embeds a bearer token.
+                "ics_url": encrypted_url,
+                "updated_at": datetime.now()
+            },
+            # Saved feed state belongs to the previous link; the
+            # next background run does a full fetch and sync.
+            "$unset": {"ics_feed": ""}},
+            upsert=True
+        )
+        # Make the user due for the background scheduler right away.
+        db.user_auth.update_one({"email": user_email}, {"$unset": {"next_sync_at": ""}})
+        logger.info("ICS URL saved successfully")
+
+        # The fetch and sync run in a worker (sync_worker.py); the user
+        # watches the job's progress on the status page.
+        token = {key: session['user'].get(key) for key in
+                 ('access_token', 'refresh_token', 'client_id', 'client_secret', 'expires_at')}
+        job_id = enqueue_sync_job(db, user_email, encrypted_url, encrypt_token(json.dumps(token)))
+    except Exception as e:
+        flash(GENERIC_DB_ERROR, 'error')
+        logger.error(f"MongoDB error: {e}")
+        return render_template('import_ics.html', saved_link=ics_url)
+
+    return redirect(url_for('sync_status', job_id=job_id))
+
+
+def _sync_calendar_now(ics_url):
+    """The whole sync within the request, for when there is no job queue."""
     try:
         # Get events from ICS URL
         events = get_ics_events(ics_url)
@@ -354,28 +434,13 @@ def sync_calendar():
         if not events:
             flash('No events found in the provided Canvas ICS file', 'warning')
             return render_template('import_ics.html')
-        
-        # Save or update the ICS URL in the database
-        user_email = session.get('user', {}).get('userinfo', {}).get('email')
-        if user_email and db is not None:  # Fixed: proper check for database object
-            try:
-                db.user_links.update_one(
-                    {"email": user_email},
-                    {"$set": {
-                        "email": user_email,
-                        # Encrypt at rest — the feed URL embeds a bearer token.
-                        "ics_url": encrypt_token(ics_url),
-                        "updated_at": datetime.now()
-                    }},
-                    upsert=True
-                )
-                logger.info("ICS URL saved successfully")
-            except Exception as e:
-                flash(GENERIC_DB_ERROR, 'error')
-                logger.error(f"MongoDB error: {e}")
             
         # Always exclude past events by passing False
+        started = time.monotonic()
         result = sync_with_tasklist(session['user'], events, False)
+        metrics.SYNC_USER_SECONDS.labels("web", "synced" if result['success'] else "failed").observe(
+            time.monotonic() - started
+        )
         
         if result['success']:
             return render_template('import_success.html',
@@ -393,6 +458,78 @@ def sync_calendar():
         flash('Something went wrong while processing your calendar. Please try again later.', 'error')
         return render_template('import_ics.html')
 
+
+def _find_sync_job(job_id):
+    """The logged-in user's sync job, or None."""
+    user_email = session.get('user', {}).get('userinfo', {}).get('email')
+    if not user_email or db is None:
+        return None
+    try:
+        return get_sync_job(db, job_id, user_email)
+    except Exception as e:
+        logger.error(f"MongoDB error reading sync job: {e}")
+        return None
+
+
+def _sync_job_message(job):
+    if job['status'] == 'queued':
+        return "Waiting for a free worker..."
+    return SYNC_STAGE_MESSAGES.get(job.get('stage'), SYNC_STAGE_MESSAGES[None])
+
+
+@app.route('/sync_status/<job_id>')
+def sync_status(job_id):
+    if not session.get('user'):
+        flash('Please log in to sync Canvas calendar events', 'error')
+        return redirect(url_for('home'))
+
+    job = _find_sync_job(job_id)
+    if job is None:
+        flash('That sync could not be found. Please try again.', 'error')
+        return redirect(url_for('import_ics'))
+
+    if job['status'] == 'done':
+        return render_template('import_success.html',
+                               tasklist_title=job.get('tasklist_title'),
+                               task_count=job.get('task_count', 0),
+                               updated_count=job.get('updated_count', 0),
+                               is_sync=True)
+    if job['status'] == 'failed':
+        logger.error(f"Sync job {job_id} failed: {job.get('error')}")
+        message, category = SYNC_JOB_ERRORS.get(
+            job.get('error'), ('We could not sync your calendar tasks. Please try again later.', 'error')
+        )
+        flash(message, category)
+        return redirect(url_for('import_ics'))
+
+    return render_template('sync_status.html', job_id=job_id, message=_sync_job_message(job))
+
+
+@app.route('/sync_status/<job_id>/progress')
+def sync_status_progress(job_id):
+    """Polled by the status page: the job's status and what it is doing."""
+    if not session.get('user'):
+        abort(401)
+    job = _find_sync_job(job_id)
+    if job is None:
+        abort(404)
+    return {"status": job['status'], "message": _sync_job_message(job)}
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    token = app_config['METRICS_TOKEN']
+    # The app is public; without a token to check, act as if there were no
+    # metrics endpoint at all.
+    if not token:
+        abort(404)
+    if not secrets.compare_digest(
+        request.headers.get('Authorization', ''), f"Bearer {token}"
+    ):
+        abort(401)
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
 @app.route('/privacy-policy')
 def privacy_policy():
     return render_template('privacy_policy.html')
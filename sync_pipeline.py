@@ -0,0 +1,282 @@
+"""
+Staged bulk sync, used by one_time_sync.py and background_sync.py. Users
+flow through three stages joined by bounded queues:
+
+    fetch  downloads a batch of feeds at once, passing each on as soon as
+           it arrives (util.iter_prefetched_ics_feeds)
+    parse  fingerprints and parses them in a process pool, so big feeds
+           don't hold the GIL the network work needs (util.parse_prefetched)
+    write  syncs each user to Google Tasks on a pool of threads
+
+A full queue blocks the stage feeding it, so a slow stage throttles the
+ones upstream instead of downloaded feeds piling up in memory; a blocked
+fetch stage stops starting downloads. Each stage
+reports its queue depth and busy time (see metrics.SYNC_STAGE_*).
+"""
+import os
+import time
+import queue
+import logging
+import threading
+import contextlib
+import multiprocessing
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from util import iter_prefetched_ics_feeds, parse_prefetched, decrypt_many
+import metrics
+
+logger = logging.getLogger("sync_pipeline")
+
+# Processes parsing feeds; 0 parses on the pipeline's own threads instead.
+SYNC_PARSE_PROCESSES = int(os.getenv("SYNC_PARSE_PROCESSES", min(4, os.cpu_count() or 1)))
+# Users waiting between two stages before the stage feeding them blocks.
+SYNC_STAGE_QUEUE_SIZE = int(os.getenv("SYNC_STAGE_QUEUE_SIZE", 32))
+
+STAGES = ('fetch', 'parse', 'write')
+
+# Marks the end of a stage's input.
+_DONE = object()
+
+
+class _StageQueue(queue.Queue):
+    """A bounded queue feeding a stage, reporting its depth."""
+
+    def __init__(self, stage, maxsize):
+        super().__init__(maxsize)
+        self.max_depth = 0
+        self._depth = metrics.SYNC_STAGE_QUEUE_DEPTH.labels(stage)
+
+    # Called by put() / get() with the queue's lock held.
+    def _put(self, item):
+        super()._put(item)
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self._depth.set(len(self.queue))
+
+    def _get(self):
+        item = super()._get()
+        self._depth.set(len(self.queue))
+        return item
+
+
+class SyncPipeline:
+    """
+    Runs sync(user_auth, user_link, prefetched) for a stream of users
+    through the fetch, parse and write stages; prefetched is the user's
+    parsed feed, for sync to pass on to util.fetch_ics_events.
+
+    sync runs on the write stage's threads, so a trace it profiles (see
+    util.SyncTrace.profiling) covers the writes only. The fetch and parse
+    stages serve many users at once; their per-user times reach sync
+    through prefetched instead.
+
+    Use it as a context manager: the parse processes live until exit, so
+    one pipeline can serve many runs (the scheduler's passes).
+    """
+
+    def __init__(self, sync, writers, fetch_batch=200, bucket=None,
+                 parsers=SYNC_PARSE_PROCESSES, queue_size=SYNC_STAGE_QUEUE_SIZE):
+        self.sync = sync
+        self.fetch_batch = max(1, fetch_batch)
+        self.bucket = bucket
+        self.queue_size = max(1, queue_size)
+        self.workers = {'fetch': 1, 'parse': max(1, parsers), 'write': max(1, writers)}
+        self.busy = dict.fromkeys(STAGES, 0.0)
+        self.max_depth = dict.fromkeys(STAGES[1:], 0)
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+        # Spawned, not forked: the parent has the Mongo client's and the
+        # other stages' threads running.
+        self._pool = ProcessPoolExecutor(
+            max_workers=parsers, mp_context=multiprocessing.get_context("spawn"),
+        ) if parsers > 0 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+
+    def utilization(self):
+        """Fraction of the last run's time each stage's workers spent busy."""
+        if not self.elapsed:
+            return dict.fromkeys(STAGES, 0.0)
+        return {stage: self.busy[stage] / (self.elapsed * self.workers[stage]) for stage in STAGES}
+
+    def summary(self):
+        """One line describing the last run's stages, for logs."""
+        utilization = self.utilization()
+        return ", ".join(
+            f"{stage} {utilization[stage]:.0%} busy"
+            + (f" (queue max {self.max_depth[stage]})" if stage in self.max_depth else "")
+            for stage in STAGES
+        )
+
+    def run(self, users):
+        """
+        Yields (user_auth, user_link, outcome) for each (user_auth,
+        user_link) pair in users as its sync finishes, outcome being what
+        sync returned. An error escaping a stage stops the run and is raised
+        here; closing the generator early stops the stages too.
+        """
+        self.busy = dict.fromkeys(STAGES, 0.0)
+        stop = threading.Event()
+        errors = []
+        to_parse = _StageQueue('parse', self.queue_size)
+        to_write = _StageQueue('write', self.queue_size)
+        done = queue.Queue(self.queue_size)
+        for stage in STAGES:
+            metrics.SYNC_STAGE_WORKERS.labels(stage).set(self.workers[stage])
+
+        def guarded(target, *args):
+            def run_stage():
+                try:
+                    target(*args)
+                except Exception as e:
+                    logger.error(f"Sync pipeline stage failed: {e}")
+                    errors.append(e)
+                    stop.set()
+            return run_stage
+
+        def worker_group(stage, target, inbox, outbox):
+            # The last worker of a stage to finish tells the next stage.
+            remaining = [self.workers[stage]]
+
+            def run_worker():
+                try:
+                    target(inbox, outbox, stop)
+                finally:
+                    with self._lock:
+                        remaining[0] -= 1
+                        last = remaining[0] == 0
+                    if last:
+                        self._put(outbox, _DONE, stop)
+            return [
+                threading.Thread(target=guarded(run_worker), name=f"sync-{stage}-{i}", daemon=True)
+                for i in range(self.workers[stage])
+            ]
+
+        threads = [threading.Thread(
+            target=guarded(self._fetch_stage, users, to_parse, stop), name="sync-fetch", daemon=True,
+        )]
+        threads += worker_group('parse', self._parse_worker, to_parse, to_write)
+        threads += worker_group('write', self._write_worker, to_write, done)
+
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self._get(done, stop)
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self.elapsed = time.monotonic() - started
+            self.max_depth = {'parse': to_parse.max_depth, 'write': to_write.max_depth}
+        if errors:
+            raise errors[0]
+
+    @contextlib.contextmanager
+    def _busy(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            metrics.SYNC_STAGE_BUSY_SECONDS.labels(stage).inc(seconds)
+            with self._lock:
+                self.busy[stage] += seconds
+
+    @staticmethod
+    def _put(q, item, stop):
+        """Puts item on q, waiting for room unless the run stops; returns whether it was put."""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _get(q, stop):
+        """The next item on q, or _DONE once the run stops."""
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fetch_stage(self, users, outbox, stop):
+        users = iter(users)
+        try:
+            while not stop.is_set():
+                batch = list(islice(users, self.fetch_batch))
+                if not batch:
+                    break
+                with self._busy('fetch'):
+                    ics_urls = decrypt_many([user_link.get('ics_url') for _, user_link in batch])
+                fetched = iter_prefetched_ics_feeds(
+                    [(ics_url, user_link.get('ics_feed')) for ics_url, (_, user_link) in zip(ics_urls, batch)],
+                    bucket=self.bucket,
+                )
+                with contextlib.closing(fetched):
+                    while True:
+                        # Waiting on downloads is this stage's work; waiting
+                        # for room downstream is not.
+                        with self._busy('fetch'):
+                            i, prefetched = next(fetched, (None, None))
+                        if i is None:
+                            break
+                        user_auth, user_link = batch[i]
+                        if not self._put(outbox, (user_auth, user_link, prefetched), stop):
+                            return
+        finally:
+            self._put(outbox, _DONE, stop)
+
+    def _parse_worker(self, inbox, outbox, stop):
+        while True:
+            item = self._get(inbox, stop)
+            if item is _DONE:
+                # Pass the end on to this stage's other workers.
+                self._put(inbox, _DONE, stop)
+                return
+            user_auth, user_link, prefetched = item
+            if prefetched is not None and prefetched.get('content') is not None:
+                with self._busy('parse'):
+                    try:
+                        if self._pool is None:
+                            prefetched = parse_prefetched(prefetched, user_link.get('ics_feed'))
+                        else:
+                            prefetched = self._pool.submit(
+                                parse_prefetched, prefetched, user_link.get('ics_feed'),
+                            ).result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        # A feed that fails to parse fails that user's sync only.
+                        prefetched = {"error": e, "seconds": prefetched['seconds']}
+            if not self._put(outbox, (user_auth, user_link, prefetched), stop):
+                return
+
+    def _write_worker(self, inbox, outbox, stop):
+        while True:
+            item = self._get(inbox, stop)
+            if item is _DONE:
+                self._put(inbox, _DONE, stop)
+                return
+            user_auth, user_link, prefetched = item
+            with self._busy('write'):
+                outcome = self.sync(user_auth, user_link, prefetched)
+            if not self._put(outbox, (user_auth, user_link, outcome), stop):
+                return
@@ -0,0 +1,785 @@
+"""
+MongoDB access shared by the batch sync scripts (background_sync.py and
+one_time_sync.py): reading the users to sync (all of them, the ones due
+by their schedule, or leases on them when a run is split across shards),
+recording sync results and each user's next sync time, the queue of web
+sync jobs run by sync_worker.py, and the Google call budget shared with the
+web app.
+"""
+import os
+import time
+import random
+import socket
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, DESCENDING, InsertOne, UpdateOne
+from pymongo import ReturnDocument
+from pymongo.errors import CollectionInvalid, DuplicateKeyError, PyMongoError
+import metrics
+
+logger = logging.getLogger("sync_store")
+
+# Documents per cursor batch when streaming users. Each getMore must come
+# within the server's 10-minute cursor timeout, so keep this small enough
+# that one batch syncs well inside that window.
+SYNC_CURSOR_BATCH_SIZE = int(os.getenv("SYNC_CURSOR_BATCH_SIZE", 100))
+
+# Outcomes are buffered and written this many users at a time.
+SYNC_LEDGER_FLUSH_SIZE = 200
+# sync_ledger rows expire (TTL index) after this many days.
+SYNC_LEDGER_TTL_DAYS = 30
+# Size of the capped sync_traces collection; the oldest traces are
+# overwritten once it is full.
+SYNC_TRACES_BYTES = int(os.getenv("SYNC_TRACES_BYTES", 64 * 1024 * 1024))
+
+# Joins each user_auth row to its user_links row on the server, keeping only
+# users that can actually be synced and only the fields the sync reads.
+SYNC_USERS_PIPELINE = [
+    {"$match": {"refresh_token": {"$nin": [None, ""]}}},
+    {"$lookup": {
+        "from": "user_links",
+        "localField": "email",
+        "foreignField": "email",
+        "as": "link",
+    }},
+    # Drops users without a link (an empty or missing ics_url counts as none).
+    {"$unwind": "$link"},
+    {"$match": {"link.ics_url": {"$nin": [None, ""]}}},
+    {"$project": {
+        "_id": 0, "email": 1, "refresh_token": 1, "access_token": 1, "access_token_expires_at": 1,
+        "client_id": 1, "client_secret": 1,
+        "tasks_state": 1, "deadlines": 1, "feed_changed_at": 1, "sync_failures": 1,
+        "link.email": 1, "link.ics_url": 1, "link.ics_feed": 1,
+    }},
+]
+
+# Per-user sync cadence (see next_sync_delay), in hours.
+SYNC_INTERVAL_HOURS = float(os.getenv("SYNC_INTERVAL_HOURS", 6))
+# A deadline within SYNC_DEADLINE_WINDOW_HOURS: sync this often.
+SYNC_URGENT_INTERVAL_HOURS = float(os.getenv("SYNC_URGENT_INTERVAL_HOURS", 1))
+SYNC_DEADLINE_WINDOW_HOURS = 48
+# The feed changed within the last day: sync this often.
+SYNC_RECENT_INTERVAL_HOURS = 2
+SYNC_RECENT_CHANGE_HOURS = 24
+# The feed hasn't changed for a week: daily; for a month: this often.
+SYNC_DORMANT_DAYS = 7
+SYNC_DORMANT_INTERVAL_HOURS = 24
+SYNC_MAX_INTERVAL_HOURS = float(os.getenv("SYNC_MAX_INTERVAL_HOURS", 72))
+# Users without a feed link are looked at again after this long.
+SYNC_NO_LINK_INTERVAL_HOURS = 24
+
+
+def next_sync_delay(now, status, deadlines, feed_changed_at, failures):
+    """
+    How long to wait before syncing a user again, so the API budget goes
+    where freshness matters: hourly with a deadline in the next 48 hours,
+    every 2 hours after a recent feed change, the normal 6 hours otherwise,
+    and backing off to daily and then every few days while the feed stays
+    unchanged. Failed syncs retry with exponential backoff. The delay is
+    shortened by up to 10% at random so users scheduled together spread out.
+
+    Args:
+        now (datetime): The current UTC time
+        status (str): The sync's outcome ('synced', 'unchanged' or 'failed')
+        deadlines (list): The feed's upcoming due times (util.upcoming_deadlines)
+        feed_changed_at (datetime): When the feed last changed, or None
+        failures (int): Consecutive failed syncs, including this one
+
+    Returns:
+        timedelta: The delay
+    """
+    if status == 'failed':
+        hours = min(SYNC_DORMANT_INTERVAL_HOURS, SYNC_URGENT_INTERVAL_HOURS * 2 ** max(0, failures - 1))
+    elif any(now < _utc(due) <= now + timedelta(hours=SYNC_DEADLINE_WINDOW_HOURS) for due in deadlines or []):
+        hours = SYNC_URGENT_INTERVAL_HOURS
+    elif feed_changed_at is None:
+        hours = SYNC_INTERVAL_HOURS
+    else:
+        idle = now - _utc(feed_changed_at)
+        if idle <= timedelta(hours=SYNC_RECENT_CHANGE_HOURS):
+            hours = SYNC_RECENT_INTERVAL_HOURS
+        elif idle < timedelta(days=SYNC_DORMANT_DAYS):
+            hours = SYNC_INTERVAL_HOURS
+        elif idle < timedelta(days=30):
+            hours = SYNC_DORMANT_INTERVAL_HOURS
+        else:
+            hours = SYNC_MAX_INTERVAL_HOURS
+    return timedelta(hours=hours * random.uniform(0.9, 1.0))
+
+
+def _utc(value):
+    """Mongo hands datetimes back naive; they are stored as UTC."""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def iter_due_users(db, now, limit):
+    """
+    Streams (user_auth, user_link) pairs for up to `limit` users whose
+    next_sync_at has passed (or who were never scheduled), most overdue
+    first. Users without a usable feed link are pushed back by
+    SYNC_NO_LINK_INTERVAL_HOURS instead, so they don't crowd the queue.
+    """
+    db.user_auth.create_index("next_sync_at")
+    db.user_links.create_index("email")
+    pipeline = [
+        {"$match": {
+            "$or": [{"next_sync_at": {"$lte": now}}, {"next_sync_at": None}],
+            "refresh_token": {"$nin": [None, ""]},
+        }},
+        {"$sort": {"next_sync_at": ASCENDING}},
+        {"$limit": limit},
+        # Like SYNC_USERS_PIPELINE, but keeping link-less users to defer them.
+        {"$lookup": {
+            "from": "user_links",
+            "localField": "email",
+            "foreignField": "email",
+            "as": "links",
+        }},
+        {"$project": {
+            "_id": 0, "email": 1, "refresh_token": 1, "access_token": 1, "access_token_expires_at": 1,
+            "client_id": 1, "client_secret": 1,
+            "tasks_state": 1, "deadlines": 1, "feed_changed_at": 1, "sync_failures": 1,
+            "links.email": 1, "links.ics_url": 1, "links.ics_feed": 1,
+        }},
+    ]
+    unlinked = []
+    with db.user_auth.aggregate(pipeline, batchSize=SYNC_CURSOR_BATCH_SIZE) as cursor:
+        for doc in cursor:
+            links = [link for link in doc.pop("links") if link.get("ics_url")]
+            if not links:
+                unlinked.append(doc.get("email"))
+            for link in links:
+                yield doc, link
+    if unlinked:
+        db.user_auth.update_many(
+            {"email": {"$in": unlinked}},
+            {"$set": {"next_sync_at": now + timedelta(hours=SYNC_NO_LINK_INTERVAL_HOURS)}},
+        )
+
+
+def iter_sync_users(db):
+    """
+    Streams (user_auth, user_link) pairs for every syncable user, joined
+    server-side. Documents arrive SYNC_CURSOR_BATCH_SIZE at a time, so memory
+    stays flat however many users there are.
+    """
+    # $lookup does one user_links query per user; make it an index hit.
+    db.user_links.create_index("email")
+    cursor = db.user_auth.aggregate(SYNC_USERS_PIPELINE, batchSize=SYNC_CURSOR_BATCH_SIZE)
+    with cursor:
+        for doc in cursor:
+            yield doc, doc.pop("link")
+
+
+# Users leased per claim by a sharded run, and how long a lease lasts before
+# the users go back to the pool (a shard that crashed never finishes them).
+SYNC_LEASE_BATCH_SIZE = int(os.getenv("SYNC_LEASE_BATCH_SIZE", 20))
+SYNC_LEASE_SECONDS = int(os.getenv("SYNC_LEASE_SECONDS", 900))
+# sync_leases documents expire (TTL index) this long after their run starts.
+SYNC_LEASE_TTL_DAYS = 7
+
+# The user_auth fields a sync reads, and the user_links ones.
+_AUTH_FIELDS = {"_id": 1, "email": 1, "refresh_token": 1, "access_token": 1, "access_token_expires_at": 1,
+                "client_id": 1, "client_secret": 1, "tasks_state": 1,
+                "deadlines": 1, "feed_changed_at": 1, "sync_failures": 1}
+_LINK_FIELDS = {"_id": 0, "email": 1, "ics_url": 1, "ics_feed": 1}
+
+
+class SyncLeases:
+    """
+    Splits one sync run across any number of shards (processes or CI jobs
+    sharing a run_id) so that each user is synced once. Shards lease batches
+    of syncable users in user_auth _id order: the batch's lease is recorded
+    in sync_leases first, then a per-run cursor document is moved past it
+    with a compare-and-set update. A shard that dies in between leaves a
+    lease to take over, never users that nobody leased; the next shard to
+    find the lease moves the cursor on for it.
+
+    A background thread keeps extending the shard's unfinished leases, so a
+    batch waiting in a slow pipeline isn't taken over while it is still
+    being synced. A lease that isn't finished before it expires (its shard
+    died) is taken over by whichever shard asks next. A lease is only
+    claimed when the previous one's users have all been handed out, so a
+    consumer pulling batch_size users at a time holds about one lease ahead.
+
+    Iterate it for (user_auth, user_link) pairs, like iter_sync_users, and
+    call finished(user_link) once each user's result is recorded; close()
+    (or use it as a context manager) when the run ends.
+    """
+
+    def __init__(self, db, run_id, owner=None, batch_size=SYNC_LEASE_BATCH_SIZE,
+                 lease_seconds=SYNC_LEASE_SECONDS):
+        self.db = db
+        self.leases = db.sync_leases
+        self.run_id = run_id
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{ObjectId()}"
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self._cursor_id = f"{run_id}:cursor"
+        self._pending = {}      # lease _id -> users yielded but not finished
+        self._lease_of = {}     # id(user_link) -> lease _id
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._heartbeat_thread = None
+        self.claimed = 0
+        self.taken_over = 0
+
+        self.leases.create_index("expires_at", expireAfterSeconds=0)
+        self.leases.create_index([("run", ASCENDING), ("done", ASCENDING), ("until", ASCENDING)])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        """Stops extending this shard's leases; unfinished ones then expire."""
+        self._closed.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+    def _heartbeat(self):
+        """Pushes back the expiry of this shard's unfinished leases until close()."""
+        while not self._closed.wait(max(1, self.lease_seconds / 3)):
+            with self._lock:
+                lease_ids = list(self._pending)
+            if not lease_ids:
+                continue
+            try:
+                # A lease that expired anyway and was taken over isn't ours
+                # to extend.
+                self.leases.update_many(
+                    {"_id": {"$in": lease_ids}, "owner": self.owner, "done": False},
+                    {"$set": {"until": datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)}},
+                )
+            except PyMongoError as e:
+                logger.warning(f"Failed to extend leases: {e}")
+
+    def _take_over_expired(self):
+        """Re-leases a batch whose shard let the lease run out, or returns None."""
+        now = datetime.now(timezone.utc)
+        return self.leases.find_one_and_update(
+            {"run": self.run_id, "done": False, "until": {"$lt": now}},
+            {"$set": {"owner": self.owner, "until": now + timedelta(seconds=self.lease_seconds)},
+             "$inc": {"attempts": 1}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _lease_next(self):
+        """Leases the next batch_size users after the run's cursor, or returns None when none are left."""
+        while True:
+            cursor = self.leases.find_one({"_id": self._cursor_id}) or {}
+            after = cursor.get("after")
+            query = {"refresh_token": {"$nin": [None, ""]}}
+            if after is not None:
+                query["_id"] = {"$gt": after}
+            ids = [doc["_id"] for doc in
+                   self.db.user_auth.find(query, {"_id": 1}).sort("_id", ASCENDING).limit(self.batch_size)]
+            if not ids:
+                return None
+            now = datetime.now(timezone.utc)
+            lease = {
+                "_id": f"{self.run_id}:{ids[0]}",
+                "run": self.run_id,
+                "users": ids,
+                "owner": self.owner,
+                "until": now + timedelta(seconds=self.lease_seconds),
+                "done": False,
+                "attempts": 1,
+                "expires_at": now + timedelta(days=SYNC_LEASE_TTL_DAYS),
+            }
+            try:
+                self.leases.insert_one(lease)
+            except DuplicateKeyError:
+                # Another shard leased this batch first. It may have died
+                # before moving the cursor, so move it past that lease here.
+                other = self.leases.find_one({"_id": lease["_id"]}, {"users": 1})
+                if other is not None:
+                    self._advance_cursor(after, other["users"][-1], now)
+                continue
+            self._advance_cursor(after, ids[-1], now)
+            return lease
+
+    def _advance_cursor(self, after, last, now):
+        """Moves the run's cursor from after to last, unless another shard already moved it."""
+        try:
+            # On a race the upsert collides with the existing cursor.
+            self.leases.update_one(
+                {"_id": self._cursor_id, "after": after},
+                {"$set": {"after": last},
+                 "$setOnInsert": {"run": self.run_id,
+                                  "expires_at": now + timedelta(days=SYNC_LEASE_TTL_DAYS)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            pass
+
+    def _claim(self):
+        lease = self._take_over_expired()
+        if lease is not None:
+            self.taken_over += 1
+            logger.warning(f"Took over expired lease {lease['_id']} ({len(lease['users'])} users)")
+            return lease
+        return self._lease_next()
+
+    def __iter__(self):
+        if self._heartbeat_thread is None:
+            self._heartbeat_thread = threading.Thread(
+                target=self._heartbeat, name=f"sync-leases-{self.run_id}", daemon=True,
+            )
+            self._heartbeat_thread.start()
+        while not self._closed.is_set():
+            lease = self._claim()
+            if lease is None:
+                return
+            self.claimed += 1
+            auths = list(self.db.user_auth.find(
+                {"_id": {"$in": lease["users"]}, "refresh_token": {"$nin": [None, ""]}}, _AUTH_FIELDS
+            ))
+            links = {}
+            for link in self.db.user_links.find(
+                {"email": {"$in": [a.get("email") for a in auths]}, "ics_url": {"$nin": [None, ""]}},
+                _LINK_FIELDS,
+            ):
+                links.setdefault(link.get("email"), []).append(link)
+            pairs = [(auth, link) for auth in auths for link in links.get(auth.get("email"), [])]
+            with self._lock:
+                self._pending[lease["_id"]] = len(pairs)
+                for _, link in pairs:
+                    self._lease_of[id(link)] = lease["_id"]
+            if not pairs:
+                self._finish_lease(lease["_id"])
+            for auth, link in pairs:
+                auth.pop("_id", None)
+                yield auth, link
+
+    def finished(self, user_link):
+        """Marks a yielded user done; a lease is released once all its users are."""
+        with self._lock:
+            lease_id = self._lease_of.pop(id(user_link), None)
+            if lease_id is None:
+                return
+            self._pending[lease_id] -= 1
+            if self._pending[lease_id] > 0:
+                return
+            del self._pending[lease_id]
+        self._finish_lease(lease_id)
+
+    def _finish_lease(self, lease_id):
+        try:
+            # Only the current holder can finish it; if the lease expired and
+            # was taken over, the new holder finishes it.
+            self.leases.update_one(
+                {"_id": lease_id, "owner": self.owner},
+                {"$set": {"done": True, "finished_at": datetime.now(timezone.utc)}},
+            )
+        except PyMongoError as e:
+            logger.error(f"Failed to finish lease {lease_id}: {e}")
+
+
+# Google Tasks calls per minute across every process (web app, background
+# daemon, Actions runs). Batched calls count one each, as Google counts them.
+GOOGLE_API_CALLS_PER_MINUTE = int(os.getenv("GOOGLE_API_CALLS_PER_MINUTE", 600))
+
+
+class SharedRateLimiter:
+    """
+    A per-minute call budget shared by every process through Mongo. Each
+    minute is one rate_limits document whose 'used' count processes $inc
+    atomically, reserving calls in small blocks to keep round trips down.
+
+    The budget adapts: throttled() (Google said slow down) halves it for
+    everyone, down to min_fraction of the configured rate, and it then grows
+    back by recovery_per_minute of the rate each minute.
+    """
+
+    def __init__(self, db, name, rate_per_minute, block=10, min_fraction=0.1,
+                 recovery_per_minute=0.1):
+        self.collection = db.rate_limits
+        self.name = name
+        self.rate = rate_per_minute
+        self.block = max(1, min(block, rate_per_minute))
+        self.min_fraction = min_fraction
+        self.recovery_per_minute = recovery_per_minute
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._window = None
+        self._scale = None
+        self._scale_read_at = 0.0
+        self._last_cut = 0.0
+        try:
+            self.collection.create_index("expires_at", expireAfterSeconds=0)
+        except PyMongoError as e:
+            logger.error(f"Failed to index rate_limits: {e}")
+
+    def _budget(self):
+        """Calls allowed this minute, from the shared adaptive scale (re-read every 10s)."""
+        now = time.monotonic()
+        if self._scale is None or now - self._scale_read_at > 10:
+            state = self.collection.find_one({"_id": f"{self.name}:state"}) or {}
+            scale = state.get("scale", 1.0)
+            if state.get("cut_at"):
+                minutes = (datetime.now(timezone.utc) - state["cut_at"].replace(tzinfo=timezone.utc)).total_seconds() / 60
+                scale += minutes * self.recovery_per_minute
+            self._scale = min(1.0, max(self.min_fraction, scale))
+            self._scale_read_at = now
+        return max(1, int(self.rate * self._scale))
+
+    def _reserve(self, window, calls):
+        """Atomically takes calls from the window's budget; False if they don't fit."""
+        budget = self._budget()
+        if calls > budget:
+            return False
+        try:
+            self.collection.find_one_and_update(
+                {"_id": f"{self.name}:{window}", "used": {"$lte": budget - calls}},
+                {"$inc": {"used": calls},
+                 "$setOnInsert": {"expires_at": datetime.now(timezone.utc) + timedelta(minutes=5)}},
+                upsert=True, return_document=ReturnDocument.AFTER,
+            )
+            return True
+        except DuplicateKeyError:
+            # The window exists and is too full to match the filter.
+            return False
+
+    def acquire(self, calls=1):
+        """Blocks until calls Google calls fit in the shared budget."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                window = int(time.time() // 60)
+                if window != self._window:
+                    self._window, self._reserved = window, 0
+                try:
+                    # A batch bigger than a whole (cut) minute just takes the minute.
+                    calls = min(calls, self._budget())
+                    needed = calls - self._reserved
+                    block = max(needed, self.block)
+                    if needed <= 0:
+                        pass
+                    elif self._reserve(window, block):
+                        self._reserved += block
+                    elif block > needed and self._reserve(window, needed):
+                        self._reserved += needed
+                except PyMongoError as e:
+                    # Don't stall the sync on a Mongo hiccup; Google's own
+                    # rate-limit errors (and the backoff) still apply.
+                    logger.error(f"Rate limiter unavailable, not pacing: {e}")
+                    break
+                if self._reserved >= calls:
+                    self._reserved -= calls
+                    break
+            pause = (window + 1) * 60 - time.time() + random.uniform(0, 1)
+            waited += pause
+            time.sleep(pause)
+        if waited:
+            metrics.GOOGLE_RATE_LIMIT_WAIT_SECONDS.inc(waited)
+
+    def throttled(self):
+        """Halves the shared budget; repeated calls within 5 seconds count once."""
+        with self._lock:
+            if time.monotonic() - self._last_cut < 5:
+                return
+            self._last_cut = time.monotonic()
+            scale = max(self.min_fraction, (self._scale or 1.0) / 2)
+            self._scale, self._scale_read_at = scale, time.monotonic()
+            self._reserved = 0
+        try:
+            self.collection.update_one(
+                {"_id": f"{self.name}:state"},
+                {"$set": {"scale": scale, "cut_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+        except PyMongoError as e:
+            logger.error(f"Failed to share rate-limit cut: {e}")
+        logger.warning(f"Google rate limit hit; {self.name} budget cut to {int(self.rate * scale)}/min")
+
+
+# Web sync jobs (sync_jobs collection): a job whose worker died is re-run
+# once its lease runs out, up to SYNC_JOB_MAX_ATTEMPTS times. The worker
+# running a job renews its lease until the job finishes (renew_sync_job).
+# Jobs expire (TTL index) a day after they are queued.
+SYNC_JOB_LEASE_SECONDS = 300
+SYNC_JOB_MAX_ATTEMPTS = 2
+SYNC_JOB_TTL_HOURS = 24
+
+# What a job carries until it is finished; never shown on the status page.
+_JOB_SECRETS = {"ics_url": "", "token": ""}
+
+
+def enqueue_sync_job(db, email, ics_url, token):
+    """
+    Queues a sync of email's feed for sync_worker.py and returns the job id
+    (a str). A job the user already has waiting is reused, with the new
+    feed URL and token. ics_url and token must already be encrypted.
+    """
+    now = datetime.now(timezone.utc)
+    db.sync_jobs.create_index("expires_at", expireAfterSeconds=0)
+    db.sync_jobs.create_index([("status", ASCENDING), ("created_at", ASCENDING)])
+    db.sync_jobs.create_index("email")
+    waiting = db.sync_jobs.find_one_and_update(
+        {"email": email, "status": "queued"},
+        {"$set": {"ics_url": ics_url, "token": token}},
+        projection={"_id": 1},
+    )
+    if waiting is not None:
+        return str(waiting["_id"])
+    return str(db.sync_jobs.insert_one({
+        "email": email,
+        "ics_url": ics_url,
+        "token": token,
+        "status": "queued",
+        "stage": None,
+        "attempts": 0,
+        "created_at": now,
+        "expires_at": now + timedelta(hours=SYNC_JOB_TTL_HOURS),
+    }).inserted_id)
+
+
+def claim_sync_job(db, owner):
+    """
+    Leases the oldest queued job (or one whose worker's lease ran out) to
+    owner and returns it, or None when there is nothing to do.
+    """
+    now = datetime.now(timezone.utc)
+    # Jobs that keep dying with their worker are given up on.
+    db.sync_jobs.update_many(
+        {"status": "running", "lease_until": {"$lt": now}, "attempts": {"$gte": SYNC_JOB_MAX_ATTEMPTS}},
+        {"$set": {"status": "failed", "error": "Interrupted", "finished_at": now}, "$unset": _JOB_SECRETS},
+    )
+    return db.sync_jobs.find_one_and_update(
+        {"$or": [{"status": "queued"}, {"status": "running", "lease_until": {"$lt": now}}]},
+        {"$set": {"status": "running", "owner": owner, "started_at": now,
+                  "lease_until": now + timedelta(seconds=SYNC_JOB_LEASE_SECONDS)},
+         "$inc": {"attempts": 1}},
+        sort=[("created_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def update_sync_job(db, job_id, owner, **fields):
+    """
+    Records a running job's progress (its stage). Does nothing once the job
+    has been taken over by another worker. Failures are logged, not raised.
+    """
+    try:
+        db.sync_jobs.update_one({"_id": job_id, "owner": owner, "status": "running"}, {"$set": fields})
+    except PyMongoError as e:
+        logger.error(f"Failed to update sync job {job_id}: {e}")
+
+
+def renew_sync_job(db, job_id, owner):
+    """
+    Extends owner's lease on a running job by SYNC_JOB_LEASE_SECONDS.
+    Returns False if owner no longer holds it. Failures are logged, not
+    raised (and count as still holding it: the lease may yet be renewed).
+    """
+    lease_until = datetime.now(timezone.utc) + timedelta(seconds=SYNC_JOB_LEASE_SECONDS)
+    try:
+        result = db.sync_jobs.update_one(
+            {"_id": job_id, "owner": owner, "status": "running"},
+            {"$set": {"lease_until": lease_until}},
+        )
+    except PyMongoError as e:
+        logger.error(f"Failed to renew the lease of sync job {job_id}: {e}")
+        return True
+    return result.matched_count > 0
+
+
+def finish_sync_job(db, job_id, owner, status, **fields):
+    """
+    Marks a job 'done' or 'failed' with its outcome, and drops its URL and
+    token. Returns False, changing nothing, if owner no longer holds the job
+    (its lease ran out and another worker took it over).
+    """
+    result = db.sync_jobs.update_one(
+        {"_id": job_id, "owner": owner, "status": "running"},
+        {"$set": dict(fields, status=status, finished_at=datetime.now(timezone.utc)),
+         "$unset": _JOB_SECRETS},
+    )
+    return result.matched_count > 0
+
+
+def get_sync_job(db, job_id, email):
+    """The job as the status page sees it (no URL or token), or None if it isn't email's."""
+    try:
+        job_id = ObjectId(job_id)
+    except (InvalidId, TypeError):
+        return None
+    return db.sync_jobs.find_one({"_id": job_id, "email": email}, {"ics_url": 0, "token": 0})
+
+
+def trace_user_key(email):
+    """
+    The key sync_traces are stored under for a user. Documents in a capped
+    collection can't be deleted individually, so traces carry a one-way hash
+    of the email rather than the email itself; look a user up by hashing.
+    """
+    return hashlib.sha256((email or '').strip().lower().encode()).hexdigest()[:32]
+
+
+def _ensure_traces_collection(db):
+    """Creates the capped sync_traces collection on first use. Failures are logged, not raised."""
+    try:
+        if "sync_traces" not in db.list_collection_names(filter={"name": "sync_traces"}):
+            try:
+                db.create_collection("sync_traces", capped=True, size=SYNC_TRACES_BYTES)
+            except CollectionInvalid:
+                pass  # created by a concurrent run
+        db.sync_traces.create_index([("user", ASCENDING), ("at", DESCENDING)])
+    except PyMongoError as e:
+        logger.error(f"Failed to set up sync_traces: {e}")
+
+
+class SyncLedger:
+    """
+    Buffers per-user sync outcomes for one run and writes them in unordered
+    bulk batches: one sync_ledger row per user (status, counts, duration,
+    error class), plus the last_sync / tasks_state / ics_feed updates for
+    users that synced, the user's next_sync_at, and a sync_traces row with
+    the per-stage timings.
+    Use it as a context manager so the tail is flushed when the run ends.
+    """
+
+    def __init__(self, db, source, flush_size=SYNC_LEDGER_FLUSH_SIZE):
+        self.db = db
+        self.source = source
+        self.run_id = ObjectId()
+        self.flush_size = flush_size
+        self._entries = []
+        self._auth_updates = []
+        self._link_updates = []
+        self._traces = []
+        self._lock = threading.Lock()
+
+        db.sync_ledger.create_index("at", expireAfterSeconds=SYNC_LEDGER_TTL_DAYS * 86400)
+        db.sync_ledger.create_index("run_id")
+        db.sync_ledger.create_index([("email", ASCENDING), ("at", DESCENDING)])
+        _ensure_traces_collection(db)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def record(self, user_link, result, duration, trace=None, user_auth=None):
+        """
+        Buffers the outcome of one sync_task_for_user call.
+
+        Args:
+            user_link (dict): The user's link row as read by iter_sync_users
+            result (dict): What sync_task_for_user returned
+            duration (float): Wall-clock seconds the user's sync took
+            trace (util.SyncTrace): The sync's stage timings (and profile)
+            user_auth (dict): The user's auth row as read by iter_sync_users;
+                when given, the user's next sync is scheduled from the outcome
+        """
+        email = user_link.get('email')
+        # Aware UTC, like every other timestamp here: the ledger's TTL index
+        # and the schedule compare against UTC.
+        now = datetime.now(timezone.utc)
+        if not result.get('success'):
+            status = 'failed'
+        elif result.get('not_modified'):
+            status = 'unchanged'
+        else:
+            status = 'synced'
+        metrics.SYNC_USER_SECONDS.labels(self.source, status).observe(duration)
+
+        with self._lock:
+            self._entries.append(InsertOne({
+                "run_id": self.run_id,
+                "source": self.source,
+                "email": email,
+                "status": status,
+                "counts": result.get('counts'),
+                "duration_ms": round(duration * 1000),
+                "error_class": result.get('error'),
+                "at": now,
+            }))
+            auth_fields = self._schedule(user_auth, status, result, now) if user_auth is not None else {}
+            # A refreshed access token, saved (encrypted) for the next syncs.
+            auth_fields.update(result.get('token_fields') or {})
+            if result.get('success'):
+                auth_fields["last_sync"] = now
+                if result.get('tasks_state'):
+                    auth_fields["tasks_state"] = result['tasks_state']
+                # Unchanged feeds usually hand back the stored state; skip that
+                # write. The filter on the stored (encrypted) ics_url keeps state
+                # from being attached to a link that was changed mid-sync.
+                feed = result.get('ics_feed')
+                if feed and feed != user_link.get('ics_feed'):
+                    self._link_updates.append(UpdateOne(
+                        {"email": email, "ics_url": user_link.get('ics_url')},
+                        {"$set": {"ics_feed": feed}}
+                    ))
+            if auth_fields:
+                self._auth_updates.append(
+                    UpdateOne({"email": email}, {"$set": auth_fields})
+                )
+            if trace is not None:
+                self._traces.append(InsertOne(self._trace_doc(email, status, result, duration, trace, now)))
+            full = len(self._entries) >= self.flush_size
+        if full:
+            self.flush()
+
+    @staticmethod
+    def _schedule(user_auth, status, result, now):
+        """The user_auth fields that schedule the user's next sync (see next_sync_delay), as of now."""
+        deadlines = result.get('deadlines')
+        if deadlines is None:
+            # The feed wasn't parsed (unchanged, or the sync failed early).
+            deadlines = user_auth.get('deadlines') or []
+        deadlines = [due for due in deadlines if _utc(due) > now]
+        failures = (user_auth.get('sync_failures') or 0) + 1 if status == 'failed' else 0
+        feed_changed_at = now if status == 'synced' else user_auth.get('feed_changed_at')
+        fields = {
+            "next_sync_at": now + next_sync_delay(now, status, deadlines, feed_changed_at, failures),
+            "sync_failures": failures,
+            "deadlines": deadlines,
+        }
+        if status == 'synced':
+            fields["feed_changed_at"] = now
+        return fields
+
+    def _trace_doc(self, email, status, result, duration, trace, now):
+        doc = {
+            "run_id": self.run_id,
+            "source": self.source,
+            "user": trace_user_key(email),
+            "status": status,
+            "error_class": result.get('error'),
+            "duration_ms": round(duration * 1000),
+            "stages_ms": {stage: round(seconds * 1000, 1) for stage, seconds in trace.stages.items()},
+            "at": now,
+        }
+        if trace.profile_summary is not None:
+            doc["profile"] = trace.profile_summary
+            doc["process_peak_memory_bytes"] = trace.process_peak_memory
+        return doc
+
+    def flush(self):
+        """Writes everything buffered so far. Failures are logged, not raised."""
+        with self._lock:
+            batches = (
+                (self.db.sync_ledger, self._entries),
+                (self.db.user_auth, self._auth_updates),
+                (self.db.user_links, self._link_updates),
+                (self.db.sync_traces, self._traces),
+            )
+            self._entries, self._auth_updates, self._link_updates, self._traces = [], [], [], []
+            for collection, ops in batches:
+                if not ops:
+                    continue
+                try:
+                    collection.bulk_write(ops, ordered=False)
+                except PyMongoError as e:
+                    logger.error(f"Failed to write {len(ops)} sync results to {collection.name}: {e}")
@@ -0,0 +1,197 @@
+"""
+Runs the web app's sync jobs. /sync_calendar only queues a job (see
+sync_store.enqueue_sync_job) and sends the user to a status page; this
+fetches the feed and syncs it to Google Tasks, recording the job's progress
+and outcome for that page to show.
+
+Run it as its own process (the Procfile's worker):
+
+    python sync_worker.py
+
+It runs SYNC_JOB_THREADS jobs at a time. The web app can also run jobs in
+each of its processes (start_job_threads, SYNC_WEB_JOB_THREADS in
+server.py), which is off by default: every gunicorn worker would start its
+own threads.
+"""
+import os
+import json
+import time
+import socket
+import logging
+import threading
+import contextlib
+from datetime import timezone
+from dotenv import load_dotenv
+from pymongo.mongo_client import MongoClient
+from pymongo.errors import PyMongoError
+from util import (
+    fetch_ics_events, sync_with_tasklist, decrypt_many, set_google_rate_limiter,
+    access_token_fields, SyncTrace, UnsafeURLError,
+)
+from sync_store import (
+    claim_sync_job, update_sync_job, renew_sync_job, finish_sync_job, SharedRateLimiter,
+    GOOGLE_API_CALLS_PER_MINUTE, SYNC_JOB_LEASE_SECONDS,
+)
+import metrics
+
+load_dotenv()
+
+logger = logging.getLogger("sync_worker")
+
+# How long an idle worker waits before looking for new jobs again.
+SYNC_JOB_POLL_SECONDS = float(os.getenv("SYNC_JOB_POLL_SECONDS", 1))
+# Jobs run concurrently per process.
+SYNC_JOB_THREADS = int(os.getenv("SYNC_JOB_THREADS", 2))
+# Where the worker serves its Prometheus metrics (0: not served). The web
+# app's /metrics only covers its own processes.
+SYNC_WORKER_METRICS_PORT = int(os.getenv("SYNC_WORKER_METRICS_PORT", 9101))
+SYNC_WORKER_METRICS_ADDR = os.getenv("SYNC_WORKER_METRICS_ADDR", "0.0.0.0")
+
+# The stages a job reports as it finishes them (see SyncTrace), in order.
+JOB_STAGES = ('fetch', 'parse', 'list', 'diff', 'writes')
+
+
+class JobTrace(SyncTrace):
+    """
+    A SyncTrace that also saves each finished stage as the job's progress.
+    Progress only moves forward through JOB_STAGES, so a stage recorded out
+    of order never sends the status page back.
+    """
+
+    def __init__(self, db, job):
+        super().__init__(job.get('email'))
+        self.db = db
+        self.job_id = job['_id']
+        self.owner = job['owner']
+        self._reached = -1
+
+    def add(self, stage, seconds):
+        super().add(stage, seconds)
+        if stage in JOB_STAGES and JOB_STAGES.index(stage) > self._reached:
+            self._reached = JOB_STAGES.index(stage)
+            update_sync_job(self.db, self.job_id, self.owner, stage=stage)
+
+
+def save_access_token(db, job, oauth_token):
+    """Saves an access token refreshed during a job for the user's later syncs to reuse."""
+    try:
+        db.user_auth.update_one({"email": job.get('email')}, {"$set": access_token_fields(oauth_token)})
+    except PyMongoError as e:
+        logger.error(f"Failed to save the refreshed token of sync job {job['_id']}: {e}")
+
+
+@contextlib.contextmanager
+def renewing_lease(db, job):
+    """Renews the lease on a claimed job from a background thread while the block runs."""
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(SYNC_JOB_LEASE_SECONDS / 3):
+            if not renew_sync_job(db, job['_id'], job['owner']):
+                logger.warning(f"Lost the lease on sync job {job['_id']}")
+                return
+
+    thread = threading.Thread(target=renew, name=f"sync-job-lease-{job['_id']}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def process_job(db, job):
+    """Runs one claimed job and records its outcome. Never raises."""
+    created = job['created_at'].replace(tzinfo=timezone.utc)
+    started = job['started_at'].replace(tzinfo=timezone.utc)
+    metrics.SYNC_JOB_WAIT_SECONDS.observe((started - created).total_seconds())
+
+    # Renewed for as long as the job runs: a job slowed down by the shared
+    # Google budget must not be handed to a second worker mid-write, or
+    # both would insert the same tasks.
+    with renewing_lease(db, job):
+        trace = JobTrace(db, job)
+        clock = time.monotonic()
+        status = 'failed'
+        try:
+            ics_url, token = decrypt_many([job.get('ics_url'), job.get('token')])
+            try:
+                events, _ = fetch_ics_events(ics_url, None, trace)
+            except UnsafeURLError:
+                outcome = {"error": "UnsafeURL"}
+            except Exception as e:
+                logger.error(f"Failed to fetch feed for job {job['_id']}: {e}")
+                outcome = {"error": "FetchFailed"}
+            else:
+                if not events:
+                    outcome = {"error": "NoEvents"}
+                else:
+                    # Always exclude past events, as the web sync always has.
+                    oauth_token = json.loads(token)
+                    access_token = oauth_token.get('access_token')
+                    result = sync_with_tasklist(oauth_token, events, False, trace=trace)
+                    if oauth_token.get('access_token') != access_token:
+                        save_access_token(db, job, oauth_token)
+                    if result.get('success'):
+                        status = 'done'
+                        outcome = {
+                            "tasklist_title": result.get('tasklist_title'),
+                            "task_count": result.get('task_count', 0),
+                            "updated_count": result.get('updated_count', 0),
+                        }
+                    else:
+                        logger.error(f"Sync failed for job {job['_id']}: {result.get('error')}")
+                        outcome = {"error": result.get('error_class', 'SyncFailed')}
+        except Exception as e:
+            logger.error(f"Error running sync job {job['_id']}: {e}")
+            outcome = {"error": type(e).__name__}
+
+    metrics.SYNC_USER_SECONDS.labels("web", "synced" if status == 'done' else "failed").observe(
+        time.monotonic() - clock
+    )
+    try:
+        if not finish_sync_job(db, job['_id'], job['owner'], status, **outcome):
+            logger.warning(f"Sync job {job['_id']} was taken over by another worker; its outcome is theirs to record")
+    except PyMongoError as e:
+        # The lease runs out and another worker retries the job.
+        logger.error(f"Failed to record the outcome of sync job {job['_id']}: {e}")
+
+
+def work(db, stop=None):
+    """Claims and runs jobs until stop (a threading.Event) is set, or forever."""
+    owner = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    while stop is None or not stop.is_set():
+        try:
+            job = claim_sync_job(db, owner)
+        except PyMongoError as e:
+            logger.error(f"Failed to claim a sync job: {e}")
+            job = None
+        if job is None:
+            time.sleep(SYNC_JOB_POLL_SECONDS)
+            continue
+        process_job(db, job)
+
+
+def start_job_threads(db, count):
+    """Starts count daemon threads running work(db); returns their stop Event."""
+    stop = threading.Event()
+    for i in range(count):
+        threading.Thread(target=work, args=(db, stop), name=f"sync-job-{i}", daemon=True).start()
+    return stop
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    mongo_uri = os.getenv("MONGO_URI")
+    mongo_db_name = os.getenv("MONGO_DB_NAME")
+    if not mongo_uri or not mongo_db_name:
+        raise SystemExit("MONGO_URI / MONGO_DB_NAME not set")
+    client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
+    client.admin.command('ping')
+    worker_db = client[mongo_db_name]
+    set_google_rate_limiter(SharedRateLimiter(worker_db, "google_tasks", GOOGLE_API_CALLS_PER_MINUTE))
+    if SYNC_WORKER_METRICS_PORT > 0:
+        metrics.serve(SYNC_WORKER_METRICS_PORT, SYNC_WORKER_METRICS_ADDR)
+    logger.info(f"Sync worker started with {SYNC_JOB_THREADS} threads")
+    start_job_threads(worker_db, max(1, SYNC_JOB_THREADS))
+    threading.Event().wait()
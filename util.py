@@ -1,17 +1,37 @@
 import os
 import re
+import json
+import time
+import hashlib
+import random
+import functools
 import socket
+import queue
+import threading
 import ipaddress
+import cProfile
+import pstats
+import tracemalloc
+import contextlib
+import asyncio
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from cachetools import TTLCache
 from urllib.parse import urljoin, urlparse
-from icalendar import Calendar
-from datetime import datetime, date, timezone
+from icalendar import Calendar, Event, Timezone
+from datetime import datetime, date, timedelta, timezone
 import logging
 from cryptography.fernet import Fernet, InvalidToken
-from googleapiclient.discovery import build
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 from google.oauth2.credentials import Credentials
 from google.auth.exceptions import RefreshError
+import metrics
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,12 +40,45 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 HTTP_TIMEOUT = 15              # seconds, applied to all outbound calls
 ICS_MAX_BYTES = 10 * 1024 * 1024   # cap ICS download at 10 MB
 ICS_MAX_REDIRECTS = 5
+DNS_CACHE_TTL = 300                # seconds a validated DNS answer is reused
+REDIRECT_CACHE_TTL = 24 * 3600     # seconds a permanent redirect is remembered
+ICS_POOL_HOSTS = int(os.getenv("ICS_POOL_HOSTS", 32))        # hosts with kept-alive connections
+ICS_POOL_PER_HOST = int(os.getenv("ICS_POOL_PER_HOST", 8))   # max concurrent connections per host
+ICS_FETCH_CONCURRENCY = int(os.getenv("ICS_FETCH_CONCURRENCY", 64))  # feeds downloaded at once by prefetch_ics_feeds
+
+# Google endpoints. Both default to Google itself; point them at a local
+# stand-in (see fake_google.py) to load-test the sync offline.
+GOOGLE_TOKEN_URI = os.getenv("GOOGLE_TOKEN_URI", "https://oauth2.googleapis.com/token")
+GOOGLE_TASKS_ROOT_URL = os.getenv("GOOGLE_TASKS_ROOT_URL")
+
+# Access tokens are reused until they are this close to expiring.
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN_SECONDS", 300))
+
+# Hostnames allowed to resolve to non-public addresses, e.g. "127.0.0.1" for
+# a local test feed server. Keep empty in production: these bypass the SSRF
+# guard.
+ICS_TRUSTED_HOSTS = frozenset(
+    h.strip().lower() for h in os.getenv("ICS_TRUSTED_HOSTS", "").split(",") if h.strip()
+)
+
+# Parse feeds one event at a time instead of building icalendar's full
+# component tree (see iter_ics_events). A feed with no saved fingerprint is
+# parsed while it downloads; one with a fingerprint to compare against is
+# buffered (up to ICS_MAX_BYTES) and only parsed if it changed.
+ICS_STREAM_PARSE = os.getenv("ICS_STREAM_PARSE", "1") == "1"
 
 
 class UnsafeURLError(Exception):
     """Raised when an ICS URL targets a non-public / disallowed destination."""
 
 
+# Validated public addresses per host, and permanent (301/308) redirect
+# targets per URL. Both are shared by all sync threads, hence the lock.
+_dns_cache = TTLCache(maxsize=1024, ttl=DNS_CACHE_TTL)
+_redirect_cache = TTLCache(maxsize=4096, ttl=REDIRECT_CACHE_TTL)
+_cache_lock = threading.Lock()
+
+
 def _is_public_ip(addr):
     """True only for globally-routable addresses (blocks private/loopback/etc.)."""
     ip = ipaddress.ip_address(addr)
@@ -35,15 +88,44 @@ def _is_public_ip(addr):
     )
 
 
+def _resolve_public(host):
+    """
+    Resolves a host and checks that *every* returned address is public,
+    raising UnsafeURLError otherwise. Validated answers are cached for
+    DNS_CACHE_TTL seconds (failures are not), so bulk runs against the same
+    few Canvas hosts resolve each one once.
+
+    Returns:
+        tuple: The validated addresses, in resolver order.
+    """
+    with _cache_lock:
+        addrs = _dns_cache.get(host)
+    if addrs is not None:
+        return addrs
+    try:
+        infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+    except socket.gaierror as e:
+        raise UnsafeURLError(f"Could not resolve host: {host}") from e
+    addrs = tuple(dict.fromkeys(info[4][0] for info in infos))
+    if not addrs:
+        raise UnsafeURLError(f"Host did not resolve: {host}")
+    for addr in addrs:
+        if not _is_public_ip(addr) and host.lower() not in ICS_TRUSTED_HOSTS:
+            raise UnsafeURLError(f"Host resolves to a non-public address: {addr}")
+    with _cache_lock:
+        _dns_cache[host] = addrs
+    return addrs
+
+
 def _validate_public_url(url):
     """
     SSRF guard: only allow http(s) URLs whose host resolves *entirely* to
     public IP addresses. Blocks localhost, private ranges, and cloud metadata
     endpoints (e.g. 169.254.169.254, which is link-local).
 
-    Note: this resolves DNS and checks every returned address; there is a
-    residual DNS-rebinding window between this check and the actual connection,
-    which is an accepted trade-off for this app.
+    Feed connections are pinned to these validated addresses (see
+    _PinnedConnectionMixin), so a DNS answer that changes between this check
+    and the connection (DNS rebinding) cannot redirect the request.
     """
     parsed = urlparse(url)
     if parsed.scheme not in ('http', 'https'):
@@ -51,59 +133,574 @@ def _validate_public_url(url):
     host = parsed.hostname
     if not host:
         raise UnsafeURLError("URL has no host")
+    _resolve_public(host)
+
+
+class _PinnedConnectionMixin:
+    """
+    Opens the socket to an address from _resolve_public instead of letting
+    urllib3 resolve the host again. The Host header, TLS SNI and certificate
+    check still use the hostname.
+    """
+
+    def _new_conn(self):
+        dns_host = self._dns_host
+        self._dns_host = _resolve_public(self.host)[0]
+        try:
+            return super()._new_conn()
+        finally:
+            self._dns_host = dns_host
+
+
+class _PinnedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = type('_PinnedHTTPConnection', (_PinnedConnectionMixin, HTTPConnection), {})
+
+
+class _PinnedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = type('_PinnedHTTPSConnection', (_PinnedConnectionMixin, HTTPSConnection), {})
+
+
+class _PinnedAdapter(HTTPAdapter):
+    """Transport adapter whose connections are pinned to validated addresses."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _PinnedHTTPConnectionPool,
+            'https': _PinnedHTTPSConnectionPool,
+        }
+
+
+# One connection pool for all feed downloads, shared by every thread, so
+# users on the same institution's Canvas reuse kept-alive TLS connections.
+# Requests go straight to the adapter (not a Session), so no cookies or proxy
+# settings carry over between users. pool_block bounds connections per host.
+_ics_adapter = _PinnedAdapter(
+    pool_connections=ICS_POOL_HOSTS, pool_maxsize=ICS_POOL_PER_HOST, pool_block=True,
+)
+
+
+def _ics_get(url, headers):
+    """Sends a streaming GET for url through the shared feed pool."""
+    request = requests.Request(
+        'GET', url, headers={**requests.utils.default_headers(), **headers}
+    ).prepare()
+    return _ics_adapter.send(request, stream=True, timeout=HTTP_TIMEOUT)
+
+
+def _release(resp):
+    """
+    Closes a response. A small unread body (redirect, 304, error page) is
+    drained first so its connection goes back to the pool instead of being
+    torn down; anything larger is simply closed.
+    """
     try:
-        infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
-    except socket.gaierror as e:
-        raise UnsafeURLError(f"Could not resolve host: {host}") from e
-    addrs = {info[4][0] for info in infos}
-    if not addrs:
-        raise UnsafeURLError(f"Host did not resolve: {host}")
-    for addr in addrs:
-        if not _is_public_ip(addr):
-            raise UnsafeURLError(f"Host resolves to a non-public address: {addr}")
+        length = int(resp.headers.get('Content-Length', ''))
+    except ValueError:
+        length = None
+    if length is not None and length <= 64 * 1024:
+        try:
+            resp.content
+        except Exception:
+            pass
+    resp.close()
+
+
+def _cached_redirect(url):
+    """Follows remembered permanent redirects from url to the final target."""
+    with _cache_lock:
+        for _ in range(ICS_MAX_REDIRECTS):
+            target = _redirect_cache.get(url)
+            if target is None:
+                break
+            url = target
+    return url
+
+
+def _forget_redirects(url):
+    """Drops the remembered redirect chain starting at url."""
+    with _cache_lock:
+        for _ in range(ICS_MAX_REDIRECTS):
+            url = _redirect_cache.pop(url, None)
+            if url is None:
+                break
 
 
-def _fetch_ics(url):
+def _conditional_headers(validators):
+    """If-None-Match / If-Modified-Since headers from a previous fetch's validators."""
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def _open_ics(url, validators=None):
     """
-    Fetch an ICS feed safely: SSRF-validate the URL (and every redirect hop),
-    enforce a timeout, and cap the downloaded size. Returns raw bytes.
+    Opens an ICS feed safely: SSRF-validates the URL (and every redirect hop)
+    and enforces a timeout. When validators from a previous fetch are given
+    ({'etag', 'last_modified'}) the request is conditional, so an unchanged
+    feed costs a 304 instead of a full download.
+
+    Returns:
+        The open 200 response, streaming (the caller must close it), or None
+        when the server reported the feed unchanged.
     """
-    current = url
+    headers = _conditional_headers(validators)
+
+    # Skip hops we already know are permanent (301/308).
+    current = _cached_redirect(url)
     for _ in range(ICS_MAX_REDIRECTS + 1):
         _validate_public_url(current)
-        resp = requests.get(
-            current, timeout=HTTP_TIMEOUT, allow_redirects=False, stream=True
-        )
+        resp = _ics_get(current, headers)
+        if resp.status_code == 200:
+            return resp
         try:
             if resp.status_code in (301, 302, 303, 307, 308):
                 location = resp.headers.get('Location')
                 if not location:
                     raise Exception("Redirect response missing Location header")
-                current = urljoin(current, location)
+                target = urljoin(current, location)
+                if resp.status_code in (301, 308):
+                    with _cache_lock:
+                        _redirect_cache[current] = target
+                current = target
                 continue
-            if resp.status_code != 200:
-                raise Exception(
-                    f"Failed to fetch the ics file. Status code: {resp.status_code}"
-                )
-            chunks = []
-            total = 0
-            for chunk in resp.iter_content(8192):
-                total += len(chunk)
-                if total > ICS_MAX_BYTES:
-                    raise Exception("ICS file exceeds the maximum allowed size")
-                chunks.append(chunk)
-            return b''.join(chunks)
+            if resp.status_code == 304 and headers:
+                return None
+            # A remembered redirect may have gone stale; walk it afresh next time.
+            _forget_redirects(url)
+            raise Exception(
+                f"Failed to fetch the ics file. Status code: {resp.status_code}"
+            )
         finally:
-            resp.close()
+            _release(resp)
     raise Exception("Too many redirects while fetching the ICS file")
 
+
+def _iter_body(resp):
+    """Yields a response body in chunks, enforcing the ICS_MAX_BYTES cap."""
+    total = 0
+    for chunk in resp.iter_content(8192):
+        total += len(chunk)
+        if total > ICS_MAX_BYTES:
+            raise Exception("ICS file exceeds the maximum allowed size")
+        yield chunk
+
+
+def _response_validators(resp):
+    """Cache validators to send on the next fetch, or None if there are none."""
+    validators = {
+        'etag': resp.headers.get('ETag'),
+        'last_modified': resp.headers.get('Last-Modified'),
+    }
+    return {k: v for k, v in validators.items() if v} or None
+
+
+def _fetch_ics(url, validators=None):
+    """
+    Fetch an ICS feed safely (see _open_ics) and cap the downloaded size.
+
+    Returns:
+        tuple: (content, validators). content is the raw bytes, or None when
+            the server reported the feed unchanged; validators are the cache
+            validators to send next time (None if the server sent none).
+    """
+    resp = _open_ics(url, validators)
+    if resp is None:
+        return None, validators
+    try:
+        return b''.join(_iter_body(resp)), _response_validators(resp)
+    finally:
+        resp.close()
+
+
+class _PinnedResolver(aiohttp.abc.AbstractResolver):
+    """
+    aiohttp resolver that only hands out addresses validated by
+    _resolve_public, pinning async feed connections the way
+    _PinnedConnectionMixin pins the synchronous ones.
+    """
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        addrs = await asyncio.get_running_loop().run_in_executor(None, _resolve_public, host)
+        return [
+            {
+                'hostname': host, 'host': addr, 'port': port,
+                'family': socket.AF_INET6 if ':' in addr else socket.AF_INET,
+                'proto': 0, 'flags': socket.AI_NUMERICHOST,
+            }
+            for addr in addrs
+        ]
+
+    async def close(self):
+        pass
+
+
+async def _release_async(resp):
+    """_release for aiohttp responses."""
+    if resp.content_length is not None and resp.content_length <= 64 * 1024:
+        try:
+            await resp.read()
+        except Exception:
+            pass
+    resp.release()
+
+
+async def _open_ics_async(session, url, validators=None):
+    """
+    _open_ics over an aiohttp session: the same SSRF check on every hop,
+    redirect limit, redirect cache and conditional request.
+
+    Returns:
+        The open 200 response (the caller must release it), or None when the
+        server reported the feed unchanged.
+    """
+    headers = _conditional_headers(validators)
+    loop = asyncio.get_running_loop()
+
+    current = _cached_redirect(url)
+    for _ in range(ICS_MAX_REDIRECTS + 1):
+        # Resolving may block; keep it off the event loop.
+        await loop.run_in_executor(None, _validate_public_url, current)
+        resp = await session.get(current, headers=headers, allow_redirects=False)
+        if resp.status == 200:
+            return resp
+        try:
+            if resp.status in (301, 302, 303, 307, 308):
+                location = resp.headers.get('Location')
+                if not location:
+                    raise Exception("Redirect response missing Location header")
+                target = urljoin(current, location)
+                if resp.status in (301, 308):
+                    with _cache_lock:
+                        _redirect_cache[current] = target
+                current = target
+                continue
+            if resp.status == 304 and headers:
+                return None
+            _forget_redirects(url)
+            raise Exception(
+                f"Failed to fetch the ics file. Status code: {resp.status}"
+            )
+        finally:
+            await _release_async(resp)
+    raise Exception("Too many redirects while fetching the ICS file")
+
+
+async def _read_body_async(resp):
+    """Reads a whole response body, enforcing the ICS_MAX_BYTES cap."""
+    chunks = []
+    total = 0
+    async for chunk in resp.content.iter_chunked(8192):
+        total += len(chunk)
+        if total > ICS_MAX_BYTES:
+            raise Exception("ICS file exceeds the maximum allowed size")
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+async def _prefetch_one(session, bucket, ics_url, feed):
+    if not ics_url:
+        return None
+    if bucket is not None:
+        await bucket.acquire_async()
+    started = time.perf_counter()
+    try:
+        resp = await _open_ics_async(session, ics_url, feed)
+        if resp is None:
+            content, validators = None, feed
+        else:
+            try:
+                content = await _read_body_async(resp)
+                validators = _response_validators(resp)
+            finally:
+                resp.release()
+    except Exception as e:
+        return {"error": e, "seconds": time.perf_counter() - started}
+    return {"content": content, "validators": validators, "seconds": time.perf_counter() - started}
+
+
+async def _prefetch(feeds, concurrency, bucket, on_done=None, stop=None):
+    """
+    Downloads feeds, concurrency at a time, and returns their results in
+    order. With on_done, each result is also passed to on_done(i, result,
+    release) as it arrives, and its slot is only freed once release() is
+    called; downloads not yet started when stop (an Event) is set are
+    skipped.
+    """
+    connector = aiohttp.TCPConnector(
+        resolver=_PinnedResolver(), use_dns_cache=False,
+        limit=concurrency, limit_per_host=ICS_POOL_PER_HOST,
+    )
+    # Per connect and per read, like the requests timeout in _ics_get.
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=HTTP_TIMEOUT, sock_read=HTTP_TIMEOUT)
+    # As with _ics_adapter, no cookies or proxy settings carry over.
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=timeout,
+        cookie_jar=aiohttp.DummyCookieJar(), trust_env=False,
+    ) as session:
+        limit = asyncio.Semaphore(concurrency)
+
+        async def prefetch(i, ics_url, feed):
+            await limit.acquire()
+            if stop is not None and stop.is_set():
+                limit.release()
+                return None
+            try:
+                result = await _prefetch_one(session, bucket, ics_url, feed)
+            except BaseException:
+                limit.release()
+                raise
+            if on_done is None:
+                limit.release()
+            else:
+                on_done(i, result, limit.release)
+            return result
+
+        return await asyncio.gather(*(
+            prefetch(i, ics_url, feed) for i, (ics_url, feed) in enumerate(feeds)
+        ))
+
+
+def prefetch_ics_feeds(feeds, concurrency=None, bucket=None):
+    """
+    Downloads many ICS feeds concurrently on an asyncio event loop, so a bulk
+    sync can fetch a whole batch of users' feeds before any Google writes.
+    Every download gets the _fetch_ics safeguards: SSRF validation of each
+    redirect hop, pinned connections, ICS_MAX_REDIRECTS, ICS_MAX_BYTES and
+    HTTP_TIMEOUT.
+
+    Args:
+        feeds: (ics_url, feed) pairs, feed being the state saved from the
+            last sync (see fetch_ics_events) or None. Pairs without a URL are
+            skipped.
+        concurrency (int): Downloads in flight at once (default
+            ICS_FETCH_CONCURRENCY); ICS_POOL_PER_HOST still caps the
+            connections to any one host.
+        bucket (TokenBucket): Paces the downloads, if given.
+
+    Returns:
+        list: One entry per pair, in order, to hand to fetch_ics_events as
+            prefetched (None for skipped pairs). A failed download is
+            reported there rather than raised.
+    """
+    feeds = list(feeds)
+    if not any(ics_url for ics_url, _ in feeds):
+        return [None] * len(feeds)
+    return asyncio.run(_prefetch(feeds, concurrency or ICS_FETCH_CONCURRENCY, bucket))
+
+
+def iter_prefetched_ics_feeds(feeds, concurrency=None, bucket=None):
+    """
+    Like prefetch_ics_feeds, but yields (index, prefetched) pairs as each
+    download finishes instead of a list once the slowest has. The downloads
+    run on an event loop in a thread of their own. A finished download
+    keeps its slot (of concurrency) until it is taken from here, so a slow
+    consumer pauses new downloads rather than letting feeds pile up in
+    memory. Closing the generator early skips the downloads not yet started.
+    """
+    feeds = list(feeds)
+    results = queue.SimpleQueue()
+    # Guards closed against results arriving while the generator closes.
+    lock = threading.Lock()
+    closed = threading.Event()
+
+    def on_done(i, result, release):
+        loop = asyncio.get_running_loop()
+
+        def release_from_consumer():
+            try:
+                loop.call_soon_threadsafe(release)
+            except RuntimeError:
+                pass  # the loop has closed: every download is over
+
+        with lock:
+            if closed.is_set():
+                release()
+            else:
+                results.put((i, result, release_from_consumer))
+
+    def run():
+        try:
+            asyncio.run(_prefetch(feeds, concurrency or ICS_FETCH_CONCURRENCY, bucket, on_done, closed))
+        except Exception as e:
+            results.put(e)
+
+    threading.Thread(target=run, name="ics-prefetch", daemon=True).start()
+    try:
+        for _ in feeds:
+            item = results.get()
+            if isinstance(item, Exception):
+                raise item
+            i, prefetched, release = item
+            release()
+            yield i, prefetched
+    finally:
+        with lock:
+            closed.set()
+            while not results.empty():
+                item = results.get()
+                if not isinstance(item, Exception):
+                    item[2]()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter. Allows bursts of up to `capacity`
+    calls and refills at `rate_per_minute`; acquire() blocks until a token is
+    available. One instance shared by all worker threads enforces a single
+    global limit, unlike per-function decorators.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1, rate_per_minute // 60)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens):
+        """Takes tokens if available; returns 0, or how long to wait before retrying."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        while True:
+            wait = self._take(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        """acquire() for coroutines: waits without blocking the event loop."""
+        while True:
+            wait = self._take(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+# Emails whose syncs are run under cProfile and tracemalloc (comma-separated,
+# or "*" for everyone). Profiling slows a sync down severalfold; opt in only
+# for the users being investigated.
+SYNC_PROFILE_USERS = frozenset(
+    e.strip().lower() for e in os.getenv("SYNC_PROFILE_USERS", "").split(",") if e.strip()
+)
+# Where full cProfile dumps (<email>-<timestamp>.prof) are written, if set.
+SYNC_PROFILE_DIR = os.getenv("SYNC_PROFILE_DIR")
+# Functions kept in a trace's profile summary, by cumulative time.
+SYNC_PROFILE_TOP = 30
+
+# tracemalloc is process-wide, so profiled syncs run one at a time.
+_profile_lock = threading.Lock()
+
+
+class SyncTrace:
+    """
+    Wall-clock seconds spent in each stage of one user's sync (decrypt,
+    throttle, fetch, parse, token_refresh, list, diff, writes). Pass one to
+    fetch_ics_events / sync_with_tasklist to have their stages recorded.
+
+    With profile=True, profiling() also runs the sync under cProfile and
+    tracemalloc and keeps a summary of the hottest functions and the peak
+    traced memory. tracemalloc sees every thread, so that peak is the whole
+    process's while the sync ran (other syncs and pipeline stages running
+    alongside it included), not the sync's own.
+    """
+
+    def __init__(self, email=None, profile=None):
+        self.email = email
+        if profile is None:
+            profile = bool(email) and ('*' in SYNC_PROFILE_USERS or email.lower() in SYNC_PROFILE_USERS)
+        self.profile = profile
+        self.stages = {}
+        self.profile_summary = None
+        self.process_peak_memory = None
+        self._mark = time.perf_counter()
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def mark(self):
+        """Starts the clock for the next lap()."""
+        self._mark = time.perf_counter()
+
+    def lap(self, stage):
+        """Records the time since the last mark() or lap() under stage."""
+        now = time.perf_counter()
+        self.add(stage, now - self._mark)
+        self._mark = now
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    @contextlib.contextmanager
+    def profiling(self):
+        """Profiles the enclosed code if this trace was opted in; otherwise a no-op."""
+        if not self.profile:
+            yield
+            return
+        with _profile_lock:
+            profiler = cProfile.Profile()
+            tracemalloc.start()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                self.process_peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self._keep_profile(profiler)
+
+    def _keep_profile(self, profiler):
+        stats = pstats.Stats(profiler)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        self.profile_summary = [
+            {
+                "function": f"{filename}:{line}({name})",
+                "calls": ncalls,
+                "tottime": round(tottime, 6),
+                "cumtime": round(cumtime, 6),
+            }
+            for (filename, line, name), (_, ncalls, tottime, cumtime, _) in rows[:SYNC_PROFILE_TOP]
+        ]
+        if SYNC_PROFILE_DIR:
+            safe = re.sub(r'[^A-Za-z0-9_.@-]', '_', self.email or 'user')
+            path = os.path.join(SYNC_PROFILE_DIR, f"{safe}-{int(time.time())}.prof")
+            try:
+                stats.dump_stats(path)
+            except OSError as e:
+                logging.error(f"Failed to write profile to {path}: {str(e)}")
+
+
 def _get_fernet():
     """
     Returns a Fernet built from TOKEN_ENC_KEY, or None if the key is unset or
     invalid. When None, token encryption is a no-op so the app keeps working
     until the key is provisioned (refresh tokens stay plaintext, as before).
+
+    The Fernet is built once per key value and reused, so only a change to
+    TOKEN_ENC_KEY causes it to be rebuilt.
     """
-    key = os.getenv("TOKEN_ENC_KEY")
+    return _fernet_for_key(os.getenv("TOKEN_ENC_KEY"))
+
+
+@functools.lru_cache(maxsize=1)
+def _fernet_for_key(key):
     if not key:
         return None
     try:
@@ -113,25 +710,17 @@ def _get_fernet():
         return None
 
 
-def encrypt_token(plaintext):
-    """Encrypts a refresh token for storage. No-op if no key is configured."""
+def _encrypt_with(fernet, plaintext):
     if plaintext is None:
         return None
-    fernet = _get_fernet()
     if fernet is None:
         return plaintext
     return fernet.encrypt(plaintext.encode()).decode()
 
 
-def decrypt_token(value):
-    """
-    Decrypts a stored refresh token. Transparently passes through values that
-    were stored as plaintext before encryption was enabled (legacy rows), so
-    migration is seamless.
-    """
+def _decrypt_with(fernet, value):
     if value is None:
         return None
-    fernet = _get_fernet()
     if fernet is None:
         return value
     try:
@@ -140,6 +729,32 @@ def decrypt_token(value):
         return value  # legacy plaintext value
 
 
+def encrypt_token(plaintext):
+    """Encrypts a refresh token for storage. No-op if no key is configured."""
+    return _encrypt_with(_get_fernet(), plaintext)
+
+
+def decrypt_token(value):
+    """
+    Decrypts a stored refresh token. Transparently passes through values that
+    were stored as plaintext before encryption was enabled (legacy rows), so
+    migration is seamless.
+    """
+    return _decrypt_with(_get_fernet(), value)
+
+
+def encrypt_many(values):
+    """encrypt_token over a list of values, resolving the key once."""
+    fernet = _get_fernet()
+    return [_encrypt_with(fernet, value) for value in values]
+
+
+def decrypt_many(values):
+    """decrypt_token over a list of values, resolving the key once."""
+    fernet = _get_fernet()
+    return [_decrypt_with(fernet, value) for value in values]
+
+
 def revoke_google_token(token):
     """
     Revokes a Google OAuth grant. Revoking the refresh token invalidates the
@@ -176,11 +791,12 @@ def refresh_oauth_token(oauth_token):
             logging.error("No refresh token available")
             return None
             
-        client_id = oauth_token.get('client_id')
-        client_secret = oauth_token.get('client_secret')
+        # Login tokens don't carry the client; it is the app's own.
+        client_id = oauth_token.get('client_id') or os.getenv("OAUTH_CLIENT_ID")
+        client_secret = oauth_token.get('client_secret') or os.getenv("OAUTH_CLIENT_SECRET")
         
         # Make a refresh token request
-        refresh_url = "https://oauth2.googleapis.com/token"
+        refresh_url = GOOGLE_TOKEN_URI
         payload = {
             'client_id': client_id,
             'client_secret': client_secret,
@@ -190,12 +806,15 @@ def refresh_oauth_token(oauth_token):
         
         response = requests.post(refresh_url, data=payload, timeout=HTTP_TIMEOUT)
         
+        metrics.TOKEN_REFRESHES.labels("ok" if response.status_code == 200 else "failed").inc()
         if response.status_code == 200:
             new_token_data = response.json()
             # Update the token information while keeping the refresh token
+            expires_in = new_token_data.get('expires_in')
             oauth_token.update({
                 'access_token': new_token_data.get('access_token'),
-                'expires_in': new_token_data.get('expires_in'),
+                'expires_in': expires_in,
+                'expires_at': int(time.time()) + int(expires_in) if expires_in else None,
                 'token_type': new_token_data.get('token_type')
             })
             logging.info("OAuth token refreshed successfully")
@@ -205,13 +824,254 @@ def refresh_oauth_token(oauth_token):
             return None
             
     except Exception as e:
+        metrics.TOKEN_REFRESHES.labels("failed").inc()
         logging.error(f"Error refreshing OAuth token: {str(e)}")
         return None
 
+# The latest access token per refresh token (by digest), so one user's
+# concurrent syncs share a refresh; and the locks single-flighting those
+# refreshes, striped by the same digest.
+_access_tokens = TTLCache(maxsize=4096, ttl=3600)
+_refresh_locks = [threading.Lock() for _ in range(64)]
+
+
+def _token_expiry(oauth_token):
+    """oauth_token's 'expires_at' (epoch seconds or a datetime) as an aware datetime, or None."""
+    expires_at = oauth_token.get('expires_at')
+    if expires_at is None:
+        return None
+    if isinstance(expires_at, datetime):
+        return expires_at if expires_at.tzinfo else expires_at.replace(tzinfo=timezone.utc)
+    return datetime.fromtimestamp(float(expires_at), timezone.utc)
+
+
+def token_expires_soon(oauth_token, now=None):
+    """
+    True unless oauth_token has an access token that is valid for more than
+    TOKEN_REFRESH_MARGIN seconds. A token of unknown expiry counts as
+    expiring.
+    """
+    expiry = _token_expiry(oauth_token)
+    if not oauth_token.get('access_token') or expiry is None:
+        return True
+    now = now or datetime.now(timezone.utc)
+    return expiry - now <= timedelta(seconds=TOKEN_REFRESH_MARGIN)
+
+
+def ensure_fresh_token(oauth_token, stale=None):
+    """
+    Makes sure oauth_token holds a usable access token, refreshing it (in
+    place) only when it is within TOKEN_REFRESH_MARGIN of expiring, or when
+    it is the token given as stale (one the API just rejected).
+
+    Refreshes are single-flighted per user: concurrent callers holding the
+    same refresh token wait for one refresh and all use its result.
+
+    Returns:
+        bool: Whether oauth_token now holds a usable access token.
+    """
+    def usable(token):
+        return token.get('access_token') != stale and not token_expires_soon(token)
+
+    if usable(oauth_token):
+        return True
+    refresh_token = oauth_token.get('refresh_token')
+    if not refresh_token:
+        logging.error("No refresh token available")
+        return False
+    key = hashlib.sha256(refresh_token.encode()).hexdigest()
+    with _refresh_locks[int(key[:8], 16) % len(_refresh_locks)]:
+        with _cache_lock:
+            shared = _access_tokens.get(key)
+        if shared is not None and usable(shared):
+            # Another sync refreshed while this one waited.
+            oauth_token.update(shared)
+            metrics.TOKEN_REFRESHES.labels("shared").inc()
+            return True
+        if not refresh_oauth_token(oauth_token):
+            return False
+        with _cache_lock:
+            _access_tokens[key] = {
+                k: oauth_token.get(k) for k in ('access_token', 'expires_in', 'expires_at', 'token_type')
+            }
+    return True
+
+
+def access_token_fields(oauth_token):
+    """The user_auth fields saving oauth_token's access token (encrypted) and its expiry."""
+    return {
+        "access_token": encrypt_token(oauth_token.get('access_token')),
+        "access_token_expires_at": _token_expiry(oauth_token),
+    }
+
+
+class _SharedCredentials(Credentials):
+    """
+    Credentials for one user's service whose refreshes go through
+    ensure_fresh_token. google-auth refreshes by itself, inside
+    AuthorizedHttp and batch requests, when a call gets a 401 or the token
+    has expired; this way those refreshes are single-flighted too, and the
+    new token lands in the caller's oauth_token, where it can be saved.
+    """
+
+    def __init__(self, oauth_token):
+        expiry = _token_expiry(oauth_token)
+        super().__init__(
+            token=oauth_token.get('access_token'),
+            refresh_token=oauth_token.get('refresh_token'),
+            token_uri=GOOGLE_TOKEN_URI,
+            client_id=oauth_token.get('client_id'),
+            client_secret=oauth_token.get('client_secret'),
+            scopes=["https://www.googleapis.com/auth/tasks"],
+            # google-auth compares naive UTC datetimes.
+            expiry=expiry.replace(tzinfo=None) if expiry else None,
+        )
+        self._oauth_token = oauth_token
+
+    def refresh(self, request):
+        if not ensure_fresh_token(self._oauth_token, stale=self.token):
+            raise RefreshError("Failed to refresh the access token")
+        self.token = self._oauth_token['access_token']
+        expiry = _token_expiry(self._oauth_token)
+        self.expiry = expiry.replace(tzinfo=None) if expiry else None
+
+
+@functools.lru_cache(maxsize=None)
+def _tasks_discovery_doc():
+    """
+    The Tasks v1 discovery document, parsed once per process from the copy
+    bundled with google-api-python-client (no network fetch). Treated as
+    read-only; every service built from it shares the same dict.
+
+    With GOOGLE_TASKS_ROOT_URL set, the document is re-rooted there, batch
+    endpoint included.
+    """
+    doc = json.loads(discovery_cache.get_static_doc("tasks", "v1"))
+    if GOOGLE_TASKS_ROOT_URL:
+        root = GOOGLE_TASKS_ROOT_URL.rstrip('/') + '/'
+        doc.update(rootUrl=root, mtlsRootUrl=root, baseUrl=root + doc['servicePath'])
+    return doc
+
+
+def _api_status(error):
+    """Status label for a Google API call's outcome: its HTTP status, or 'error'."""
+    if error is None:
+        return "200"
+    if isinstance(error, HttpError):
+        return str(error.resp.status)
+    return "error"
+
+
+# Retries of a throttled Google call (429, or 403 rateLimitExceeded /
+# userRateLimitExceeded), with exponential backoff and full jitter between
+# GOOGLE_BACKOFF_BASE and GOOGLE_BACKOFF_MAX seconds.
+GOOGLE_MAX_RETRIES = 5
+GOOGLE_BACKOFF_BASE = 1.0
+GOOGLE_BACKOFF_MAX = 64.0
+
+_RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+
+# Paces every Google Tasks call; see set_google_rate_limiter.
+_google_limiter = None
+
+
+def set_google_rate_limiter(limiter):
+    """
+    Installs the limiter all Google Tasks calls are paced by: an object with
+    acquire(calls), which blocks until that many calls may be made, and
+    throttled(), called whenever Google answers with a rate-limit error
+    (see sync_store.SharedRateLimiter). None turns pacing off; throttled
+    calls are still retried with backoff.
+    """
+    global _google_limiter
+    _google_limiter = limiter
+
+
+def _acquire_google_calls(calls):
+    if _google_limiter is not None and calls:
+        _google_limiter.acquire(calls)
+
+
+def _is_rate_limited(error):
+    """True for the errors Google uses to say 'slow down'."""
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    if error.resp.status != 403:
+        return False
+    try:
+        details = json.loads(error.content).get('error', {})
+    except (ValueError, AttributeError, TypeError):
+        return False
+    return any(e.get('reason') in _RATE_LIMIT_REASONS for e in details.get('errors', []))
+
+
+def _is_transient(error):
+    """Server (5xx) and network errors, worth retrying as they are."""
+    if isinstance(error, HttpError):
+        return error.resp.status >= 500
+    return isinstance(error, OSError)
+
+
+def _on_rate_limited(attempt):
+    """Tells the limiter Google pushed back, then sleeps out the backoff for attempt."""
+    if _google_limiter is not None:
+        _google_limiter.throttled()
+    delay = random.uniform(0, min(GOOGLE_BACKOFF_MAX, GOOGLE_BACKOFF_BASE * 2 ** attempt))
+    metrics.GOOGLE_BACKOFF_SECONDS.inc(delay)
+    time.sleep(delay)
+
+
+class _MeteredHttpRequest(HttpRequest):
+    """
+    HttpRequest that paces each execution against the shared Google budget,
+    retries throttled calls with backoff, and records every attempt in the
+    Google API metrics. num_retries covers server errors (5xx) and network
+    errors, as in the stock client.
+    """
+
+    def execute(self, http=None, num_retries=0):
+        throttled = 0
+        failed = 0
+        while True:
+            _acquire_google_calls(1)
+            started = time.perf_counter()
+            error = None
+            try:
+                return super().execute(http=http, num_retries=0)
+            except Exception as e:
+                error = e
+            finally:
+                metrics.GOOGLE_API_CALLS.labels(self.methodId, _api_status(error)).inc()
+                metrics.GOOGLE_API_SECONDS.labels(self.methodId).observe(time.perf_counter() - started)
+
+            if _is_rate_limited(error) and throttled < GOOGLE_MAX_RETRIES:
+                _on_rate_limited(throttled)
+                throttled += 1
+            elif _is_transient(error) and failed < num_retries:
+                time.sleep(random.uniform(0, GOOGLE_BACKOFF_BASE * 2 ** failed))
+                failed += 1
+            else:
+                raise error
+
+
+def _build_tasks_service(oauth_token):
+    """Builds a Tasks service for one user's token from the cached document."""
+    return build_from_document(
+        _tasks_discovery_doc(), credentials=_SharedCredentials(oauth_token),
+        requestBuilder=_MeteredHttpRequest,
+    )
+
+
 def get_tasks_service(oauth_token):
     """
     Creates and returns an authenticated Google Tasks API service.
-    Handles token refresh if the current token is invalid.
+
+    The access token is refreshed first only if it is about to expire (see
+    ensure_fresh_token). A 401 later on refreshes it once more, through the
+    service's credentials; either way the new token is written into
+    oauth_token.
     
     Args:
         oauth_token (dict): OAuth token from Google authentication
@@ -220,57 +1080,14 @@ def get_tasks_service(oauth_token):
         tuple: (service object, updated oauth_token)
     """
     try:
-        # Create credentials from OAuth token
-        creds = Credentials(
-            token=oauth_token.get('access_token'),
-            refresh_token=oauth_token.get('refresh_token'),
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=oauth_token.get('client_id'),
-            client_secret=oauth_token.get('client_secret'),
-            scopes=["https://www.googleapis.com/auth/tasks"]
-        )
-        
-        # Build the service
-        service = build("tasks", "v1", credentials=creds)
-        
-        # Make a simple API call to verify the token is valid
-        service.tasklists().list(maxResults=1).execute()
-        
-        # If we get here, the token is valid
-        return service, oauth_token
-        
-    except HttpError as err:
-        if err.resp.status in [401, 403]:
-            logging.info("Authentication error. Attempting to refresh token...")
-            refreshed_token = refresh_oauth_token(oauth_token)
-            
-            if refreshed_token:
-                # Try again with the refreshed token
-                try:
-                    creds = Credentials(
-                        token=refreshed_token.get('access_token'),
-                        refresh_token=refreshed_token.get('refresh_token'),
-                        token_uri="https://oauth2.googleapis.com/token",
-                        client_id=refreshed_token.get('client_id'),
-                        client_secret=refreshed_token.get('client_secret'),
-                        scopes=["https://www.googleapis.com/auth/tasks"]
-                    )
-                    service = build("tasks", "v1", credentials=creds)
-                    service.tasklists().list(maxResults=1).execute()
-                    return service, refreshed_token
-                except Exception as e:
-                    logging.error(f"Still failed after token refresh: {str(e)}")
-                    raise
-            else:
-                logging.error("Token refresh failed")
-                raise
-        else:
-            logging.error(f"HTTP Error: {str(err)}")
-            raise
+        if not ensure_fresh_token(oauth_token):
+            raise RefreshError("Failed to refresh the access token")
+        return _build_tasks_service(oauth_token), oauth_token
     except Exception as err:
         logging.error(f"Error creating Google Tasks service: {str(err)}")
         raise
 
+
 def convert_to_rfc3339(event_start):
     """
     Converts event_start (which can be a datetime.date or datetime.datetime)
@@ -321,32 +1138,374 @@ def get_ics_events(ics_url: str) -> list[dict]:
     Returns:
         dict: A dictionary containing the parsed events.
     """
+    events, _ = fetch_ics_events(ics_url)
+    return events
+
+
+def fetch_ics_events(ics_url, feed=None, trace=None, prefetched=None):
+    """
+    Like get_ics_events, but skips the parse when the feed is unchanged since
+    the last successful sync.
+
+    Args:
+        ics_url (str): The URL of the ICS file to fetch.
+        feed (dict): State saved from the last successful sync of this feed:
+            the cache validators ('etag', 'last_modified') and the content
+            'fingerprint'. None forces a full fetch and parse.
+        trace (SyncTrace): Receives the 'fetch' and 'parse' stage timings.
+        prefetched: This feed's entry from prefetch_ics_feeds (or
+            parse_prefetched), if it was already downloaded; the feed is then
+            not fetched again.
+
+    Returns:
+        tuple: (events, feed). events is None when the feed is unchanged
+            (the server answered 304, or the content fingerprint matched), in
+            which case the whole sync can be skipped. feed is the new state to
+            save once the sync has succeeded.
+    """
+    trace = trace if trace is not None else SyncTrace()
+    if prefetched is not None:
+        return _prefetched_events(feed, trace, prefetched)
 
     # Fetch the .ics file safely (SSRF-validated, timed out, size-capped)
-    content = _fetch_ics(ics_url)
+    started = time.perf_counter()
+    try:
+        resp = _open_ics(ics_url, feed)
+    except Exception:
+        metrics.ICS_FETCH_SECONDS.labels("error").observe(time.perf_counter() - started)
+        trace.add('fetch', time.perf_counter() - started)
+        raise
+    opened = time.perf_counter() - started
+    if resp is None:
+        metrics.ICS_FETCH_SECONDS.labels("not_modified").observe(opened)
+        trace.add('fetch', opened)
+        logging.debug("ICS feed not modified since last fetch")
+        return None, feed
+
+    # Seconds spent waiting on body reads, and bytes read; the rest of the
+    # time a streaming parse takes is parse time.
+    reads = [0.0, 0]
+    fetch_recorded = False
+    try:
+        validators = _response_validators(resp)
+        parse_started = time.perf_counter()
+        body = _timed_chunks(_iter_body(resp), reads)
+        if ICS_STREAM_PARSE and not (feed and feed.get('fingerprint')):
+            # Nothing to compare the feed against, so it is parsed whatever
+            # it holds: parse while downloading, without holding the raw
+            # feed, computing the fingerprint from the same stream of lines.
+            hasher = _FeedHasher()
+            content = None
+            events = list(_iter_vevents(hasher.tap(_iter_lines(body))))
+            fingerprint = hasher.hexdigest()
+            parse_seconds = time.perf_counter() - parse_started - reads[0]
+            metrics.ICS_PARSE_SECONDS.observe(parse_seconds)
+            metrics.ICS_EVENTS.observe(len(events))
+            # Stages are recorded in the order they end: the download ends
+            # before its parse does.
+            trace.add('fetch', opened + reads[0])
+            fetch_recorded = True
+            trace.add('parse', parse_seconds)
+        else:
+            # Fingerprint before parsing, so an unchanged feed is never
+            # parsed (see _changed_events).
+            content = b''.join(body)
+            fingerprint = feed_fingerprint(content)
+            events = None
+    except Exception:
+        metrics.ICS_FETCH_SECONDS.labels("error").observe(opened + reads[0])
+        raise
+    finally:
+        resp.close()
+        if not fetch_recorded:
+            trace.add('fetch', opened + reads[0])
+
+    # Many hosts send no useful validators, so also compare the content.
+    state = dict(validators or {}, fingerprint=fingerprint)
+    return _changed_events(feed, state, opened + reads[0], reads[1], trace, events, content)
+
+
+def parse_prefetched(prefetched, feed=None):
+    """
+    The CPU-bound part of fetch_ics_events for a prefetched feed: computes
+    its fingerprint and, unless that matches feed's, parses its events. It
+    touches no shared state or metrics, so it can run in a process pool;
+    hand the result to fetch_ics_events as prefetched.
+
+    Returns:
+        dict: prefetched with the raw 'content' replaced by its 'size',
+            'fingerprint', 'events' (None when unchanged) and
+            'parse_seconds'. Failed, not-modified and already parsed entries
+            are returned as they are.
+    """
+    if not prefetched or prefetched.get('content') is None:
+        return prefetched
+    parsed = {k: v for k, v in prefetched.items() if k != 'content'}
+    content = prefetched['content']
+    parsed.update(size=len(content), fingerprint=feed_fingerprint(content), events=None, parse_seconds=0.0)
+    # Fingerprint before parsing, so an unchanged feed is never parsed.
+    if not (feed and feed.get('fingerprint') == parsed['fingerprint']):
+        started = time.perf_counter()
+        parsed['events'] = _parse_buffered(content)
+        parsed['parse_seconds'] = time.perf_counter() - started
+    return parsed
+
+
+def _parse_buffered(content):
+    """Parses a downloaded feed's bytes with the parser ICS_STREAM_PARSE selects."""
+    return list(iter_ics_events((content,))) if ICS_STREAM_PARSE else _parse_ics(content)
+
+
+def _prefetched_events(feed, trace, prefetched):
+    """fetch_ics_events for a feed prefetch_ics_feeds already downloaded."""
+    seconds = prefetched['seconds']
+    trace.add('fetch', seconds)
+    if prefetched.get('error') is not None:
+        metrics.ICS_FETCH_SECONDS.labels("error").observe(seconds)
+        raise prefetched['error']
+    if prefetched.get('content') is None and 'fingerprint' not in prefetched:
+        metrics.ICS_FETCH_SECONDS.labels("not_modified").observe(seconds)
+        logging.debug("ICS feed not modified since last fetch")
+        return None, feed
+    parsed = parse_prefetched(prefetched, feed)
+    if parsed['events'] is not None:
+        metrics.ICS_PARSE_SECONDS.observe(parsed['parse_seconds'])
+        metrics.ICS_EVENTS.observe(len(parsed['events']))
+        trace.add('parse', parsed['parse_seconds'])
+    state = dict(parsed['validators'] or {}, fingerprint=parsed['fingerprint'])
+    return _changed_events(feed, state, seconds, parsed['size'], trace, parsed['events'])
+
+
+def _changed_events(feed, state, seconds, size, trace, events=None, content=None):
+    """
+    The end of fetch_ics_events once a feed is downloaded: (None, state) if
+    its fingerprint matches feed's, else its events (parsing the buffered
+    content unless they were already parsed) and the new state.
+    """
+    unchanged = bool(feed) and feed.get('fingerprint') == state['fingerprint']
+    metrics.ICS_FETCH_SECONDS.labels("unchanged" if unchanged else "ok").observe(seconds)
+    metrics.ICS_FETCH_BYTES.observe(size)
+    if unchanged:
+        logging.debug("ICS feed content unchanged since last sync")
+        # Keep the recorded outcome; only the validators may have moved.
+        return None, dict(feed, **state)
+    if events is None:
+        parse_started = time.perf_counter()
+        events = _parse_buffered(content)
+        parse_seconds = time.perf_counter() - parse_started
+        metrics.ICS_PARSE_SECONDS.observe(parse_seconds)
+        metrics.ICS_EVENTS.observe(len(events))
+        trace.add('parse', parse_seconds)
+    return events, state
+
+
+def _timed_chunks(chunks, reads):
+    """Yields chunks, adding the time waited for each to reads[0] and its size to reads[1]."""
+    chunks = iter(chunks)
+    while True:
+        started = time.perf_counter()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            reads[0] += time.perf_counter() - started
+            return
+        reads[0] += time.perf_counter() - started
+        reads[1] += len(chunk)
+        yield chunk
+
+
+def sync_counts(result):
+    """The added / updated / skipped / error counts from a sync_with_tasklist result."""
+    return {
+        "task_count": result.get('task_count', 0),
+        "updated_count": result.get('updated_count', 0),
+        "skipped_count": result.get('skipped_count', 0),
+        "error_count": result.get('error_count', 0),
+    }
+
+
+def upcoming_deadlines(events, now=None, limit=10):
+    """
+    The next `limit` due times in a feed, as sorted UTC datetimes after now.
+    An event is due at its end (or else its start); a date-only event is
+    due at the end of that day. The scheduler keeps these to sync users more
+    often as a deadline nears, even while their feed is unchanged.
+    """
+    now = now or datetime.now(timezone.utc)
+    deadlines = set()
+    for event in events:
+        when = event.get('end') or event.get('start')
+        if isinstance(when, datetime):
+            due = when if when.tzinfo else when.replace(tzinfo=timezone.utc)
+            due = due.astimezone(timezone.utc)
+        elif isinstance(when, date):
+            due = datetime.combine(when, datetime.min.time(), timezone.utc) + timedelta(days=1)
+        else:
+            continue
+        if due > now:
+            deadlines.add(due)
+    return sorted(deadlines)[:limit]
+
+
+def feed_after_sync(feed, result):
+    """
+    Returns the feed state to save after sync_with_tasklist ran, with the
+    sync's counts recorded as its outcome. Returns None when some writes
+    failed, so the next run re-syncs instead of treating the feed as done.
+    """
+    if not feed or result.get('error_count'):
+        return None
+    return dict(feed, outcome=dict(sync_counts(result), synced_at=datetime.now(timezone.utc)))
+
+
+# Properties that change on every render of a feed even when none of its
+# events did; they are left out of the fingerprint.
+_VOLATILE_ICS_PROPS = (b'DTSTAMP',)
+
+
+def _is_volatile_line(line):
+    name = re.split(rb'[;:]', line, maxsplit=1)[0].upper()
+    return name in _VOLATILE_ICS_PROPS
+
+
+class _FeedHasher:
+    """
+    Incremental feed fingerprint over physical ICS lines. Volatile properties
+    (and their folded continuation lines) are skipped so an unchanged feed
+    always hashes the same.
+    """
+
+    def __init__(self):
+        self._digest = hashlib.sha256()
+        self._skipping = False
+
+    def update(self, line):
+        if line[:1] in (b' ', b'\t'):
+            # Folded continuation of the previous property line
+            if not self._skipping:
+                self._digest.update(line)
+            return
+        self._skipping = _is_volatile_line(line)
+        if not self._skipping:
+            self._digest.update(b'\n')
+            self._digest.update(line)
+
+    def tap(self, lines):
+        """Passes lines through unchanged, hashing each on the way."""
+        for line in lines:
+            self.update(line)
+            yield line
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+def feed_fingerprint(content):
+    """Returns the SHA-256 hex fingerprint of raw ICS bytes (see _FeedHasher)."""
+    hasher = _FeedHasher()
+    for line in _iter_lines((content,)):
+        hasher.update(line)
+    return hasher.hexdigest()
+
+
+def _iter_lines(chunks):
+    """Splits a stream of byte chunks into physical lines, without terminators."""
+    # Pieces of the line still being read; joined once it ends, so a line
+    # spread over many chunks costs no more than its length to assemble.
+    pending = []
+    for chunk in chunks:
+        lines = chunk.split(b'\n')
+        if len(lines) == 1:
+            pending.append(chunk)
+            continue
+        pending.append(lines[0])
+        lines[0] = b''.join(pending)
+        pending = [lines.pop()]
+        for line in lines:
+            yield line[:-1] if line.endswith(b'\r') else line
+    tail = b''.join(pending)
+    if tail:
+        yield tail[:-1] if tail.endswith(b'\r') else tail
+
+
+def _iter_unfolded(lines):
+    """Joins RFC 5545 folded continuation lines back onto their property."""
+    current = None
+    for line in lines:
+        if line[:1] in (b' ', b'\t'):
+            if current is not None:
+                current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def _iter_vevents(lines):
+    """
+    Yields event dicts from physical ICS lines one VEVENT at a time. Only the
+    lines of the event being read are held, so memory stays flat no matter how
+    large the feed is. Each block is parsed by icalendar itself, so values
+    come out exactly as in _parse_ics.
+
+    VTIMEZONE blocks are parsed too, which registers the feed's own TZIDs
+    with icalendar just as a whole-calendar parse does; without them an
+    event in a non-Olson zone would come out as a naive datetime.
+    """
+    block = None
+    end = None
+    for line in _iter_unfolded(lines):
+        tag = line.strip().upper() if line[:1] in b'BbEe' else b''
+        if block is None:
+            if tag in (b'BEGIN:VEVENT', b'BEGIN:VTIMEZONE'):
+                block = [line]
+                end = b'END:' + tag[6:]
+            continue
+        block.append(line)
+        if tag == end:
+            if end == b'END:VEVENT':
+                yield _event_from_component(Event.from_ical(b'\r\n'.join(block)))
+            else:
+                Timezone.from_ical(b'\r\n'.join(block))
+            block = None
+
 
-    # Parse the ICS content
+def iter_ics_events(chunks):
+    """
+    Streaming parser: yields events (same fields as get_ics_events) from an
+    iterable of raw byte chunks, e.g. a response's iter_content().
+    """
+    return _iter_vevents(_iter_lines(chunks))
+
+
+def _event_from_component(component):
+    """Maps a VEVENT component to the event dict the sync consumes."""
+    return {
+        "summary": str(component.get('summary')) if component.get('summary') else None,
+        "start": component.get('dtstart').dt if component.get('dtstart') else None,
+        "end": component.get('dtend').dt if component.get('dtend') else None,
+        "location": str(component.get('location')) if component.get('location') else None,
+        "description": str(component.get('description')) if component.get('description') else None,
+        # Stable identity for upsert matching. Canvas emits a UID like
+        # "event-assignment-1813708" that does NOT change when the due
+        # date moves, so it is the correct dedup key. recurrence_id
+        # distinguishes individually-edited instances of a series.
+        "uid": str(component.get('uid')) if component.get('uid') else None,
+        "recurrence_id": str(component.get('recurrence-id')) if component.get('recurrence-id') else None,
+    }
+
+
+def _parse_ics(content):
+    """Parses raw ICS bytes into the list of event dicts the sync consumes."""
     cal = Calendar.from_ical(content)
     
     events = []
     
     for component in cal.walk():
         if component.name == "VEVENT":
-            event = {
-                "summary": str(component.get('summary')) if component.get('summary') else None,
-                "start": component.get('dtstart').dt if component.get('dtstart') else None,
-                "end": component.get('dtend').dt if component.get('dtend') else None,
-                "location": str(component.get('location')) if component.get('location') else None,
-                "description": str(component.get('description')) if component.get('description') else None,
-                # Stable identity for upsert matching. Canvas emits a UID like
-                # "event-assignment-1813708" that does NOT change when the due
-                # date moves, so it is the correct dedup key. recurrence_id
-                # distinguishes individually-edited instances of a series.
-                "uid": str(component.get('uid')) if component.get('uid') else None,
-                "recurrence_id": str(component.get('recurrence-id')) if component.get('recurrence-id') else None,
-            }
-                
-            events.append(event)
+            events.append(_event_from_component(component))
     
     logging.debug(f"Parsed {len(events)} events from ICS file")
     return events
@@ -408,7 +1567,7 @@ def insert_into_tasklist(oauth_token, events, include_past_events=True):
         tasklist = {
             'title': f'dot_tasklist'
         }
-        result = service.tasklists().insert(body=tasklist).execute()
+        result = service.tasklists().insert(body=tasklist, fields=TASKLIST_FIELDS).execute()
         tasklist_id = result['id']
         tasklist_title = result['title']
 
@@ -449,7 +1608,9 @@ def insert_into_tasklist(oauth_token, events, include_past_events=True):
             
             # Insert the task with error handling
             try:
-                service.tasks().insert(tasklist=tasklist_id, body=validated_task).execute()
+                service.tasks().insert(
+                    tasklist=tasklist_id, body=validated_task, fields='id'
+                ).execute()
                 task_count += 1
                 logging.info(f"Added task: {validated_task['title']} due: {validated_task.get('due')}")
             except HttpError as insert_err:
@@ -551,7 +1712,303 @@ def _match_title(title):
     return title.strip().lower()
 
 
-def sync_with_tasklist(oauth_token, events, include_past_events=True):
+# Max calls per Google API batch request. The API accepts up to 1000, but the
+# Tasks backend handles each sub-call separately and throttles large batches,
+# so smaller batches keep failures (and retries) cheap.
+BATCH_SIZE = 50
+
+
+def _execute_batched(service, requests_):
+    """
+    Executes Google API requests in batches of up to BATCH_SIZE calls.
+
+    Every sub-request counts against the shared Google budget. A sub-request
+    that fails inside a batch with a rate-limit or server error is retried on
+    its own, with backoff (see _MeteredHttpRequest), before its error is
+    reported; other errors (400, 404, ...) are reported as they are.
+
+    When a whole batch fails (a timeout, say) Google may still have applied
+    it, so only its idempotent calls (gets, patches) are retried. Inserts
+    keep the batch's error: the sync counts them as failed, which makes the
+    next sync re-list the tasklist, where any insert that did land is
+    recognised by its uid marker instead of being added twice.
+
+    Args:
+        service: The Google Tasks API service the requests were built from
+        requests_ (list): HttpRequest objects, not yet executed
+
+    Returns:
+        list: (response, error) pairs aligned with requests_; exactly one of
+            the two is None for each entry.
+    """
+    results = [None] * len(requests_)
+    # Calls whose whole batch failed, so whose outcome is unknown.
+    unknown = set()
+
+    for start in range(0, len(requests_), BATCH_SIZE):
+        chunk = requests_[start:start + BATCH_SIZE]
+
+        def callback(request_id, response, exception, start=start):
+            results[start + int(request_id)] = (response, exception)
+            method = getattr(requests_[start + int(request_id)], 'methodId', None)
+            metrics.GOOGLE_API_CALLS.labels(method, _api_status(exception)).inc()
+
+        batch = service.new_batch_http_request(callback=callback)
+        for offset, req in enumerate(chunk):
+            batch.add(req, request_id=str(offset))
+        _acquire_google_calls(len(chunk))
+        started = time.perf_counter()
+        try:
+            batch.execute()
+        except Exception as batch_err:
+            logging.warning(f"Batch request failed, retrying idempotent calls individually: {str(batch_err)}")
+            for i in range(start, start + len(chunk)):
+                if results[i] is None:
+                    results[i] = (None, batch_err)
+                    unknown.add(i)
+        finally:
+            metrics.GOOGLE_API_SECONDS.labels("batch").observe(time.perf_counter() - started)
+
+    if any(_is_rate_limited(error) for _, error in results):
+        # Back off once before the individual retries rather than letting
+        # each of them run into the limit first.
+        _on_rate_limited(0)
+
+    for i, (response, error) in enumerate(results):
+        if error is None:
+            continue
+        # An insert is only repeated when Google said it failed; a timeout
+        # can hide one that was applied.
+        idempotent = requests_[i].method != 'POST'
+        if i in unknown:
+            if not idempotent:
+                continue
+        elif not (_is_rate_limited(error) or _is_transient(error)):
+            continue
+        try:
+            results[i] = (requests_[i].execute(num_retries=2 if idempotent else 0), None)
+        except Exception as retry_err:
+            results[i] = (None, retry_err)
+
+    return results
+
+
+# Partial-response field masks. The sync only ever reads these fields, so
+# everything else (links, selfLink, etags, ...) is never sent back.
+TASK_FIELDS = 'id,title,due,deleted'
+TASKLIST_FIELDS = 'id,title'
+
+# Saved task state is trusted for incremental listings for this long; after
+# that the next sync lists everything again, healing any drift.
+TASKS_STATE_MAX_AGE = timedelta(days=7)
+# updatedMin is moved back this much to cover clock skew against Google.
+TASKS_STATE_CLOCK_SKEW = timedelta(minutes=5)
+
+
+def _as_utc(value):
+    """Mongo hands datetimes back naive (in UTC); make them aware."""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def _state_usable(state, tasklist_id, now):
+    """True if saved task state can seed an incremental listing of tasklist_id."""
+    if not state or state.get('tasklist_id') != tasklist_id or not state.get('listed_at'):
+        return False
+    return now - _as_utc(state['listed_at']) < TASKS_STATE_MAX_AGE
+
+
+def _task_entry(task):
+    """
+    Reduces an API task to what the sync works from: id, embedded uid, title
+    and due. Notes are kept only on marker-less (legacy) tasks, the only ones
+    whose notes the sync may rewrite.
+    """
+    uid = extract_uid(task.get('notes'))
+    entry = {'id': task['id'], 'uid': uid, 'title': task.get('title'), 'due': task.get('due')}
+    if uid is None:
+        entry['notes'] = task.get('notes', '')
+    return entry
+
+
+def _list_tasks(service, tasklist_id, updated_min=None, with_notes=True):
+    """
+    Lists every task in a tasklist, completed and hidden ones included. With
+    updated_min, lists only tasks changed since then, deleted ones included
+    (flagged 'deleted') so they can be dropped from saved state. Notes, by far
+    the largest field, are left out unless with_notes is set.
+    """
+    fields = TASK_FIELDS + ',notes' if with_notes else TASK_FIELDS
+    params = {
+        'tasklist': tasklist_id,
+        'showCompleted': True,
+        'showHidden': True,
+        'maxResults': 100,
+        'fields': f'nextPageToken,items({fields})',
+    }
+    if updated_min is not None:
+        params['updatedMin'] = updated_min.isoformat()
+        params['showDeleted'] = True
+
+    tasks = []
+    page_token = None
+    while True:
+        tasks_result = service.tasks().list(pageToken=page_token, **params).execute()
+        tasks.extend(tasks_result.get('items', []))
+        page_token = tasks_result.get('nextPageToken')
+        if not page_token:
+            return tasks
+
+
+def plan_sync(events, existing_tasks, today, include_past_events=True):
+    """
+    Works out the writes that bring a tasklist in line with the feed, without
+    calling the API. Each event is matched by UID, or else adopts a legacy
+    (pre-UID) task by title, exactly as the sync has always done; the result
+    is an explicit plan the caller can execute however it likes.
+
+    Events that repeat a task already planned in this run are folded into
+    that task's write, so every task gets at most one insert or one patch.
+
+    Args:
+        events (list): Event dicts as returned by get_ics_events
+        existing_tasks (iterable): Known tasks as _task_entry dicts. They are
+            not modified.
+        today (date): Inserts due before this are skipped unless
+            include_past_events is set
+        include_past_events (bool): Whether to insert events whose due date is
+            in the past. Updates to already-tracked tasks happen regardless.
+
+    Returns:
+        dict: 'inserts' ({'body', 'uid'} per task to create), 'patches'
+            ({'id', 'patch', 'title', 'tag_uid'} per task to update; tag_uid
+            is set when the task's notes still have to be fetched to add the
+            uid marker), and the 'skipped' / 'errors' event counts.
+    """
+    inserts = []
+    patches = []
+    skipped = 0
+    errors = 0
+
+    # Planned state of every task, with its due date and normalized title
+    # worked out once, indexed by embedded UID (the real key) and by
+    # normalized title (legacy fallback to adopt pre-UID tasks once).
+    by_uid = {}
+    by_title = {}
+    for task in existing_tasks:
+        planned = dict(task, due_date=_due_date_part(task.get('due')), op=None)
+        if planned['uid']:
+            by_uid[planned['uid']] = planned
+        if planned.get('title'):
+            by_title.setdefault(_match_title(planned['title']), planned)
+
+    for event in events:
+        try:
+            key = event_key(event)
+            title = event['summary'] if event['summary'] is not None else 'Untitled Event'
+            description = event['description'] if event['description'] is not None else ''
+            match_title = _match_title(title)
+
+            # Desired due date (Canvas assignments only carry a start date)
+            due = None
+            if event['end']:
+                due = convert_to_rfc3339(event['end'])
+            elif event['start']:
+                due = convert_to_rfc3339(event['start'])
+            due_date = _due_date_part(due)
+
+            # Locate an existing task: prefer the UID match, otherwise adopt
+            # a legacy task that matches by title and has no marker yet.
+            existing = by_uid.get(key) if key else None
+            adopt_legacy = False
+            if existing is None:
+                candidate = by_title.get(match_title)
+                if candidate is not None and candidate['uid'] is None:
+                    existing, adopt_legacy = candidate, True
+
+            if existing is not None:
+                # UPDATE path — always allowed, even if the due date moved
+                # into the past (correcting exactly that is the point).
+                changes = {}
+                if existing.get('title') != title:
+                    changes['title'] = title
+                if due and existing['due_date'] != due_date:
+                    changes['due'] = due
+                tag_uid = key if adopt_legacy and key else None
+
+                op = existing['op']
+                if not changes and not tag_uid:
+                    skipped += 1
+                    logging.info(f"No change for task: {title}")
+                    continue
+                if op is not None and 'body' in op:
+                    # Still to be created: fold the change into the insert.
+                    body = dict(op['body'], **changes)
+                    if tag_uid:
+                        body['notes'] = with_uid_marker(body.get('notes'), tag_uid)
+                        op['uid'] = tag_uid
+                    op['body'] = validate_task(body)
+                    changes = {k: op['body'].get(k) for k in changes}
+                    skipped += 1
+                else:
+                    if op is None:
+                        op = {'id': existing['id'], 'patch': {}, 'title': title, 'tag_uid': None}
+                        existing['op'] = op
+                        patches.append(op)
+                    else:
+                        skipped += 1
+                    op['patch'].update(changes)
+                    if tag_uid:
+                        # Tag the legacy task so future syncs match it by UID,
+                        # keeping the user's text intact. Saved state has no
+                        # notes; the executor fetches them first.
+                        if 'notes' in existing:
+                            op['patch']['notes'] = with_uid_marker(existing['notes'], tag_uid)
+                        else:
+                            op['tag_uid'] = tag_uid
+
+                existing.update(changes)
+                if 'due' in changes:
+                    existing['due_date'] = due_date
+                if tag_uid:
+                    existing['uid'] = tag_uid
+                    by_uid[tag_uid] = existing
+            else:
+                # INSERT path — only here do we honor include_past_events.
+                if not include_past_events and due_date is not None and due_date < today:
+                    skipped += 1
+                    continue
+
+                task = {
+                    'title': title,
+                    'notes': with_uid_marker(description, key),
+                    'status': 'needsAction'
+                }
+                if due:
+                    task['due'] = due
+
+                op = {'body': validate_task(task), 'uid': key}
+                inserts.append(op)
+                # Index the planned task right away so later events in this
+                # run match it exactly as they would a created task.
+                planned = {
+                    'id': None,
+                    'uid': key,
+                    'title': op['body']['title'],
+                    'due': op['body'].get('due'),
+                    'due_date': _due_date_part(op['body'].get('due')),
+                    'op': op,
+                }
+                if key:
+                    by_uid[key] = planned
+                by_title.setdefault(match_title, planned)
+        except Exception as task_err:
+            errors += 1
+            logging.error(f"Error processing event: {str(task_err)}")
+
+    return {"inserts": inserts, "patches": patches, "skipped": skipped, "errors": errors}
+
+
+def sync_with_tasklist(oauth_token, events, include_past_events=True, state=None, trace=None):
     """
     Upserts events into the 'dot_tasklist' in Google Tasks.
 
@@ -560,7 +2017,9 @@ def sync_with_tasklist(oauth_token, events, include_past_events=True):
     patched if they changed in Canvas (e.g. an assignment was rescheduled). With
     no match, the event is inserted as a new task. Tasks created before UID
     embedding existed are adopted on a one-time normalized-title match and then
-    tagged, so existing users don't get everything duplicated.
+    tagged, so existing users don't get everything duplicated. The matching is
+    done up front by plan_sync; this function only lists the tasklist and
+    sends the planned writes in batches.
 
     Args:
         oauth_token (dict): OAuth token from Google authentication
@@ -568,154 +2027,136 @@ def sync_with_tasklist(oauth_token, events, include_past_events=True):
         include_past_events (bool): Whether to insert events whose due date is in
             the past. Updates to already-tracked tasks happen regardless, so a
             date that slips into the past is still corrected.
+        state (dict): The 'tasks_state' returned by the previous sync for this
+            user. When given (and fresh enough), only tasks changed since then
+            are listed instead of the whole tasklist.
+        trace (SyncTrace): Receives the 'list', 'diff' and 'writes' stage
+            timings.
 
     Returns:
-        dict: Counts of added / updated / skipped tasks for the sync operation.
+        dict: Counts of added / updated / skipped tasks for the sync operation,
+            plus the 'tasks_state' to pass to the next sync.
     """
+    trace = trace if trace is not None else SyncTrace()
+    trace.mark()
     try:
         # Get an authenticated service with token refresh handling
         service, updated_token = get_tasks_service(oauth_token)
 
         # Find the dot_tasklist
-        tasklists = service.tasklists().list().execute()
+        tasklists = service.tasklists().list(fields=f'items({TASKLIST_FIELDS})').execute()
         dot_tasklist_id = None
         for tasklist in tasklists.get('items', []):
             if tasklist['title'] == 'dot_tasklist':
                 dot_tasklist_id = tasklist['id']
                 break
 
-        # If dot_tasklist doesn't exist, create it
+        # Known tasks by id, as _task_entry dicts. Incremental mode starts
+        # from the saved map and fetches only what changed since it was saved.
+        listed_at = datetime.now(timezone.utc)
+        entries = {}
         if not dot_tasklist_id:
+            # If dot_tasklist doesn't exist, create it
             tasklist = {'title': 'dot_tasklist'}
-            result = service.tasklists().insert(body=tasklist).execute()
+            result = service.tasklists().insert(body=tasklist, fields=TASKLIST_FIELDS).execute()
             dot_tasklist_id = result['id']
-            existing_tasks = []
+        elif _state_usable(state, dot_tasklist_id, listed_at):
+            entries = {e['id']: dict(e) for e in state['tasks']}
+            since = _as_utc(state['listed_at']) - TASKS_STATE_CLOCK_SKEW
+            # Changed tasks we already know by uid only need title and due;
+            # notes are fetched just for the rest, to look for a uid marker.
+            need_notes = []
+            for task in _list_tasks(service, dot_tasklist_id, updated_min=since, with_notes=False):
+                known = entries.get(task['id'])
+                if task.get('deleted'):
+                    entries.pop(task['id'], None)
+                elif known is not None and known['uid']:
+                    known.update(title=task.get('title'), due=task.get('due'))
+                else:
+                    need_notes.append(task['id'])
+            fetched = _execute_batched(service, [
+                service.tasks().get(
+                    tasklist=dot_tasklist_id, task=task_id, fields=TASK_FIELDS + ',notes'
+                ) for task_id in need_notes
+            ])
+            for task_id, (task, error) in zip(need_notes, fetched):
+                if error is None:
+                    entries[task_id] = _task_entry(task)
+                elif isinstance(error, HttpError) and error.resp.status == 404:
+                    entries.pop(task_id, None)  # deleted since it was listed
+                else:
+                    raise error
         else:
-            # Get all existing tasks from the dot_tasklist
-            # Make sure to get ALL tasks including completed and hidden ones
-            existing_tasks = []
-            page_token = None
-
-            while True:
-                tasks_result = service.tasks().list(
-                    tasklist=dot_tasklist_id,
-                    showCompleted=True,
-                    showHidden=True,
-                    maxResults=100,
-                    pageToken=page_token
-                ).execute()
-
-                existing_tasks.extend(tasks_result.get('items', []))
-
-                page_token = tasks_result.get('nextPageToken')
-                if not page_token:
-                    break
-
-        # Index existing tasks two ways: by embedded UID (the real key) and by
-        # normalized title (legacy fallback to adopt pre-UID tasks once).
-        by_uid = {}
-        by_title = {}
-        for task in existing_tasks:
-            uid = extract_uid(task.get('notes'))
-            if uid:
-                by_uid[uid] = task
-            if task.get('title'):
-                by_title.setdefault(_match_title(task['title']), task)
-
+            # Get all existing tasks from the dot_tasklist; notes are needed
+            # for every task here to find the uid markers.
+            for task in _list_tasks(service, dot_tasklist_id, with_notes=True):
+                entries[task['id']] = _task_entry(task)
+
+        trace.lap('list')
+        plan = plan_sync(
+            events, entries.values(), datetime.now(timezone.utc).date(), include_past_events
+        )
+        trace.lap('diff')
         added_count = 0
         updated_count = 0
-        skipped_count = 0
-        error_count = 0
-        current_date = datetime.now(timezone.utc).date()
-
-        for event in events:
-            try:
-                key = event_key(event)
-                title = event['summary'] if event['summary'] is not None else 'Untitled Event'
-                description = event['description'] if event['description'] is not None else ''
-
-                # Desired due date (Canvas assignments only carry a start date)
-                due = None
-                if event['end']:
-                    due = convert_to_rfc3339(event['end'])
-                elif event['start']:
-                    due = convert_to_rfc3339(event['start'])
-
-                # Locate an existing task: prefer the UID match, otherwise adopt
-                # a legacy task that matches by title and has no marker yet.
-                existing = None
-                adopt_legacy = False
-                if key and key in by_uid:
-                    existing = by_uid[key]
-                else:
-                    candidate = by_title.get(_match_title(title))
-                    if candidate is not None and extract_uid(candidate.get('notes')) is None:
-                        existing = candidate
-                        adopt_legacy = True
-
-                if existing is not None:
-                    # UPDATE path — always allowed, even if the due date moved
-                    # into the past (correcting exactly that is the point).
-                    patch = {}
-                    if existing.get('title') != title:
-                        patch['title'] = title
-                    if due and _due_date_part(existing.get('due')) != _due_date_part(due):
-                        patch['due'] = due
-                    if adopt_legacy and key:
-                        # Tag the legacy task so future syncs match it by UID.
-                        patch['notes'] = with_uid_marker(existing.get('notes'), key)
-
-                    if patch:
-                        try:
-                            service.tasks().patch(
-                                tasklist=dot_tasklist_id, task=existing['id'], body=patch
-                            ).execute()
-                            existing.update(patch)
-                            updated_count += 1
-                            logging.info(f"Updated task: {title} due: {existing.get('due')}")
-                        except HttpError as patch_err:
-                            error_count += 1
-                            logging.error(f"Failed to update task '{title}': {str(patch_err)}")
-                    else:
-                        skipped_count += 1
-                        logging.info(f"No change for task: {title}")
-
-                    if key:
-                        by_uid[key] = existing
-                    continue
-
-                # INSERT path — only here do we honor include_past_events.
-                if not include_past_events and due:
-                    d = _due_date_part(due)
-                    if d is not None and d < current_date:
-                        skipped_count += 1
-                        continue
-
-                task = {
-                    'title': title,
-                    'notes': with_uid_marker(description, key),
-                    'status': 'needsAction'
+        skipped_count = plan['skipped']
+        error_count = plan['errors']
+
+        # Legacy tasks being adopted from saved state have no notes on hand;
+        # fetch them so the uid marker is appended to the user's text.
+        tagging = [op for op in plan['patches'] if op['tag_uid']]
+        fetched = _execute_batched(service, [
+            service.tasks().get(tasklist=dot_tasklist_id, task=op['id'], fields='notes')
+            for op in tagging
+        ])
+        for op, (response, error) in zip(tagging, fetched):
+            if error is None:
+                op['patch']['notes'] = with_uid_marker(response.get('notes', ''), op['tag_uid'])
+            else:
+                error_count += 1
+                logging.error(f"Failed to read task '{op['title']}': {str(error)}")
+        patches = [op for op in plan['patches'] if not op['tag_uid'] or 'notes' in op['patch']]
+
+        requests_ = [
+            service.tasks().patch(
+                tasklist=dot_tasklist_id, task=op['id'], body=op['patch'], fields='id'
+            ) for op in patches
+        ] + [
+            service.tasks().insert(tasklist=dot_tasklist_id, body=op['body'], fields='id')
+            for op in plan['inserts']
+        ]
+        results = _execute_batched(service, requests_)
+
+        for op, (response, error) in zip(patches, results):
+            if error is None:
+                entry = entries[op['id']]
+                entry.update({k: v for k, v in op['patch'].items() if k in ('title', 'due')})
+                if 'notes' in op['patch']:
+                    entry['uid'] = extract_uid(op['patch']['notes'])
+                    entry.pop('notes', None)
+                updated_count += 1
+                logging.info(f"Updated task: {op['title']} due: {entry.get('due')}")
+            else:
+                error_count += 1
+                logging.error(f"Failed to update task '{op['title']}': {str(error)}")
+
+        for op, (response, error) in zip(plan['inserts'], results[len(patches):]):
+            body = op['body']
+            if error is None:
+                entries[response['id']] = {
+                    'id': response['id'],
+                    'uid': op['uid'],
+                    'title': body['title'],
+                    'due': body.get('due'),
                 }
-                if due:
-                    task['due'] = due
-
-                validated_task = validate_task(task)
-                try:
-                    created = service.tasks().insert(
-                        tasklist=dot_tasklist_id, body=validated_task
-                    ).execute()
-                    if key:
-                        by_uid[key] = created
-                    by_title.setdefault(_match_title(title), created)
-                    added_count += 1
-                    logging.info(f"Added task: {validated_task['title']} due: {validated_task.get('due')}")
-                except HttpError as insert_err:
-                    error_count += 1
-                    logging.error(f"Failed to insert task '{validated_task['title']}': {str(insert_err)}")
-                    logging.debug(f"Task data: {validated_task}")
-            except Exception as task_err:
+                added_count += 1
+                logging.info(f"Added task: {body['title']} due: {body.get('due')}")
+            else:
                 error_count += 1
-                logging.error(f"Error processing event: {str(task_err)}")
+                logging.error(f"Failed to insert task '{body['title']}': {str(error)}")
+                logging.debug(f"Task data: {body}")
+
+        trace.lap('writes')
 
         result = {
             "success": True,
@@ -726,7 +2167,15 @@ def sync_with_tasklist(oauth_token, events, include_past_events=True):
             "skipped_count": skipped_count,
             "error_count": error_count,
             "is_sync": True,
-            "oauth_token": updated_token  # Return the possibly refreshed token
+            "oauth_token": updated_token,  # Return the possibly refreshed token
+            "tasks_state": {
+                "tasklist_id": dot_tasklist_id,
+                "listed_at": listed_at,
+                "tasks": [
+                    {k: e.get(k) for k in ('id', 'uid', 'title', 'due')}
+                    for e in entries.values()
+                ],
+            },
         }
 
         # If we had errors but some tasks were successful, still return success
@@ -741,10 +2190,12 @@ def sync_with_tasklist(oauth_token, events, include_past_events=True):
         return {
             "success": False,
             "error": str(err),
+            "error_class": type(err).__name__,
         }
     except Exception as err:
         logging.error(f"Error in sync_with_tasklist: {str(err)}")
         return {
             "success": False,
             "error": str(err),
+            "error_class": type(err).__name__,
         }
\ No newline at end of file